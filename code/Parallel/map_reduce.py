@@ -82,6 +82,7 @@ class MapReduceExperiment(object):
 
         self.make_file_names()
         self.summary = []
+        self.shared_indexes = []
 
         if self.which_piece == -1:
             piece_string = ' '
@@ -171,16 +172,33 @@ class MapReduceExperiment(object):
 
         return data
 
+    def share_index(self, aligner, index):
+        ''' Registers this piece as a user of a node-wide shared copy of an
+            aligner index until the current stage's work is done, so that
+            pieces running on the same node load it once between them.
+            Returns the mapping_tools.SharedIndex, whose mapping_options
+            should be passed to the mapper.
+        '''
+        from Sequencing import mapping_tools
+        shared_index = mapping_tools.SharedIndex(aligner, index).acquire()
+        self.shared_indexes.append(shared_index)
+        return shared_index
+
     def do_work(self, stage):
         logging.info('Beginning work for stage {0}'.format(stage))
 
         times = []
-        for function_name in self.work[stage]:
-            logging.info('Starting function {0}'.format(function_name))
-            start_time = time.time()
-            self.__getattribute__(function_name)()
-            end_time = time.time()
-            times.append((function_name, end_time - start_time))
+        try:
+            for function_name in self.work[stage]:
+                logging.info('Starting function {0}'.format(function_name))
+                start_time = time.time()
+                self.__getattribute__(function_name)()
+                end_time = time.time()
+                times.append((function_name, end_time - start_time))
+        finally:
+            # The last piece on the node to finish removes the index.
+            while self.shared_indexes:
+                self.shared_indexes.pop().release()
 
         self.write_file('timing_{0}'.format(stage), times)
         self.write_file('summary_stage_{0}'.format(stage), self.summary)
@@ -3,7 +3,7 @@ import numpy as np
 from itertools import chain
 from functools import partial
 from collections import deque
-from Sequencing import fastq
+from Sequencing import fastq, sam
 
 def generate_suffix(num_pieces, which_piece):
     ''' Suffix to append to piece number which_piece out of num_pieces.
@@ -177,6 +177,10 @@ def _find_next_sam_chunk(fh, key):
 def _find_start_of_reads(fh):
     ''' Find the position in fh immediately following the last SAM header line.
     '''
+    if os.path.isfile(getattr(fh, 'name', '')):
+        # Shares sam's cached header parse instead of rescanning every call.
+        return sam.get_header(fh.name).start_of_reads
+
     fh.seek(0)
     while True:
         start_of_line = fh.tell()
@@ -8,9 +8,10 @@ def _concatenate(input_file_names, output_file_name):
         for input_file_name in input_file_names:
             shutil.copyfileobj(open(input_file_name), output_file)
 
-def _merge_sam_files(input_file_names, merged_file_name, are_sorted=False):
+def _merge_sam_files(input_file_names, merged_file_name, are_sorted=False, **merge_kwargs):
     ''' Merges a list of sam files.
         Requires all input files to have the same @SQ lines.
+        If are_sorted, merge_kwargs are passed along to external_sort.merge_files.
     '''
     sq_lines = None
     for file_name in input_file_names:
@@ -25,13 +26,14 @@ def _merge_sam_files(input_file_names, merged_file_name, are_sorted=False):
         for sq_line in sq_lines:
             merged_file.write(sq_line)
 
-        input_files = [sam.open_to_reads(fn) for fn in input_file_names]
         if are_sorted:
-            for line in external_sort.merge(input_files):
-                merged_file.write(line)
+            external_sort.merge_files(input_file_names,
+                                      merged_file,
+                                      open_input=sam.open_to_reads,
+                                      **merge_kwargs)
         else:
-            for input_file in input_files:
-                shutil.copyfileobj(input_file, merged_file)
+            for input_file_name in input_file_names:
+                shutil.copyfileobj(sam.open_to_reads(input_file_name), merged_file)
 
 special_mergers = {'bam': sam.merge_sorted_bam_files,
                    'bam_by_name': partial(sam.merge_sorted_bam_files, by_name=True),
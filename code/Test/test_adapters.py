@@ -0,0 +1,32 @@
+import unittest
+import random
+import Sequencing.adapters
+
+class TestFindAdapters(unittest.TestCase):
+    def test_threaded(self):
+        ''' Tests that finding adapters in chunks on several threads matches
+            calling find_adapter on each seq.
+        '''
+        random.seed(0)
+        adapter = 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC'
+        seqs = []
+        for _ in range(3000):
+            insert = ''.join(random.choice('TCAG') for _ in range(random.randint(0, 100)))
+            seq = list((insert + adapter)[:100])
+            for _ in range(random.randint(0, 3)):
+                seq[random.randrange(len(seq))] = random.choice('TCAGN')
+            seqs.append(''.join(seq))
+
+        expected = [Sequencing.adapters.find_adapter(adapter, 2, seq) for seq in seqs]
+        for num_threads in [1, 4]:
+            positions = Sequencing.adapters.find_adapters_threaded(adapter,
+                                                                   2,
+                                                                   iter(seqs),
+                                                                   num_threads=num_threads,
+                                                                   chunk_size=97,
+                                                                  )
+            self.assertEqual(list(positions), expected)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFindAdapters)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,164 @@
+import unittest
+import random
+import tempfile
+import shutil
+import os
+from functools import partial
+from cStringIO import StringIO
+import Sequencing.external_sort
+import Sequencing.sam
+import Sequencing.Serialize
+
+def random_sam_lines(num_lines, seed=0):
+    random.seed(seed)
+    lines = []
+    for i in range(num_lines):
+        rname = random.choice(['chr1', 'chr2', 'chr10', '*'])
+        pos = 0 if rname == '*' else random.randint(1, 1000)
+        lines.append('read{0}\t0\t{1}\t{2}\t42\t5M\t*\t0\t0\tACGTA\tIIIII\n'.format(i, rname, pos))
+    return lines
+
+def failing_key(line):
+    if line.startswith('read500\t'):
+        raise ValueError('unparseable line', line)
+    return line
+
+class KeyFailingAfter(object):
+    ''' A key that raises after being called num_calls times. '''
+    def __init__(self, num_calls):
+        self.calls_left = num_calls
+
+    def __call__(self, line):
+        self.calls_left -= 1
+        if self.calls_left < 0:
+            raise ValueError('unparseable line', line)
+        return line
+
+class TestExternalSort(unittest.TestCase):
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def sort(self, lines, **kwargs):
+        sorted_file = StringIO()
+        Sequencing.external_sort.external_sort(iter(lines),
+                                               sorted_file,
+                                               scratch_dir=self.scratch_dir,
+                                               **kwargs)
+        return sorted_file.getvalue().splitlines(True)
+
+    def test_chunked_sort(self):
+        ''' Tests that sorting in many small, possibly compressed, chunks on
+            multiple processes matches an in-memory sort.
+        '''
+        lines = random_sam_lines(1000)
+        for kwargs in [dict(chunk_size=100),
+                       dict(memory_budget=5000, compress=True),
+                       dict(memory_budget=5000, num_processes=2),
+                      ]:
+            self.assertEqual(self.sort(lines, **kwargs), sorted(lines))
+
+    def test_coordinate_key(self):
+        ''' Tests sorting by (RNAME, POS) in @SQ order with unmapped reads
+            last, keeping input order for ties.
+        '''
+        lines = random_sam_lines(1000)
+        ref_order = {'chr1': 0, 'chr2': 1, 'chr10': 2}
+        key = partial(Sequencing.sam.coordinate_key, ref_order=ref_order)
+        sorted_lines = self.sort(lines, chunk_size=100, key=key, num_processes=2)
+        self.assertEqual(sorted_lines, sorted(lines, key=key))
+        self.assertTrue(sorted_lines[-1].split('\t')[2] == '*')
+
+    def test_cascading_merge(self):
+        ''' Tests that merging many runs with a small fan-in takes multiple
+            passes, reports them, and still matches an in-memory sort.
+        '''
+        lines = random_sam_lines(1000)
+        reports = []
+        for compress in [False, True]:
+            sorted_lines = self.sort(lines,
+                                     chunk_size=50,
+                                     fan_in=3,
+                                     compress=compress,
+                                     report=reports.append,
+                                    )
+            self.assertEqual(sorted_lines, sorted(lines))
+
+        for stats in reports:
+            self.assertEqual(stats['runs'], 20)
+            # 20 -> 7 -> 3 runs, then the final pass.
+            self.assertEqual(stats['passes'], 3)
+            self.assertTrue(stats['bytes_spilled'] > 0)
+
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_cleanup_on_failure(self):
+        ''' Tests that spilled chunks and intermediate runs are removed when
+            sorting a chunk or merging fails.
+        '''
+        lines = random_sam_lines(1000)
+        for kwargs in [dict(key=failing_key),
+                       dict(key=failing_key, num_processes=2),
+                       # Every line is keyed once while sorting, so this
+                       # fails once the first merge pass has written some
+                       # intermediate runs.
+                       dict(key=KeyFailingAfter(1500), fan_in=3),
+                      ]:
+            self.assertRaises(ValueError, self.sort, lines, chunk_size=50, **kwargs)
+            self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_closes_inputs_on_failure(self):
+        ''' Tests that inputs already opened are closed when opening a later
+            one fails.
+        '''
+        file_names = []
+        for i in range(5):
+            file_name = os.path.join(self.scratch_dir, '{0}.txt'.format(i))
+            with open(file_name, 'w') as fh:
+                fh.write('{0}\n'.format(i))
+            file_names.append(file_name)
+        file_names.append(os.path.join(self.scratch_dir, 'missing.txt'))
+
+        opened = []
+        def open_input(file_name):
+            opened.append(open(file_name))
+            return opened[-1]
+
+        for fan_in in [3, 10]:
+            opened = []
+            self.assertRaises(IOError,
+                              Sequencing.external_sort.merge_files,
+                              file_names,
+                              StringIO(),
+                              fan_in=fan_in,
+                              scratch_dir=self.scratch_dir,
+                              open_input=open_input,
+                             )
+            self.assertEqual(len(opened), 5)
+            self.assertTrue(all(fh.closed for fh in opened))
+
+    def test_merge_sam_files(self):
+        ''' Tests merging sorted sam files with headers in multiple passes. '''
+        header = ['@SQ\tSN:chr1\tLN:1000\n']
+        lines = random_sam_lines(100)
+        file_names = []
+        for i in range(5):
+            file_name = os.path.join(self.scratch_dir, '{0}.sam'.format(i))
+            with open(file_name, 'w') as sam_file:
+                sam_file.writelines(header + sorted(lines[i::5]))
+            file_names.append(file_name)
+
+        merged_file_name = os.path.join(self.scratch_dir, 'merged.sam')
+        Sequencing.Serialize._merge_sam_files(file_names,
+                                              merged_file_name,
+                                              are_sorted=True,
+                                              fan_in=2,
+                                              scratch_dir=self.scratch_dir,
+                                             )
+        self.assertEqual(open(merged_file_name).readlines(), header + sorted(lines))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestExternalSort)
+    unittest.TextTestRunner(verbosity=2).run(suite)
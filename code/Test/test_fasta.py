@@ -0,0 +1,44 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import Bio.SeqIO
+import Sequencing.fasta
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_matches_biopython(self):
+        ''' Tests that parsing with buffers that split records, lines and
+            headers anywhere gives the same records as Bio.SeqIO.
+        '''
+        random.seed(0)
+        fasta_fn = os.path.join(self.temp_dir, 'targets.fa')
+        with open(fasta_fn, 'w') as fasta_file:
+            fasta_file.write('comment before the first record\n')
+            for i in range(50):
+                fasta_file.write('>target{0} description {0}\n'.format(i))
+                seq = ''.join(random.choice('ACGTNacgt') for _ in range(random.randint(0, 200)))
+                line_length = random.randint(1, 80)
+                for start in range(0, len(seq), line_length):
+                    line_end = random.choice(['\n', '\r\n', ' \n'])
+                    fasta_file.write(seq[start:start + line_length] + line_end)
+                if random.random() < 0.2:
+                    fasta_file.write('\n')
+
+        expected = [(record.id, str(record.seq)) for record in Bio.SeqIO.parse(fasta_fn, 'fasta')]
+        for buffer_size in [1, 2, 7, 100, 2**22]:
+            records = list(Sequencing.fasta.records(fasta_fn, buffer_size=buffer_size))
+            self.assertEqual(records, expected)
+
+        reads = list(Sequencing.fasta.reads(fasta_fn))
+        self.assertEqual(reads, [(name, seq.upper()) for name, seq in expected])
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRecords)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,105 @@
+import unittest
+import random
+import numpy as np
+import Sequencing.fastq
+
+def random_reads(num_reads, max_length, max_q=Sequencing.fastq.MAX_EXPECTED_QUAL):
+    random.seed(0)
+    reads = []
+    for i in range(num_reads):
+        length = random.randint(0, max_length)
+        seq = ''.join(random.choice('TCAGN') for _ in range(length))
+        qual = ''.join(chr(33 + random.randint(0, max_q)) for _ in range(length))
+        reads.append(Sequencing.fastq.Read('read{0}'.format(i), seq, qual))
+    return reads
+
+class TestQualityAndComplexity(unittest.TestCase):
+    def serial(self, reads, max_read_length):
+        ''' The per-read computation that process_reads batches. '''
+        q_array = np.zeros((max_read_length, Sequencing.fastq.MAX_EXPECTED_QUAL + 1), int)
+        c_array = np.zeros((max_read_length, 256), int)
+        average_q_distribution = np.zeros(Sequencing.fastq.MAX_EXPECTED_QUAL + 1, int)
+        for read in reads:
+            average_q = Sequencing.fastq.process_read(read.seq, read.qual, q_array, c_array)
+            average_q_distribution[int(average_q)] += 1
+        return q_array, c_array, average_q_distribution
+
+    def test_process_reads(self):
+        reads = random_reads(2000, 50)
+        expected = self.serial(reads, 50)
+
+        q_array = np.zeros_like(expected[0])
+        c_array = np.zeros_like(expected[1])
+        average_q_distribution = np.zeros_like(expected[2])
+        Sequencing.fastq.process_reads(reads, q_array, c_array, average_q_distribution)
+        for array, expected_array in zip([q_array, c_array, average_q_distribution], expected):
+            self.assertTrue(np.array_equal(array, expected_array))
+
+    def test_threaded(self):
+        ''' Tests that processing chunks on several threads gives the same
+            totals as one thread.
+        '''
+        reads = random_reads(2000, 50)
+        serial = Sequencing.fastq.quality_and_complexity(iter(reads), 50)
+        threaded = Sequencing.fastq.quality_and_complexity(iter(reads), 50, num_threads=4, chunk_size=97)
+        for array, expected_array in zip(threaded, serial):
+            self.assertTrue(np.array_equal(array, expected_array))
+
+        _, _, expected_average_qs = self.serial(reads, 50)
+        self.assertTrue(np.array_equal(serial[2], expected_average_qs))
+
+    def test_out_of_range(self):
+        ''' Tests that Phred+64 qualities and overlong reads raise IndexError
+            instead of writing outside the arrays.
+        '''
+        phred_64 = [Sequencing.fastq.Read('read', 'ACGT', 'hhhh')]
+        long_read = [Sequencing.fastq.Read('read', 'A' * 60, 'I' * 60)]
+        for reads, max_read_length in [(phred_64, 50), (long_read, 50)]:
+            self.assertRaises(IndexError, self.serial, reads, max_read_length)
+            for num_threads in [1, 2]:
+                self.assertRaises(IndexError,
+                                  Sequencing.fastq.quality_and_complexity,
+                                  random_reads(500, 50) + reads,
+                                  max_read_length,
+                                  num_threads=num_threads,
+                                  chunk_size=100,
+                                 )
+
+    def test_out_of_range_leaves_no_counts(self):
+        ''' Tests that a read rejected partway through is not partially
+            counted.
+        '''
+        good_read = Sequencing.fastq.Read('good', 'ACGT', 'IIII')
+        bad_read = Sequencing.fastq.Read('bad', 'ACGT', 'IIIh')
+        expected_q_array, expected_c_array, _ = self.serial([good_read], 10)
+
+        q_array = np.zeros_like(expected_q_array)
+        c_array = np.zeros_like(expected_c_array)
+        self.assertRaises(IndexError, Sequencing.fastq.process_read, bad_read.seq, bad_read.qual, q_array, c_array)
+        self.assertFalse(q_array.any() or c_array.any())
+
+        average_q_distribution = np.zeros(Sequencing.fastq.MAX_EXPECTED_QUAL + 1, int)
+        self.assertRaises(IndexError,
+                          Sequencing.fastq.process_reads,
+                          [good_read, bad_read],
+                          q_array,
+                          c_array,
+                          average_q_distribution,
+                         )
+        self.assertTrue(np.array_equal(q_array, expected_q_array))
+        self.assertTrue(np.array_equal(c_array, expected_c_array))
+
+        # An average quality past the end of average_q_distribution is
+        # rejected before anything is counted too.
+        self.assertRaises(IndexError,
+                          Sequencing.fastq.process_reads,
+                          [good_read],
+                          q_array,
+                          c_array,
+                          np.zeros(10, int),
+                         )
+        self.assertTrue(np.array_equal(q_array, expected_q_array))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestQualityAndComplexity)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,228 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+import pysam
+import Sequencing.genomes
+import Sequencing.sam
+
+class TestPackedGenome(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        random.seed(0)
+        self.seqs = {}
+        for name, length in [('chr1', 1001), ('chr2', 64), ('chr3', 3)]:
+            seq = [random.choice('ACGTacgt') for _ in range(length)]
+            for _ in range(5):
+                start = random.randrange(length)
+                seq[start:start + random.randint(1, 20)] = 'N' * random.randint(1, 20)
+            self.seqs[name] = ''.join(seq)[:length]
+        self.seqs['chr1'] = 'NN' + self.seqs['chr1'][2:-1] + 'R'
+
+        for file_name, names in [('first.fa', ['chr1']), ('second.fasta', ['chr2', 'chr3'])]:
+            with open(os.path.join(self.temp_dir, file_name), 'w') as fasta_file:
+                for name in names:
+                    fasta_file.write('>{0}\n{1}\n'.format(name, self.seqs[name]))
+        Sequencing.genomes.make_fais(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def expected(self, name):
+        return ''.join(b if b in 'ACGT' else 'N' for b in self.seqs[name].upper())
+
+    def test_fetch(self):
+        ''' Tests that regions and batches of positions from the packed genome
+            match the upper-cased fastas, with ambiguous bases as N.
+        '''
+        genome = Sequencing.genomes.load_packed_genome(self.temp_dir)
+        fetcher = Sequencing.genomes.build_region_fetcher(self.temp_dir, packed=True)
+        for name in self.seqs:
+            expected = self.expected(name)
+            length = len(expected)
+            self.assertEqual(genome.fetch(name), expected)
+            for _ in range(200):
+                start = random.randint(-5, length + 5)
+                end = random.randint(max(start, 0), length + 10)
+                self.assertEqual(fetcher(name, start, end),
+                                 '-' * max(0, -start) + expected[max(start, 0):end] + '-' * max(0, end - max(start, length)))
+
+            positions = np.random.randint(0, length, 100)
+            self.assertEqual(genome.bases_at(name, positions), ''.join(expected[p] for p in positions))
+            self.assertEqual(genome.bases_at(name, positions, as_array=True).tostring(),
+                             genome.bases_at(name, positions))
+            self.assertEqual(''.join(genome.base(name, p) for p in range(length)), expected)
+
+    def test_load_entire_genome(self):
+        ''' Tests that sequences read through fais match parsed ones. '''
+        from_fais = Sequencing.genomes.load_entire_genome(self.temp_dir)
+        self.assertEqual(from_fais, self.seqs)
+        for fai_file_name in Sequencing.genomes.get_all_fai_file_names(self.temp_dir):
+            os.remove(fai_file_name)
+        self.assertEqual(Sequencing.genomes.load_entire_genome(self.temp_dir), self.seqs)
+
+    def test_empty_records(self):
+        ''' Tests that records left out of the fai for being empty are still
+            loaded, and that a fai whose names don't match the fasta's headers
+            is ignored.
+        '''
+        genome_dir = os.path.join(self.temp_dir, 'empty')
+        os.mkdir(genome_dir)
+        fasta_fn = os.path.join(genome_dir, 'genome.fa')
+        with open(fasta_fn, 'w') as fasta_file:
+            fasta_file.write('>a first\nACGT\n>empty\n>b\nAC\n')
+        Sequencing.genomes.make_fais(genome_dir)
+        self.assertEqual(sorted(Sequencing.genomes.parse_fai(fasta_fn + '.fai')), ['a', 'b'])
+        expected = {'a': 'ACGT', 'empty': '', 'b': 'AC'}
+        self.assertEqual(Sequencing.genomes.load_entire_genome(genome_dir), expected)
+
+        # samtools won't index a fasta ending in an empty record, so this fai
+        # is written by hand.
+        with open(fasta_fn, 'a') as fasta_file:
+            fasta_file.write('>last_empty\n')
+        with open(fasta_fn + '.fai', 'w') as fai_file:
+            fai_file.write('a\t4\t8\t4\t5\nb\t2\t23\t2\t3\n')
+        expected['last_empty'] = ''
+        self.assertEqual(Sequencing.genomes.load_entire_genome(genome_dir), expected)
+
+        with open(fasta_fn + '.fai', 'w') as fai_file:
+            fai_file.write('a\t4\t8\t4\t5\nc\t2\t23\t2\t3\n')
+        self.assertEqual(Sequencing.genomes.load_entire_genome(genome_dir), expected)
+
+    def test_repack(self):
+        ''' Tests that packing is only redone when a fasta changes. '''
+        prefix = Sequencing.genomes.pack_genome(self.temp_dir)
+        packed_time = int(os.path.getmtime(prefix + '.index'))
+        os.utime(prefix + '.index', (packed_time + 10, packed_time + 10))
+        Sequencing.genomes.pack_genome(self.temp_dir)
+        self.assertEqual(os.path.getmtime(prefix + '.index'), packed_time + 10)
+
+        fasta_file_name = os.path.join(self.temp_dir, 'second.fasta')
+        with open(fasta_file_name, 'w') as fasta_file:
+            fasta_file.write('>chr2\nGATTACA\n>chr3\nTT\n')
+        os.utime(fasta_file_name, (packed_time + 20, packed_time + 20))
+        genome = Sequencing.genomes.load_packed_genome(self.temp_dir)
+        self.assertEqual(genome.fetch('chr2'), 'GATTACA')
+
+class TestReferenceCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        random.seed(0)
+        self.seqs = {}
+        for i in range(20):
+            name = 'contig{0}'.format(i)
+            self.seqs[name] = ''.join(random.choice('ACGT') for _ in range(random.randint(50, 150)))
+            with open(os.path.join(self.temp_dir, name + '.fa'), 'w') as fasta_file:
+                fasta_file.write('>{0}\n{1}\n'.format(name, self.seqs[name]))
+        Sequencing.genomes.make_fais(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_bounded(self):
+        ''' Tests that a fetcher over many contig files matches the fastas
+            while holding a bounded number of open files and cached bases.
+        '''
+        for load_references in [False, True]:
+            stats = {}
+            fetcher = Sequencing.genomes.build_region_fetcher(self.temp_dir,
+                                                              load_references=load_references,
+                                                              cache_bytes=300,
+                                                              max_open_files=3,
+                                                              stats=stats,
+                                                              block_size=64,
+                                                             )
+            names = sorted(self.seqs)
+            for _ in range(500):
+                # Mostly a few hot contigs.
+                name = random.choice(names[:2] if random.random() < 0.8 else names)
+                start = random.randint(0, 50)
+                end = random.randint(start, 200)
+                self.assertEqual(fetcher(name, start, end), self.seqs[name][start:end].ljust(end - start, '-'))
+                self.assertLessEqual(stats['opened'] - stats['closed'], 3)
+
+            if load_references:
+                self.assertGreater(stats['hits'], stats['misses'])
+                self.assertGreater(stats['evicted'], 0)
+
+        cache = Sequencing.genomes.ReferenceCache(self.temp_dir, cache_bytes=300, block_size=64)
+        for _ in range(500):
+            name = random.choice(sorted(self.seqs))
+            start = random.randint(0, len(self.seqs[name]) - 1)
+            end = random.randint(start, 160)
+            self.assertEqual(cache.fetch(name, start, end), self.seqs[name][start:end])
+            self.assertEqual(cache.base(name, start), self.seqs[name][start])
+            self.assertLessEqual(cache.references.weight, 300)
+
+    def test_lru(self):
+        ''' Tests that the least recently used entries are evicted first. '''
+        evicted = []
+        cache = Sequencing.genomes.LRUCache(5, weigh=len, on_evict=lambda k, v: evicted.append(k))
+        cache.put('a', 'xx')
+        cache.put('b', 'xx')
+        cache.get('a')
+        cache.put('c', 'xx')
+        self.assertEqual(evicted, ['b'])
+        self.assertEqual(sorted(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.weight, 4)
+
+class TestMismatches(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        random.seed(0)
+        self.seqs = {name: ''.join(random.choice('ACGTNacgt') for _ in range(300))
+                     for name in ['chr1', 'chr2']}
+        with open(os.path.join(self.temp_dir, 'genome.fa'), 'w') as fasta_file:
+            for name in sorted(self.seqs):
+                fasta_file.write('>{0}\n{1}\n'.format(name, self.seqs[name]))
+        Sequencing.genomes.make_fais(self.temp_dir)
+
+        header = {'SQ': [{'SN': name, 'LN': 300} for name in sorted(self.seqs)]}
+        self.sam_fn = os.path.join(self.temp_dir, 'mappings.bam')
+        self.sam_file = pysam.AlignmentFile(self.sam_fn, 'wb', header=header)
+
+    def tearDown(self):
+        self.sam_file.close()
+        shutil.rmtree(self.temp_dir)
+
+    def random_mapping(self):
+        mapping = pysam.AlignedSegment()
+        cigar = [(random.choice([0, 0, 1, 2, 7, 8]), random.randint(1, 10)) for _ in range(5)]
+        cigar = [(4, 3), (0, 5)] + cigar + [(0, 5), (4, 2)]
+        read_length = sum(length for op, length in cigar if op in [0, 1, 4, 7, 8])
+        mapping.query_sequence = ''.join(random.choice('ACGTN') for _ in range(read_length))
+        mapping.reference_id = random.randint(0, 1)
+        mapping.reference_start = random.randint(0, 200)
+        mapping.cigartuples = cigar
+        return mapping
+
+    def test_group_mismatch_positions(self):
+        ''' Tests that comparing all of a group's bases at once finds the same
+            mismatches as looking bases up one at a time.
+        '''
+        base_lookup = Sequencing.genomes.build_base_lookup(self.temp_dir, self.sam_file)
+        for packed in [False, True]:
+            extent_fetcher = Sequencing.genomes.build_extent_fetcher(self.temp_dir, self.sam_file, packed=packed)
+            for _ in range(50):
+                group = [self.random_mapping() for _ in range(random.randint(1, 5))]
+                for max_span in [10, 10**5]:
+                    found = Sequencing.sam.group_mismatch_positions(group, extent_fetcher, max_span=max_span)
+                    for mapping, (read_positions, ref_positions) in zip(group, found):
+                        expected = []
+                        for read_i, ref_i in Sequencing.sam.aligned_pairs_exclude_soft_clipping(mapping):
+                            if read_i is not None and ref_i is not None:
+                                ref_base = base_lookup(mapping.tid, ref_i).upper()
+                                if ref_base not in 'ACGT':
+                                    ref_base = 'N'
+                                if mapping.seq[read_i] != ref_base:
+                                    expected.append((read_i, ref_i))
+                        self.assertEqual(zip(read_positions, ref_positions), expected)
+
+        self.assertEqual(Sequencing.sam.group_mismatch_positions([], extent_fetcher), [])
+
+if __name__ == '__main__':
+    for case in [TestPackedGenome, TestReferenceCache, TestMismatches]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity=2).run(suite)
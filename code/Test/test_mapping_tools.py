@@ -0,0 +1,422 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import pysam
+import Sequencing.mapping_tools
+import Sequencing.fastq
+
+# Stands in for bwa. Each aln waits until every aln it is run alongside has
+# started, so sequential alns would time out. sampe writes one unsorted
+# mapping per read pair. If FAKE_BWA_FAIL is aln, R1's aln fails and R2's
+# hangs; if it is sampe, sampe fails without writing anything.
+fake_bwa = r'''#!/bin/bash
+command=$1
+shift
+if [ "$FAKE_BWA_FAIL" == "$command" ]; then
+    if [ "$command" == "aln" ] && [[ "$@" == *R2* ]]; then
+        exec sleep 30
+    fi
+    echo "$command failed on $@" >&2
+    exit 1
+fi
+if [ "$command" == "aln" ]; then
+    echo "aln $@" >&2
+    touch "$FAKE_BWA_DIR/started_$$"
+    for i in $(seq 100); do
+        [ $(ls "$FAKE_BWA_DIR" | grep -c started_) -ge 2 ] && break
+        sleep 0.05
+    done
+    [ $(ls "$FAKE_BWA_DIR" | grep -c started_) -ge 2 ] || exit 1
+    echo sai
+elif [ "$command" == "sampe" ]; then
+    echo "sampe" >&2
+    printf '@SQ\tSN:chr1\tLN:1000\n'
+    for pos in 50 10 30; do
+        printf "pair$pos\t0\tchr1\t$pos\t42\t4M\t*\t0\t0\tACGT\tIIII\n"
+    done
+fi
+'''
+
+# Stands in for bowtie2. Logs its arguments and copies stdin, or the file
+# named by FAKE_BOWTIE2_SAM if set, to the -S file. Without -S, "aligns" each
+# unpaired readN on stdin to position N + 1 and writes SAM to stdout.
+fake_bowtie2 = r'''#!/bin/bash
+echo "$@" >&2
+while [ $# -gt 0 ]; do
+    [ "$1" == "-S" ] && output=$2
+    shift
+done
+if [ -z "$output" ]; then
+    printf '@SQ\tSN:chr1\tLN:100000\n'
+    awk 'NR % 4 == 1 { name = substr($0, 2); split(name, fields, "read") }
+         NR % 4 == 2 { seq = $0 }
+         NR % 4 == 0 { printf "%s\t0\tchr1\t%d\t42\t%dM\t*\t0\t0\t%s\t%s\n", name, fields[2] + 1, length(seq), seq, $0 }'
+elif [ -n "$FAKE_BOWTIE2_SAM" ]; then
+    cat "$FAKE_BOWTIE2_SAM" > "$output"
+else
+    cat > "$output"
+fi
+'''
+
+# Stands in for the samtools view/sort/index/merge calls made by
+# mapping_tools and sam, using pysam.
+fake_samtools = '''#!{0}
+import sys, pysam
+command, args = sys.argv[1], sys.argv[2:]
+if command == 'index':
+    pysam.index(args[0])
+    sys.exit()
+
+if command == 'view':
+    input_fns, output_fn = [args[-1]], '-'
+    key = None
+elif command == 'sort':
+    input_fns, output_fn = [args[-1]], args[args.index('-o') + 1]
+elif command == 'merge':
+    positional = [arg for arg in args if not arg.startswith('-')]
+    output_fn, input_fns = positional[0], positional[1:]
+
+if '-n' in args:
+    key = lambda m: m.query_name
+else:
+    key = lambda m: (m.reference_id, m.reference_start)
+
+input_files = [pysam.AlignmentFile(fn) for fn in input_fns]
+mappings = [m for input_file in input_files for m in input_file]
+if command != 'view':
+    mappings.sort(key=key)
+with pysam.AlignmentFile(output_fn, 'wbu' if command == 'view' else 'wb', template=input_files[0]) as output_file:
+    for mapping in mappings:
+        output_file.write(mapping)
+'''.format(sys.executable)
+
+# Stands in for bowtie2-build. Logs each build and writes the sequences as
+# the index.
+fake_bowtie2_build = r'''#!/bin/bash
+echo "$2" >> "$FAKE_BWA_DIR/../builds.txt"
+sleep 0.2
+cat ${1//,/ } > "$2.1.bt2"
+'''
+
+# Stands in for STAR. Logs each --genomeLoad and the --readFilesIn values. When
+# mapping reads, drains R1 if it is a FIFO and writes an empty sorted BAM with
+# the prefix. Fails before reading anything if FAKE_STAR_FAIL is set.
+fake_star = r'''#!/bin/bash
+if [ -n "$FAKE_STAR_FAIL" ]; then
+    echo "fake STAR failure" >&2
+    exit 1
+fi
+while [ $# -gt 0 ]; do
+    if [ "$1" == "--genomeLoad" ]; then
+        echo "$2" >> "$FAKE_BWA_DIR/../genome_loads.txt"
+    elif [ "$1" == "--outFileNamePrefix" ]; then
+        prefix=$2
+    elif [ "$1" == "--readFilesIn" ]; then
+        read_files=()
+        while [ $# -gt 1 ] && [[ "$2" != --* ]]; do
+            read_files+=("$2")
+            shift
+        done
+        echo "${read_files[@]}" >> "$FAKE_BWA_DIR/../read_files.txt"
+    fi
+    shift
+done
+if [ -n "$read_files" ]; then
+    if [ -p "${read_files[0]}" ]; then
+        cat "${read_files[0]}" > /dev/null
+    fi
+    printf '@SQ\tSN:chr1\tLN:100\n' > "${prefix}Aligned.sam"
+    samtools view -u "${prefix}Aligned.sam" > "${prefix}Aligned.sortedByCoord.out.bam"
+fi
+'''
+
+def install_fake(bin_dir, name, script):
+    fn = os.path.join(bin_dir, name)
+    with open(fn, 'w') as fh:
+        fh.write(script)
+    os.chmod(fn, 0755)
+
+class TestMappers(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.mkdir(bin_dir)
+        install_fake(bin_dir, 'bwa', fake_bwa)
+        install_fake(bin_dir, 'bowtie2', fake_bowtie2)
+        install_fake(bin_dir, 'samtools', fake_samtools)
+        install_fake(bin_dir, 'bowtie2-build', fake_bowtie2_build)
+        install_fake(bin_dir, 'STAR', fake_star)
+
+        os.environ['FAKE_BWA_DIR'] = os.path.join(self.temp_dir, 'started')
+        os.mkdir(os.environ['FAKE_BWA_DIR'])
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.old_path
+        Sequencing.mapping_tools.bwa_indexes_location = self.temp_dir
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        os.environ.pop('FAKE_BOWTIE2_SAM', None)
+        os.environ.pop('FAKE_BWA_FAIL', None)
+        os.environ.pop('FAKE_STAR_FAIL', None)
+        del Sequencing.mapping_tools.bwa_indexes_location
+        shutil.rmtree(self.temp_dir)
+
+    def test_map_paired_bwa(self):
+        ''' Tests that R1 and R2 alns run concurrently with split threads and
+            that sampe output is sorted straight into a BAM.
+        '''
+        fns = {name: os.path.join(self.temp_dir, name) for name in ['R1.sai', 'R2.sai', 'error.txt', 'sorted.bam']}
+        Sequencing.mapping_tools.map_paired_bwa('R1.fastq', 'R2.fastq',
+                                                'genome',
+                                                fns['R1.sai'], fns['R2.sai'],
+                                                None,
+                                                fns['error.txt'],
+                                                threads=4,
+                                                bam_file_name=fns['sorted.bam'],
+                                               )
+        positions = [m.reference_start for m in pysam.AlignmentFile(fns['sorted.bam'])]
+        self.assertEqual(positions, [9, 29, 49])
+        self.assertTrue(os.path.exists(fns['sorted.bam'] + '.bai'))
+
+        errors = open(fns['error.txt']).read().splitlines()
+        self.assertEqual(sorted(errors[:2]), ['aln -t 2 {0}/genome R1.fastq'.format(self.temp_dir),
+                                              'aln -t 2 {0}/genome R2.fastq'.format(self.temp_dir),
+                                             ])
+        self.assertEqual(errors[2:], ['sampe'])
+
+    def test_map_paired_bwa_failures(self):
+        ''' Tests that a failed aln stops its sibling and that a sampe that
+            dies before writing a header surfaces its error output.
+        '''
+        fns = {name: os.path.join(self.temp_dir, name) for name in ['R1.sai', 'R2.sai', 'error.txt', 'sorted.bam']}
+        map_paired = lambda: Sequencing.mapping_tools.map_paired_bwa('R1.fastq', 'R2.fastq',
+                                                                     'genome',
+                                                                     fns['R1.sai'], fns['R2.sai'],
+                                                                     None,
+                                                                     fns['error.txt'],
+                                                                     threads=2,
+                                                                     bam_file_name=fns['sorted.bam'],
+                                                                    )
+        for command, failed_file in [('aln', 'R1.fastq'), ('sampe', 'R1.sai')]:
+            os.environ['FAKE_BWA_FAIL'] = command
+            start = time.time()
+            with self.assertRaises(Sequencing.mapping_tools.subprocess.CalledProcessError) as context:
+                map_paired()
+            self.assertLess(time.time() - start, 10)
+            self.assertIn('{0} failed on'.format(command), str(context.exception))
+            self.assertIn(failed_file, str(context.exception))
+
+    def test_bowtie2_interleaved(self):
+        ''' Tests that read pairs reach stock bowtie2 interleaved on stdin. '''
+        read_pairs = [(Sequencing.fastq.Read('pair{0}'.format(i), 'ACGT', 'IIII'),
+                       Sequencing.fastq.Read('pair{0}'.format(i), 'TTGA', 'IIII'),
+                      )
+                      for i in range(25000)
+                     ]
+        fns = {name: os.path.join(self.temp_dir, name) for name in ['output.txt', 'error.txt']}
+        Sequencing.mapping_tools.map_bowtie2('index',
+                                             read_pairs=iter(read_pairs),
+                                             output_file_name=fns['output.txt'],
+                                             error_file_name=fns['error.txt'],
+                                            )
+        expected = ''.join(str(R1) + str(R2) for R1, R2 in read_pairs)
+        self.assertEqual(open(fns['output.txt']).read(), expected)
+        command = open(fns['error.txt']).read().split()
+        self.assertEqual(command, ['-x', 'index', '--interleaved', '-', '-S', fns['output.txt']])
+
+    def test_bowtie2_reads_error(self):
+        ''' Tests that an error producing the reads fed to bowtie2 on stdin
+            is raised rather than passed off as an early end of input.
+        '''
+        def reads():
+            for i in range(15000):
+                yield Sequencing.fastq.Read('read{0}'.format(i), 'ACGT', 'IIII')
+            raise ValueError('malformed read')
+
+        output_fn = os.path.join(self.temp_dir, 'output.txt')
+        with self.assertRaises(ValueError):
+            Sequencing.mapping_tools.map_bowtie2('index',
+                                                 reads=reads(),
+                                                 output_file_name=output_fn,
+                                                )
+
+    def test_bowtie2_binary_mappings(self):
+        ''' Tests that mappings yielded through BAM conversion and read
+            ahead match those parsed from SAM.
+        '''
+        sam_fn = os.path.join(self.temp_dir, 'fixed.sam')
+        with open(sam_fn, 'w') as sam_fh:
+            sam_fh.write('@SQ\tSN:chr1\tLN:100000\n')
+            for i in range(5000):
+                sam_fh.write('read{0}\t0\tchr1\t{1}\t42\t4M\t*\t0\t0\tACGT\tIIII\n'.format(i, i + 1))
+        os.environ['FAKE_BOWTIE2_SAM'] = sam_fn
+
+        results = []
+        for binary, prefetch in [(False, False), (True, True)]:
+            sam_file, mappings = Sequencing.mapping_tools.map_bowtie2('index',
+                                                                      R1_fn='reads.fastq',
+                                                                      yield_mappings=True,
+                                                                      binary_mappings=binary,
+                                                                      prefetch_mappings=prefetch,
+                                                                     )
+            results.append((sam_file.references, [(m.qname, m.pos) for m in mappings]))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0][1]), 5000)
+
+    def test_bowtie2_sharded(self):
+        ''' Tests that reads split across concurrent shards all come back in
+            one merged, sorted BAM, with per-shard timings.
+        '''
+        reads = (Sequencing.fastq.Read('read{0}'.format(i), 'ACGT', 'IIII') for i in range(2000))
+        bam_fn = os.path.join(self.temp_dir, 'merged.bam')
+        error_fn = os.path.join(self.temp_dir, 'error.txt')
+        timings = []
+        Sequencing.mapping_tools.map_bowtie2_sharded('index',
+                                                     bam_fn,
+                                                     reads=reads,
+                                                     num_shards=3,
+                                                     threads_per_shard=2,
+                                                     records_per_chunk=100,
+                                                     scratch_dir=self.temp_dir,
+                                                     timings=timings,
+                                                     error_file_name=error_fn,
+                                                    )
+        positions = [m.reference_start for m in pysam.AlignmentFile(bam_fn)]
+        self.assertEqual(positions, range(2000))
+        self.assertTrue(os.path.exists(bam_fn + '.bai'))
+
+        self.assertEqual(sorted(timing['shard'] for timing in timings), [0, 1, 2])
+        self.assertEqual(sum(timing['records'] for timing in timings), 2000)
+        self.assertTrue(all(timing['threads'] == 2 for timing in timings))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['bin', 'error.txt.shard_0', 'error.txt.shard_1', 'error.txt.shard_2', 'merged.bam', 'merged.bam.bai', 'started'])
+
+        self.assertEqual(Sequencing.mapping_tools.choose_shard_layout(3 * 10**9, num_cpus=16, available_memory=10**10), (3, 5))
+        self.assertEqual(Sequencing.mapping_tools.choose_shard_layout(3 * 10**9, num_cpus=16, shared_index=True), (8, 2))
+
+    def test_cached_index(self):
+        ''' Tests that concurrent and repeated requests for the same
+            sequences share one build, and that the least recently used index
+            is evicted to stay under the disk budget.
+        '''
+        cache_root = os.path.join(self.temp_dir, 'cache')
+        fasta_fns = []
+        for name in ['first', 'second']:
+            fasta_fn = os.path.join(self.temp_dir, name + '.fa')
+            with open(fasta_fn, 'w') as fasta_fh:
+                fasta_fh.write('>{0}\n{1}\n'.format(name, 'ACGT' * 100))
+            fasta_fns.append(fasta_fn)
+
+        cached = lambda fn: Sequencing.mapping_tools.cached_bowtie2_index([fn],
+                                                                          cache_root=cache_root,
+                                                                          disk_budget=500,
+                                                                          protect_seconds=0,
+                                                                         )
+        threads = [threading.Thread(target=cached, args=(fasta_fns[0],)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        first_prefix = cached(fasta_fns[0])
+        self.assertEqual(open(first_prefix + '.1.bt2').read(), open(fasta_fns[0]).read())
+        builds = open(os.path.join(self.temp_dir, 'builds.txt')).read().splitlines()
+        self.assertEqual(len(builds), 1)
+
+        # Both indexes don't fit in the budget, so the first is evicted.
+        second_prefix = cached(fasta_fns[1])
+        self.assertNotEqual(second_prefix, first_prefix)
+        self.assertTrue(os.path.exists(second_prefix + '.1.bt2'))
+        self.assertFalse(os.path.exists(first_prefix + '.1.bt2'))
+
+        # A build left by a killed process is removed, but not one whose key
+        # is still locked by its builder.
+        abandoned_dir = os.path.join(cache_root, 'abandoned.building.1')
+        running_dir = os.path.join(cache_root, 'running.building.1')
+        for building_dir in [abandoned_dir, running_dir]:
+            os.mkdir(building_dir)
+        with Sequencing.mapping_tools._locked(os.path.join(cache_root, 'running.lock')):
+            self.assertEqual(cached(fasta_fns[1]), second_prefix)
+        self.assertFalse(os.path.exists(abandoned_dir))
+        self.assertTrue(os.path.exists(running_dir))
+
+    def test_shared_index(self):
+        ''' Tests that overlapping users of a shared STAR index load it once
+            and the last one to release it removes it, ignoring users that
+            died without releasing.
+        '''
+        index_dir = os.path.join(self.temp_dir, 'index')
+        shared = lambda: Sequencing.mapping_tools.SharedIndex('STAR', index_dir, registry_dir=self.temp_dir)
+        loads_fn = os.path.join(self.temp_dir, 'genome_loads.txt')
+        loads = lambda: open(loads_fn).read().splitlines() if os.path.exists(loads_fn) else []
+
+        # A piece that was killed while holding the index.
+        dead = Sequencing.mapping_tools.subprocess.Popen(['true'])
+        dead.wait()
+        with open(shared().registry_file_name, 'w') as registry_file:
+            registry_file.write('{0}\n'.format(dead.pid))
+
+        first = shared().acquire()
+        self.assertEqual(first.mapping_options, {'genome_load': 'LoadAndKeep'})
+        with shared():
+            first.release()
+            self.assertEqual(loads(), ['LoadAndExit'])
+        self.assertEqual(loads(), ['LoadAndExit', 'Remove'])
+
+    def test_map_star(self):
+        ''' Tests that both read files reach --readFilesIn, alongside a
+            --genomeLoad.
+        '''
+        output_prefix = os.path.join(self.temp_dir, 'star_')
+        read_files_fn = os.path.join(self.temp_dir, 'read_files.txt')
+        for R2_fn in [None, 'R2.fq']:
+            Sequencing.mapping_tools.map_star('R1.fq',
+                                              'index',
+                                              output_prefix,
+                                              R2_fn=R2_fn,
+                                              genome_load='LoadAndKeep',
+                                             )
+            self.assertTrue(os.path.exists(output_prefix + 'Aligned.sortedByCoord.out.bam.bai'))
+
+        self.assertEqual(open(read_files_fn).read().splitlines(), ['R1.fq', 'R1.fq R2.fq'])
+        loads = open(os.path.join(self.temp_dir, 'genome_loads.txt')).read().splitlines()
+        self.assertEqual(loads, ['LoadAndKeep', 'LoadAndKeep'])
+
+    def test_star_sharded_failures(self):
+        ''' Tests that an error reading the input, or a STAR that exits
+            without opening its FIFO, is raised rather than lost or hung on.
+        '''
+        def reads(fail_after=None):
+            for i in range(500):
+                if i == fail_after:
+                    raise ValueError('bad read')
+                yield Sequencing.fastq.Read('read{0}'.format(i), 'ACGT', 'IIII')
+
+        bam_fn = os.path.join(self.temp_dir, 'star.bam')
+        def map_sharded(reads):
+            Sequencing.mapping_tools.map_star_sharded(reads,
+                                                      'index',
+                                                      bam_fn,
+                                                      num_shards=2,
+                                                      threads_per_shard=1,
+                                                      records_per_chunk=100,
+                                                      scratch_dir=self.temp_dir,
+                                                     )
+
+        map_sharded(reads())
+        self.assertTrue(os.path.exists(bam_fn))
+
+        self.assertRaisesRegexp(ValueError, 'bad read', map_sharded, reads(fail_after=250))
+
+        os.environ['FAKE_STAR_FAIL'] = '1'
+        CalledProcessError = Sequencing.mapping_tools.subprocess.CalledProcessError
+        self.assertRaises(CalledProcessError, map_sharded, reads())
+        self.assertEqual(threading.active_count(), 1)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMappers)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,273 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import pysam
+from collections import Counter
+import Sequencing.paired_end
+
+def make_pair(i, tid):
+    pair = []
+    for is_read1 in [True, False]:
+        mapping = pysam.AlignedSegment()
+        mapping.query_name = 'pair{0:04d}'.format(i)
+        mapping.query_sequence = 'A' * 20
+        mapping.qual = 'I' * 20
+        mapping.is_paired = True
+        mapping.is_read1 = is_read1
+        mapping.is_read2 = not is_read1
+        if random.random() < 0.1:
+            mapping.is_unmapped = True
+            mapping.reference_id = -1
+            mapping.reference_start = -1
+        else:
+            mapping.reference_id = tid if random.random() < 0.95 else 1 - tid
+            mapping.reference_start = random.randint(0, 2000)
+            mapping.cigar = random.choice([[(0, 20)], [(0, 10), (2, 3), (0, 10)]])
+            mapping.is_reverse = random.random() < 0.5
+            mapping.mapping_quality = random.choice([0, 42, 50])
+            mapping.template_length = random.randint(-500, 500)
+        pair.append(mapping)
+
+    # Some pairs have R2 first.
+    if random.random() < 0.2:
+        pair.reverse()
+    return pair
+
+class TestFilterMappings(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam_fn = os.path.join(self.temp_dir, 'by_name.bam')
+        random.seed(0)
+        header = {'SQ': [{'SN': 'chr1', 'LN': 10000}, {'SN': 'chr2', 'LN': 10000}]}
+        with pysam.AlignmentFile(self.bam_fn, 'wb', header=header) as bam_file:
+            for i in range(1000):
+                for mapping in make_pair(i, random.randint(0, 1)):
+                    bam_file.write(mapping)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def expected(self, max_insert_length=1000, minimum_mapq=42):
+        ''' Pair-at-a-time classification with the per-pair predicates. '''
+        unique_names = []
+        counts = Counter()
+        fragment_lengths = Counter()
+        mappings = list(pysam.AlignmentFile(self.bam_fn))
+        for first, second in zip(mappings[::2], mappings[1::2]):
+            R1, R2 = (first, second) if first.is_read1 else (second, first)
+            counts['total'] += 1
+            if R1.is_unmapped or R2.is_unmapped:
+                counts['unmapped'] += 1
+            elif Sequencing.paired_end.is_discordant(R1, R2, max_insert_length):
+                counts['discordant'] += 1
+            elif Sequencing.paired_end.is_disoriented(R1, R2):
+                counts['disoriented'] += 1
+            elif R1.mapq < minimum_mapq or R2.mapq < minimum_mapq:
+                counts['nonunique'] += 1
+            else:
+                unique_names.append(R1.qname)
+                fragment_lengths[abs(R1.tlen)] += 1
+
+        return unique_names, counts, fragment_lengths
+
+    def check(self, pairs, counts_dict):
+        unique_names, counts, fragment_lengths = self.expected()
+        self.assertEqual([R1.qname for R1, R2 in pairs], unique_names)
+        self.assertTrue(all(R1.is_read1 and R2.is_read2 for R1, R2 in pairs))
+        for key in counts:
+            self.assertEqual(counts_dict[key], counts[key])
+        self.assertEqual(counts_dict['fragment_lengths'], fragment_lengths)
+        self.assertEqual(sum(counts_dict['mapqs'].values()), 2 * counts['total'])
+
+    def test_batched(self):
+        ''' Tests that classifying in small batches matches classifying pair
+            by pair.
+        '''
+        counts_dict = {}
+        mappings = pysam.AlignmentFile(self.bam_fn)
+        pairs = list(Sequencing.paired_end.filter_mappings(mappings,
+                                                           counts_dict=counts_dict,
+                                                           pairs_per_batch=77,
+                                                          ))
+        self.check(pairs, counts_dict)
+
+    def test_name_sorted_bam(self):
+        ''' Tests that classifying chunks in worker processes and merging
+            their counts matches classifying pair by pair.
+        '''
+        for num_processes in [1, 2]:
+            counts_dict = {}
+            pairs = list(Sequencing.paired_end.filter_name_sorted_bam(self.bam_fn,
+                                                                      counts_dict=counts_dict,
+                                                                      num_processes=num_processes,
+                                                                      pairs_per_chunk=90,
+                                                                     ))
+            self.check(pairs, counts_dict)
+
+        # A malformed group in a worker's chunk is raised after the pairs
+        # before it.
+        mappings = list(pysam.AlignmentFile(self.bam_fn))
+        malformed_fn = os.path.join(self.temp_dir, 'malformed.bam')
+        with pysam.AlignmentFile(malformed_fn, 'wb', template=pysam.AlignmentFile(self.bam_fn)) as malformed_file:
+            for i, mapping in enumerate(mappings):
+                if i != 1001:
+                    malformed_file.write(mapping)
+        filtered = Sequencing.paired_end.filter_name_sorted_bam(malformed_fn,
+                                                                minimum_mapq=0,
+                                                                max_insert_length=10**6,
+                                                                num_processes=2,
+                                                                pairs_per_chunk=90,
+                                                               )
+        yielded = []
+        with self.assertRaises(ValueError):
+            for R1, R2 in filtered:
+                yielded.append(R1.qname)
+        self.assertTrue(all(name < 'pair0500' for name in yielded))
+        self.assertTrue(any(name > 'pair0450' for name in yielded))
+
+    def test_malformed(self):
+        ''' Tests that pairs before a malformed group are still yielded. '''
+        mappings = list(pysam.AlignmentFile(self.bam_fn))
+        del mappings[11]
+        filtered = Sequencing.paired_end.filter_mappings(iter(mappings), minimum_mapq=0, max_insert_length=10**6)
+        yielded = []
+        with self.assertRaises(ValueError):
+            for R1, R2 in filtered:
+                yielded.append(R1.qname)
+        self.assertTrue(all(name < 'pair0005' for name in yielded))
+
+    def test_pair_mates(self):
+        ''' Tests that pairing mates from a coordinate-sorted BAM, in
+            memory or through spilled partitions, finds every pair.
+        '''
+        sorted_fn = os.path.join(self.temp_dir, 'by_coordinate.bam')
+        pysam.sort('-o', sorted_fn, self.bam_fn)
+
+        expected = [('pair{0:04d}'.format(i), True, True) for i in range(1000)]
+        for max_pending in [10**6, 50]:
+            pairs = Sequencing.paired_end.pair_mates(sorted_fn,
+                                                     max_pending=max_pending,
+                                                     num_partitions=4,
+                                                     scratch_dir=self.temp_dir,
+                                                    )
+            pairs = [(R1.qname, R1.is_read1, R2.is_read2) for R1, R2 in pairs]
+            self.assertEqual(sorted(pairs), expected)
+
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['by_coordinate.bam', 'by_name.bam'])
+
+    def test_pair_mates_bounded(self):
+        ''' Tests that only the longest-waiting mappings are spilled, so that
+            mates close together still pair in input order, that partitions
+            too big for max_pending are split again, and that nothing is
+            left behind if the caller stops early.
+        '''
+        header = {'SQ': [{'SN': 'chr1', 'LN': 10**6}]}
+        sorted_fn = os.path.join(self.temp_dir, 'by_coordinate.bam')
+        mappings = []
+        for i in range(1000):
+            # Every tenth pair's mates are far apart.
+            mate_offset = 10**5 if i % 10 == 0 else 5
+            for is_read1, start in [(True, i * 10), (False, i * 10 + mate_offset)]:
+                mapping = pysam.AlignedSegment()
+                mapping.query_name = 'pair{0:04d}'.format(i)
+                mapping.query_sequence = 'A' * 20
+                mapping.flag = 1 | (64 if is_read1 else 128)
+                mapping.reference_id = 0
+                mapping.reference_start = start
+                mapping.cigar = [(0, 20)]
+                mappings.append(mapping)
+        mappings.sort(key=lambda m: m.reference_start)
+        with pysam.AlignmentFile(sorted_fn, 'wb', header=header) as bam_file:
+            for mapping in mappings:
+                bam_file.write(mapping)
+
+        scratch_dir = os.path.join(self.temp_dir, 'scratch')
+        os.mkdir(scratch_dir)
+        for max_pending, num_partitions in [(20, 4), (3, 2)]:
+            pairs = Sequencing.paired_end.pair_mates(sorted_fn,
+                                                     max_pending=max_pending,
+                                                     num_partitions=num_partitions,
+                                                     scratch_dir=scratch_dir,
+                                                    )
+            names = [R1.qname for R1, R2 in pairs]
+            close = ['pair{0:04d}'.format(i) for i in range(1000) if i % 10 != 0]
+            self.assertEqual(names[:len(close)], close)
+            self.assertEqual(sorted(names), ['pair{0:04d}'.format(i) for i in range(1000)])
+
+        pairs = Sequencing.paired_end.pair_mates(sorted_fn, max_pending=3, num_partitions=2, scratch_dir=scratch_dir)
+        next(pairs)
+        pairs.close()
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+class TestConcordantPairs(unittest.TestCase):
+    def test_get_concordant_pairs(self):
+        ''' Tests that sweeping over sorted positions finds the same pairs
+            in the same order as checking every combination.
+        '''
+        random.seed(0)
+        for _ in range(20):
+            R1_group = [m for m, _ in (make_pair(0, 0) for _ in range(30))]
+            R2_group = [m for _, m in (make_pair(0, 0) for _ in range(30))]
+            for R2_m in R2_group:
+                if R2_m.is_unmapped:
+                    # Unmapped mates are placed at their mate's position.
+                    R2_m.reference_id = 0
+                    R2_m.reference_start = random.randint(0, 2000)
+            for max_insert_length in [100, 500]:
+                expected = []
+                for R1_m in R1_group:
+                    for R2_m in R2_group:
+                        if (not Sequencing.paired_end.is_discordant(R1_m, R2_m, max_insert_length) and
+                            not Sequencing.paired_end.is_disoriented(R1_m, R2_m)):
+                            expected.append((R1_m, R2_m))
+                expected.sort(key=lambda p: Sequencing.paired_end.get_reference_extent(*p))
+
+                pairs = Sequencing.paired_end.get_concordant_pairs(R1_group, R2_group, max_insert_length)
+                self.assertEqual(pairs, expected)
+
+def make_mate(reference_start, cigarstring, seq, qual, MD, is_read1):
+    mapping = pysam.AlignedSegment()
+    mapping.query_name = 'pair'
+    mapping.query_sequence = seq
+    mapping.qual = qual
+    mapping.reference_id = 0
+    mapping.reference_start = reference_start
+    mapping.cigarstring = cigarstring
+    mapping.mapping_quality = 42
+    mapping.is_paired = True
+    mapping.is_read1 = is_read1
+    mapping.is_read2 = not is_read1
+    mapping.is_reverse = not is_read1
+    mapping.set_tag('MD', MD)
+    return mapping
+
+class TestCombinePairedMappings(unittest.TestCase):
+    def test_overlap_edge_insertions(self):
+        ''' Tests mates whose overlap starts with an insertion in the right
+            mate or ends with one in the left mate, where realigning against
+            the other mate's cigar only covers inserted bases.
+        '''
+        cases = [((6797, '5M3D1M', 'GCGCGG', '%,?(>8', '5^TGG1'),
+                  (6804, '1I3M', 'AGGT', '5>.<', '3'),
+                  ('5M2D0N1I3M', 'GCGCGAGGT', '5^TG3', 'G'),
+                 ),
+                 ((367, '5M1M2I', 'TAATAATC', "?');&$3@", '6'),
+                  (372, '8M', 'AAATCAAG', "'6&I$1$B", '8'),
+                  ('5M1M2I0N7M', 'TAATAATCAATCAAG', '13', 'A'),
+                 ),
+                ]
+        for left, right, (cigarstring, seq, MD, overlap_seq) in cases:
+            combined = Sequencing.paired_end.combine_paired_mappings(make_mate(*left, is_read1=True),
+                                                                     make_mate(*right, is_read1=False),
+                                                                    )
+            self.assertEqual(combined.cigarstring, cigarstring)
+            self.assertEqual(combined.query_sequence, seq)
+            self.assertEqual(combined.get_tag('MD'), MD)
+            self.assertEqual(combined.get_tag('Xs'), overlap_seq)
+
+if __name__ == '__main__':
+    for case in [TestFilterMappings, TestConcordantPairs, TestCombinePairedMappings]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity=2).run(suite)
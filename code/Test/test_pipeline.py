@@ -0,0 +1,78 @@
+import unittest
+import subprocess32 as subprocess
+import Sequencing.pipeline
+
+class TestPipeline(unittest.TestCase):
+    def test_chain(self):
+        ''' Tests piping through several stages, draining heavy stderr
+            without deadlocking, and recording timings.
+        '''
+        commands = [['seq', '1', '200000'],
+                    # Writes far more to stderr than a pipe buffer holds.
+                    ['sh', '-c', 'seq 1 200000 >&2; sort -rn'],
+                    ['head', '-n', '2'],
+                   ]
+        with Sequencing.pipeline.Pipeline(commands, stdout=subprocess.PIPE, max_stderr=100) as pipeline:
+            output = pipeline.stdout.read()
+
+        self.assertEqual(output, '200000\n199999\n')
+        self.assertEqual([timing['name'] for timing in pipeline.timings], ['seq', 'sh', 'head'])
+        self.assertTrue(all(timing['wall'] >= 0 for timing in pipeline.timings))
+        self.assertEqual(pipeline.stderrs[1], ''.join('{0}\n'.format(i) for i in range(1, 200001))[-100:])
+
+    def test_failure(self):
+        ''' Tests that the first stage to fail is raised with its stderr and
+            the rest of the pipeline is stopped.
+        '''
+        commands = [['sleep', '30'],
+                    ['sh', '-c', 'echo broken >&2; exit 3'],
+                   ]
+        pipeline = Sequencing.pipeline.Pipeline(commands, names=['slow', 'broken']).start()
+        with self.assertRaises(Sequencing.pipeline.PipelineError) as context:
+            pipeline.wait()
+
+        self.assertEqual(context.exception.name, 'broken')
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.output, 'broken\n')
+        self.assertTrue(isinstance(context.exception, RuntimeError))
+        self.assertTrue(pipeline.timings[0]['wall'] < 10)
+
+    def test_no_kill_after_reap(self):
+        ''' Tests that stopping the pipeline after a failure never signals a
+            stage that has already been reaped, whose pid may have been reused.
+        '''
+        for _ in range(5):
+            commands = [['true'],
+                        ['sh', '-c', 'sleep 0.1; exit 3'],
+                        ['sleep', '30'],
+                       ]
+            pipeline = Sequencing.pipeline.Pipeline(commands).start()
+            signalled = []
+            for i, (process, _) in enumerate(pipeline.processes):
+                def kill(i=i, kill=process.kill):
+                    signalled.append((i, pipeline.reaped[i]))
+                    kill()
+                process.kill = kill
+
+            self.assertRaises(Sequencing.pipeline.PipelineError, pipeline.wait)
+            pipeline.kill()
+            self.assertIn((2, False), signalled)
+            self.assertEqual([reaped for i, reaped in signalled], [False] * len(signalled))
+            self.assertEqual(pipeline.reaped, [True, True, True])
+
+    def test_failed_start(self):
+        ''' Tests that stages already started are stopped if a later one
+            can't be.
+        '''
+        commands = [['sleep', '30'],
+                    ['no_such_binary_for_pipeline_test'],
+                   ]
+        pipeline = Sequencing.pipeline.Pipeline(commands)
+        self.assertRaises(OSError, pipeline.start)
+        process, _ = pipeline.processes[0]
+        self.assertEqual(process.returncode, -9)
+        self.assertTrue(process.stdout.closed)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPipeline)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,303 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import operator
+import pysam
+from collections import Counter
+import Sequencing.sam
+
+mapped_line = 'read1\t16\tchr1\t101\t42\t5M\t*\t0\t0\tACGTA\tIIIII\tNM:i:1\tMD:Z:2A2\tXA:Z:chr2,+10,5M,0;\n'
+unmapped_line = 'read2\t4\t*\t0\t0\t*\t*\t0\t0\tACGTA\tIIIII\n'
+
+class TestSAMRecord(unittest.TestCase):
+    def test_mandatory_fields(self):
+        ''' Tests that lazily parsed mandatory fields match the SAM line. '''
+        record = Sequencing.sam.SAMRecord(mapped_line)
+        self.assertEqual(record.QNAME, 'read1')
+        self.assertEqual(record.strand, '-')
+        self.assertTrue(record.mapped)
+        self.assertEqual(record.RNAME, 'chr1')
+        self.assertEqual(record.POS, 100)
+        self.assertEqual(record.MAPQ, 42)
+        self.assertEqual(record.CIGAR, '5M')
+        self.assertEqual(record['SEQ'], 'ACGTA')
+
+    def test_tags(self):
+        ''' Tests decoding of single tags and of all tags at once. '''
+        record = Sequencing.sam.SAMRecord(mapped_line)
+        self.assertEqual(record.get_tag('NM'), 1)
+        self.assertEqual(record.get_tag('MD'), '2A2')
+        self.assertEqual(record.get_tag('AS'), None)
+        self.assertFalse(record.has_tag('AS'))
+        XA, = record.get_tag('XA')
+        self.assertEqual((XA['RNAME'], XA['strand'], XA['POS']), ('chr2', '+', 9))
+        self.assertEqual(record.tags['NM'], 1)
+
+    def test_parse_line(self):
+        ''' Tests that parse_line still produces the full dictionary. '''
+        parsed = Sequencing.sam.parse_line(mapped_line)
+        self.assertEqual(parsed['POS'], 100)
+        self.assertEqual(parsed['MD'], '2A2')
+        self.assertEqual(len(parsed['XA']), 1)
+
+    def test_filter_lines_by_flag(self):
+        lines = [mapped_line, unmapped_line]
+        mapped = list(Sequencing.sam.filter_lines_by_flag(lines, excluded=0x4))
+        self.assertEqual(mapped, [mapped_line])
+        reverse = list(Sequencing.sam.filter_lines_by_flag(lines, required=0x10))
+        self.assertEqual(reverse, [mapped_line])
+
+    def test_header(self):
+        ''' Tests the cached header parse and that it is refreshed when the
+            file changes.
+        '''
+        temp_dir = tempfile.mkdtemp()
+        try:
+            sam_fn = os.path.join(temp_dir, 'test.sam')
+            header_lines = ['@SQ\tSN:chr1\tLN:1000\n', '@PG\tID:bwa\tPN:bwa\n']
+            with open(sam_fn, 'w') as sam_file:
+                sam_file.writelines(header_lines + [mapped_line])
+
+            header = Sequencing.sam.get_header(sam_fn)
+            self.assertEqual(header.SQ, [{'SN': 'chr1', 'LN': '1000'}])
+            self.assertEqual(header.PG, [{'ID': 'bwa', 'PN': 'bwa'}])
+            self.assertEqual(Sequencing.sam.get_header_lines(sam_fn), header_lines)
+            self.assertEqual(Sequencing.sam.open_to_reads(sam_fn).read(), mapped_line)
+
+            with open(sam_fn, 'w') as sam_file:
+                sam_file.writelines(header_lines[:1] + [unmapped_line])
+            self.assertEqual(Sequencing.sam.open_to_reads(sam_fn).read(), unmapped_line)
+
+            # A same-sized file with the same mtime moved into place.
+            replacement_fn = os.path.join(temp_dir, 'replacement.sam')
+            with open(replacement_fn, 'w') as sam_file:
+                sam_file.writelines(['@SQ\tSN:chr2\tLN:1000\n', unmapped_line])
+            stat = os.stat(sam_fn)
+            self.assertEqual(os.path.getsize(replacement_fn), stat.st_size)
+            os.utime(replacement_fn, (stat.st_atime, stat.st_mtime))
+            os.rename(replacement_fn, sam_fn)
+            self.assertEqual(Sequencing.sam.get_header(sam_fn).SQ, [{'SN': 'chr2', 'LN': '1000'}])
+        finally:
+            shutil.rmtree(temp_dir)
+
+class TestAlignmentKernels(unittest.TestCase):
+    def test_cigar_to_aligned_pairs(self):
+        cigar = [(0, 2), (1, 1), (2, 1), (3, 2), (0, 1)]
+        expected = [(0, 10), (1, 11), (2, None), (None, 12), ('N', 13), ('N', 14), (3, 15)]
+        self.assertEqual(Sequencing.sam.cigar_to_aligned_pairs(cigar, 10), expected)
+
+        backwards = Sequencing.sam.cigar_to_aligned_pairs_backwards(cigar, 15, 4)
+        expected_backwards = [(read if read != 'N' else None, ref) for read, ref in expected[::-1]]
+        self.assertEqual(backwards, expected_backwards)
+
+        self.assertRaises(ValueError, Sequencing.sam.cigar_to_aligned_pairs, [(4, 2), (0, 3)], 0)
+
+    def test_aligned_pairs_round_trip(self):
+        cigar = [(0, 2), (1, 1), (2, 1), (3, 2), (0, 1)]
+        aligned_pairs = Sequencing.sam.cigar_to_aligned_pairs(cigar, 10)
+        self.assertEqual(Sequencing.sam.aligned_pairs_to_cigar(aligned_pairs), cigar)
+
+    def test_split_cigar_at_ref(self):
+        ''' Tests splitting cigar blocks against splitting aligned pairs. '''
+        cigar = [(1, 1), (0, 2), (1, 1), (2, 1), (3, 2), (7, 1), (8, 1), (1, 2)]
+        aligned_pairs = Sequencing.sam.cigar_to_aligned_pairs(cigar, 10)
+        for boundary in range(8, 20):
+            for insertions_after in [False, True]:
+                has_ref = [i for i, (read, ref) in enumerate(aligned_pairs)
+                           if ref is not None and ref >= boundary]
+                if insertions_after:
+                    before = [i for i, (read, ref) in enumerate(aligned_pairs)
+                              if ref is not None and ref < boundary]
+                    split = before[-1] + 1 if before else 0
+                else:
+                    split = has_ref[0] if has_ref else len(aligned_pairs)
+                first, second = aligned_pairs[:split], aligned_pairs[split:]
+
+                results = Sequencing.sam.split_cigar_at_ref(cigar, 10, boundary, insertions_after)
+                self.assertEqual(results[:2], (Sequencing.sam.aligned_pairs_to_cigar(first),
+                                               Sequencing.sam.aligned_pairs_to_cigar(second),
+                                              ))
+                for pairs, read_nucs, ref_nucs in [(first, results[2], results[3]),
+                                                   (second, results[4], results[5]),
+                                                  ]:
+                    self.assertEqual(read_nucs, sum(1 for read, ref in pairs if read not in [None, 'N']))
+                    self.assertEqual(ref_nucs, sum(1 for read, ref in pairs if ref is not None))
+
+    def test_MD_strings(self):
+        ref_aligned =  'ACGTTA-CA'
+        read_aligned = 'ACCT--GCA'
+        MD_string = Sequencing.sam.alignment_to_MD_string(ref_aligned, read_aligned)
+        self.assertEqual(MD_string, '2G1^TA2')
+        self.assertEqual(Sequencing.sam.md_string_to_ops_string(MD_string), '==G=TA==')
+        self.assertRaises(ValueError, Sequencing.sam.md_string_to_ops_string, '5A')
+
+class TestBufferedAlignmentSorter(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_alignments(self, get_tid, num_alignments=500):
+        random.seed(0)
+        alignments = []
+        for i in range(num_alignments):
+            alignment = pysam.AlignedSegment()
+            alignment.query_name = 'read{0:03d}'.format(random.randint(0, 100))
+            alignment.query_sequence = 'ACGTA'
+            alignment.query_qualities = [30] * 5
+            if random.random() < 0.1:
+                alignment.is_unmapped = True
+                alignment.reference_id = -1
+                alignment.reference_start = -1
+            else:
+                alignment.reference_id = get_tid(random.choice(['chr1', 'chr2']))
+                alignment.reference_start = random.randint(0, 900)
+                alignment.cigar = [(0, 5)]
+            alignment.is_read2 = random.random() < 0.5
+            alignments.append(alignment)
+        return alignments
+
+    def sort(self, by_name, fan_in=64):
+        bam_fn = os.path.join(self.temp_dir, 'sorted.bam')
+        # A tiny budget forces many spilled runs.
+        sorter = Sequencing.sam.BufferedAlignmentSorter(['chr1', 'chr2'],
+                                                       [1000, 1000],
+                                                       bam_fn,
+                                                       by_name=by_name,
+                                                       memory_budget=10000,
+                                                       scratch_dir=self.temp_dir,
+                                                       fan_in=fan_in,
+                                                      )
+        with sorter:
+            alignments = self.make_alignments(sorter.get_tid)
+            for alignment in alignments:
+                sorter.write(alignment)
+
+        return alignments, bam_fn
+
+    def test_by_coordinate(self):
+        alignments, bam_fn = self.sort(by_name=False)
+        key = Sequencing.sam._coordinate_sort_key
+        expected = [a.query_name for a in sorted(alignments, key=key)]
+        bam_file = pysam.AlignmentFile(bam_fn)
+        self.assertEqual([a.query_name for a in bam_file], expected)
+        # Index was built.
+        self.assertEqual(bam_file.count('chr2'), sum(a.reference_id == 1 for a in alignments))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['sorted.bam', 'sorted.bam.bai'])
+
+    def test_bounded_fan_in(self):
+        ''' Tests that merging the runs in several passes keeps ties in
+            their input order and cleans up the intermediate runs.
+        '''
+        alignments, bam_fn = self.sort(by_name=False, fan_in=3)
+        key = Sequencing.sam._coordinate_sort_key
+        expected = [a.query_name for a in sorted(alignments, key=key)]
+        self.assertEqual([a.query_name for a in pysam.AlignmentFile(bam_fn)], expected)
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['sorted.bam', 'sorted.bam.bai'])
+
+    def test_by_name(self):
+        alignments, bam_fn = self.sort(by_name=True)
+        key = Sequencing.sam._name_sort_key
+        expected = [(a.query_name, a.reference_start) for a in sorted(alignments, key=key)]
+        bam_file = pysam.AlignmentFile(bam_fn)
+        self.assertEqual([(a.query_name, a.reference_start) for a in bam_file], expected)
+
+class TestScanBAM(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam_fn = os.path.join(self.temp_dir, 'test.bam')
+        random.seed(0)
+        header = {'SQ': [{'SN': 'chr1', 'LN': 10000}, {'SN': 'chr2', 'LN': 10000}]}
+        with pysam.AlignmentFile(self.bam_fn, 'wb', header=header) as bam_file:
+            for tid in [0, 1, -1]:
+                for i in range(200):
+                    alignment = pysam.AlignedSegment()
+                    alignment.query_name = 'read{0}'.format(i)
+                    alignment.query_sequence = 'A' * random.randint(10, 20)
+                    alignment.query_qualities = [30] * len(alignment.query_sequence)
+                    alignment.reference_id = tid
+                    if tid == -1:
+                        alignment.is_unmapped = True
+                    else:
+                        alignment.reference_start = i * 10
+                        alignment.cigar = [(0, len(alignment.query_sequence))]
+                        alignment.mapping_quality = random.choice([0, 50])
+                        alignment.template_length = random.randint(-300, 300)
+                        alignment.is_secondary = random.random() < 0.2
+                    bam_file.write(alignment)
+        pysam.index(self.bam_fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_scan_bam(self):
+        ''' Tests that one-pass histograms, serial or parallel by reference,
+            match counting each statistic separately.
+        '''
+        alignments = list(pysam.AlignmentFile(self.bam_fn))
+        expected = {'length_primary': Counter(ar.qlen for ar in alignments if not ar.is_unmapped and not ar.is_secondary),
+                    'tlen_unique': Counter(ar.tlen for ar in alignments if ar.mapping_quality == 50),
+                    'mapq': Counter(ar.mapq for ar in alignments),
+                   }
+        for num_processes in [1, 2]:
+            histograms = Sequencing.sam.scan_bam(self.bam_fn, sorted(expected), num_processes)
+            for name in expected:
+                self.assertEqual(histograms[name].to_counter(), expected[name])
+
+        self.assertEqual(Sequencing.sam.get_mapq_counts(self.bam_fn), expected['mapq'])
+
+    def test_histogram_outliers(self):
+        ''' Tests that extreme values are counted without allocating an array
+            that spans them, and that merging keeps every count.
+        '''
+        random.seed(0)
+        batches = [[random.randint(-500, 500) for _ in range(1000)] + [10**8, -10**8, 10**8]
+                   for _ in range(3)]
+        batches.append([-2 * 10**8])
+        histograms = []
+        for batch in batches:
+            histogram = Sequencing.sam.Histogram()
+            histogram.add_values(batch)
+            self.assertLessEqual(len(histogram.counts), histogram.max_dense)
+            histograms.append(histogram)
+
+        merged = Sequencing.sam.Histogram()
+        for histogram in histograms:
+            merged += histogram
+        self.assertLessEqual(len(merged.counts), merged.max_dense)
+        self.assertEqual(merged.to_counter(), Counter(sum(batches, [])))
+
+        lengths = Sequencing.sam.Histogram()
+        lengths.add_values([3, 3, 5, -1])
+        self.assertEqual(list(lengths.to_array()), [0, 0, 0, 2, 0, 1])
+
+    def test_map_regions(self):
+        ''' Tests that small regions, serial or parallel, see every read
+            exactly once even though reads span region boundaries.
+        '''
+        expected = sorted(query_names(pysam.AlignmentFile(self.bam_fn)))
+        for workers in [1, 2]:
+            names = Sequencing.sam.map_regions(self.bam_fn,
+                                               query_names,
+                                               operator.add,
+                                               workers=workers,
+                                               chunk_bp=15,
+                                               include_unplaced=True,
+                                              )
+            self.assertEqual(sorted(names), expected)
+
+        regions = Sequencing.sam.get_regions(self.bam_fn, chunk_bp=5000)
+        self.assertEqual(regions, [('chr1', 0, 5000), ('chr1', 5000, 10000),
+                                   ('chr2', 0, 5000), ('chr2', 5000, 10000),
+                                  ])
+
+def query_names(alignments):
+    return [alignment.query_name for alignment in alignments]
+
+if __name__ == '__main__':
+    for case in [TestSAMRecord, TestAlignmentKernels, TestBufferedAlignmentSorter, TestScanBAM]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,40 @@
+import unittest
+import random
+import Sequencing.sw
+
+def comparable(alignments):
+    ''' Converts the mapping arrays in alignments to lists so that they
+        can be compared with ==.
+    '''
+    return [{key: list(value) if key.endswith('_mappings') else value
+             for key, value in alignment.items()}
+            for alignment in alignments]
+
+class TestGenerateAlignments(unittest.TestCase):
+    def test_threaded(self):
+        ''' Tests that aligning on several threads yields the same alignments,
+            in the same order, as aligning each pair in turn.
+        '''
+        random.seed(0)
+        pairs = []
+        for _ in range(300):
+            target = ''.join(random.choice('TCAG') for _ in range(random.randint(20, 80)))
+            start = random.randrange(len(target))
+            query = list(target[start:start + random.randint(5, 40)])
+            for _ in range(random.randint(0, 3)):
+                query[random.randrange(len(query))] = random.choice('TCAG')
+            pairs.append((''.join(query), target))
+
+        for alignment_type in ['local', 'overlap']:
+            expected = [comparable(Sequencing.sw.generate_alignments(query, target, alignment_type, max_alignments=2))
+                        for query, target in pairs]
+            threaded = Sequencing.sw.generate_alignments_threaded(iter(pairs),
+                                                                  alignment_type,
+                                                                  num_threads=4,
+                                                                  max_alignments=2,
+                                                                 )
+            self.assertEqual([comparable(alignments) for alignments in threaded], expected)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGenerateAlignments)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,44 @@
+import unittest
+from collections import Counter
+import Sequencing.utilities
+
+class TestGroups(unittest.TestCase):
+    def test_stream_groups(self):
+        ''' Tests lazy groups, truncating large groups, and group statistics,
+            including for groups the caller didn't consume.
+        '''
+        items = 'aaabccccccd'
+        stats = {}
+        groups = Sequencing.utilities.stream_groups(items,
+                                                    max_group_size=4,
+                                                    overflow='truncate',
+                                                    stats=stats,
+                                                   )
+        firsts = [(value, next(group)) for value, group in groups]
+        self.assertEqual(firsts, [('a', 'a'), ('b', 'b'), ('c', 'c'), ('d', 'd')])
+        self.assertEqual(stats, {'groups': 4,
+                                 'elements': 11,
+                                 'largest': 6,
+                                 'sizes': Counter({1: 2, 3: 1, 6: 1}),
+                                 'overflowed': 1,
+                                 'dropped': 2,
+                                })
+
+        groups = Sequencing.utilities.group_by(items, max_group_size=4, overflow='truncate')
+        self.assertEqual([''.join(group) for _, group in groups], ['aaa', 'b', 'cccc', 'd'])
+
+        groups = Sequencing.utilities.group_by(items, max_group_size=4)
+        self.assertRaises(ValueError, list, groups)
+
+    def test_prefetch(self):
+        ''' Tests that reading ahead preserves order, even when stopped
+            early.
+        '''
+        self.assertEqual(list(Sequencing.utilities.prefetch(xrange(10000), chunk_size=7)), range(10000))
+        prefetched = Sequencing.utilities.prefetch(xrange(10000), chunk_size=7)
+        self.assertEqual([next(prefetched) for _ in range(10)], range(10))
+        prefetched.close()
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGroups)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -92,6 +92,19 @@ def build_adapter_ranges(index_sequence, primer_type='tru_seq'):
     R2_ranges = make_ranges(R2_construct, R2_names)
     return R1_ranges, R2_ranges
 
+def find_adapters_threaded(adapter, max_distance, seqs, num_threads=1, chunk_size=10000):
+    ''' Returns an array of find_adapter(adapter, max_distance, seq) for every
+        seq in seqs, processing chunks of seqs on num_threads threads.
+    '''
+    find_in_chunk = lambda chunk: find_adapters(adapter, max_distance, chunk)
+    chunks = utilities.chunks(seqs, chunk_size)
+    positions = list(utilities.threaded_map(find_in_chunk, chunks, num_threads))
+    if positions:
+        positions = np.concatenate(positions)
+    else:
+        positions = np.array([], int)
+    return positions
+
 def consistent_paired_position(R1_seq,
                                R2_seq,
                                adapter_in_R1,
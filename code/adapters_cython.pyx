@@ -1,3 +1,57 @@
+import numpy as np
+cimport cython
+from libc.stdlib cimport malloc, free
+
+cdef int _hamming_distance(const char *seq,
+                           const char *adapter,
+                           int seq_length,
+                           int adapter_length,
+                           int start,
+                          ) nogil:
+    cdef int compare_length = min(adapter_length, seq_length - start)
+    cdef int mismatches = 0
+    cdef int i
+
+    for i in range(compare_length):
+        if seq[start + i] != adapter[i]:
+            mismatches += 1
+
+    return mismatches
+
+cdef int _find_adapter(const char *adapter,
+                       int adapter_length,
+                       int max_distance,
+                       const char *seq,
+                       int seq_length,
+                      ) nogil:
+    cdef int distance, start
+    cdef int max_long_prefix_distance = min(max_distance, 1)
+
+    for start in range(seq_length - adapter_length + 1):
+        distance = _hamming_distance(seq,
+                                     adapter,
+                                     seq_length,
+                                     adapter_length,
+                                     start,
+                                    )
+        if distance <= max_distance:
+            return start
+
+    for start in range(seq_length - adapter_length + 1, seq_length):
+        distance = _hamming_distance(seq,
+                                     adapter,
+                                     seq_length,
+                                     adapter_length,
+                                     start,
+                                    )
+        if distance == 0:
+            return start
+        elif seq_length - start >= 10 and distance <= max_long_prefix_distance:
+            return start
+
+    # Convention: position of seq_length means no position was found
+    return seq_length
+
 cpdef int adapter_hamming_distance(char *seq,
                                    char *adapter,
                                    int seq_length,
@@ -7,14 +61,9 @@ cpdef int adapter_hamming_distance(char *seq,
     ''' Returns the hamming distance between the overlap of seq[start:] and
         adapter.
     '''
-    cdef int compare_length = min(adapter_length, seq_length - start)
-    cdef int mismatches = 0
-    cdef int i
-
-    for i in range(compare_length):
-        if seq[start + i] != adapter[i]:
-            mismatches += 1
-
+    cdef int mismatches
+    with nogil:
+        mismatches = _hamming_distance(seq, adapter, seq_length, adapter_length, start)
     return mismatches
 
 cpdef simple_hamming_distance(char *first_seq, char *second_seq):
@@ -30,33 +79,48 @@ def find_adapter(char *adapter, int max_distance, char *seq):
     '''
     cdef int seq_length = len(seq)
     cdef int adapter_length = len(adapter)
-    cdef int distance, start
-    cdef int max_long_prefix_distance = min(max_distance, 1)
-        
-    for start in range(seq_length - adapter_length + 1):
-        distance = adapter_hamming_distance(seq,
-                                            adapter,
-                                            seq_length,
-                                            adapter_length,
-                                            start,
-                                           )
-        if distance <= max_distance:
-            return start
-    
-    for start in range(seq_length - adapter_length + 1, seq_length):
-        distance = adapter_hamming_distance(seq,
-                                            adapter,
-                                            seq_length,
-                                            adapter_length,
-                                            start,
-                                           )
-        if distance == 0:
-            return start
-        elif seq_length - start >= 10 and distance <= max_long_prefix_distance:
-            return start
-    
-    # Convention: position of seq_length means no position was found
-    return seq_length
+    cdef int position
+
+    with nogil:
+        position = _find_adapter(adapter, adapter_length, max_distance, seq, seq_length)
+
+    return position
+
+@cython.boundscheck(False)
+def find_adapters(char *adapter, int max_distance, seqs):
+    ''' Applies find_adapter to every seq in seqs, returning an array of
+        positions. The GIL is only held while collecting pointers to seqs, so
+        calls on different lists of seqs can run in parallel threads.
+    '''
+    # Keep a reference to each seq so the pointers stay valid.
+    seqs = list(seqs)
+
+    cdef int num_seqs = len(seqs)
+    cdef int adapter_length = len(adapter)
+    cdef int i
+    cdef const char **seq_pointers = <const char **> malloc(num_seqs * sizeof(char *))
+    cdef int *seq_lengths = <int *> malloc(num_seqs * sizeof(int))
+    positions = np.zeros(num_seqs, int)
+    cdef long[::1] positions_view = positions
+
+    try:
+        for i in range(num_seqs):
+            seq_pointers[i] = seqs[i]
+            seq_lengths[i] = len(seqs[i])
+
+        with nogil:
+            for i in range(num_seqs):
+                positions_view[i] = _find_adapter(adapter,
+                                                  adapter_length,
+                                                  max_distance,
+                                                  seq_pointers[i],
+                                                  seq_lengths[i],
+                                                 )
+    finally:
+        free(seq_pointers)
+        free(seq_lengths)
+
+    return positions
 
 def find_adapter_positions(read, adapter, int min_comparison_length, int max_distance):
     ''' Temporary for backwards compatibility. '''
@@ -64,7 +128,7 @@ def find_adapter_positions(read, adapter, int min_comparison_length, int max_dis
     cdef int adapter_length = len(adapter)
     cdef int max_start = len(read) - min_comparison_length
     cdef int distance, start
-        
+
     positions = [] 
     for start in range(max_start + 1):
         distance = adapter_hamming_distance(read,
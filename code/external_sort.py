@@ -1,52 +1,276 @@
 import heapq
 import tempfile
 import os
+import gzip
+import zlib
+import multiprocessing
+from itertools import imap
+from functools import partial
 
-def merge(input_files):
+def _decorate(lines, key, run_index):
+    for line in lines:
+        yield key(line), run_index, line
+
+def merge(input_files, key=None):
     ''' Given input_files, all sorted, returns a generator of the merged
-        lines.
+        lines. If key is given, input_files must be sorted by key. Ties are
+        broken in favor of earlier input files.
     '''
-    return heapq.merge(*input_files)
+    if key is None:
+        return heapq.merge(*input_files)
+    else:
+        decorated = [_decorate(input_file, key, i) for i, input_file in enumerate(input_files)]
+        return imap(lambda (k, i, line): line, heapq.merge(*decorated))
 
-def _sort_chunk(chunk, chunk_file_names):
-    ''' Sorts the lines in chunk, writes the sorted lines to a temporary
-        file, and appends the temporary file name to chunk_file_names.
+def _gzip_lines(file_name, block_size=2**20):
+    ''' Yields the lines of a gzip'ed file, decompressing block_size bytes
+        at a time. Much faster than iterating over a gzip.GzipFile.
     '''
-    chunk.sort()
-    
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as chunk_file:
-        chunk_file_names.append(chunk_file.name)
-        for line in chunk:
-            chunk_file.write(line)
-
-def external_sort(input_file, sorted_file, chunk_size=3e6):
-    ''' Writes the lines in file_handle in sorted order to sorted_file.
-        Never loads more than chunk_size lines into memory at the same time.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    remainder = ''
+    with open(file_name, 'rb') as compressed_file:
+        while True:
+            data = compressed_file.read(block_size)
+            if not data:
+                break
+            lines = (remainder + decompressor.decompress(data)).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+    remainder += decompressor.flush()
+    if remainder:
+        yield remainder
+
+def _open_spill(file_name, buffer_size=2**20):
+    if file_name.endswith('.gz'):
+        return _gzip_lines(file_name, buffer_size)
+    else:
+        return open(file_name, 'r', buffer_size)
+
+def _spill_file(scratch_dir, compress):
+    ''' Returns an open temporary file in scratch_dir to spill lines to. '''
+    suffix = '.gz' if compress else ''
+    return tempfile.NamedTemporaryFile(dir=scratch_dir, suffix=suffix, delete=False)
+
+def _sort_chunk(chunk, key=None, scratch_dir=None, compress=False, lines_per_write=10000):
+    ''' Sorts the lines in chunk, writes the sorted lines to a temporary
+        file in scratch_dir, and returns the temporary file's name.
     '''
-    chunk_file_names = []
-    
+    chunk.sort(key=key)
+
+    with _spill_file(scratch_dir, compress) as chunk_file:
+        chunk_file_name = chunk_file.name
+        try:
+            if compress:
+                chunk_file = gzip.GzipFile(fileobj=chunk_file, mode='wb', compresslevel=1)
+
+            # Joining lines before writing avoids per-line compressor overhead.
+            for start in xrange(0, len(chunk), lines_per_write):
+                chunk_file.write(''.join(chunk[start:start + lines_per_write]))
+
+            if compress:
+                chunk_file.close()
+        except:
+            os.remove(chunk_file_name)
+            raise
+
+    return chunk_file_name
+
+def _remove_existing(file_names):
+    for file_name in file_names:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+def _chunks(lines, chunk_size, chunk_bytes):
     chunk = []
-    for line in input_file:
+    num_bytes = 0
+    for line in lines:
         chunk.append(line)
+        num_bytes += len(line)
 
-        if len(chunk) == chunk_size:
-            # When memory is "full", sort and dump to a file.
-            _sort_chunk(chunk, chunk_file_names)
+        if len(chunk) == chunk_size or (chunk_bytes is not None and num_bytes >= chunk_bytes):
+            # When memory is "full", hand off the chunk to be sorted.
+            yield chunk
             chunk = []
-    
-    # Sort and dump the last partial fill-up of memory.
+            num_bytes = 0
+
+    # The last partial fill-up of memory.
     if len(chunk) > 0:
-        _sort_chunk(chunk, chunk_file_names)
+        yield chunk
+
+def _open_inputs(open_input, file_names):
+    ''' Opens each of file_names with open_input. If one fails, those already
+        opened are closed.
+    '''
+    input_files = []
+    try:
+        for file_name in file_names:
+            input_files.append(open_input(file_name))
+    except:
+        for input_file in input_files:
+            input_file.close()
+        raise
+    return input_files
+
+def _merge_to_file(input_files, output_file, key, compress):
+    try:
+        if compress:
+            output_file = gzip.GzipFile(fileobj=output_file, mode='wb', compresslevel=1)
+        output_file.writelines(merge(input_files, key=key))
+        if compress:
+            output_file.close()
+    finally:
+        for input_file in input_files:
+            input_file.close()
+
+def merge_files(input_file_names,
+                output_file,
+                key=None,
+                fan_in=64,
+                buffer_size=2**20,
+                scratch_dir=None,
+                compress=False,
+                open_input=None,
+                report=None,
+                _remove_inputs=False,
+               ):
+    ''' Merges the sorted lines in input_file_names into output_file, never
+        having more than fan_in files open for reading at once. If there are
+        more inputs than that, consecutive groups of fan_in are merged into
+        intermediate runs in scratch_dir (gzip'ed if compress) in as many
+        passes as needed. Each file is read with buffer_size bytes of
+        buffering. open_input, if given, is used to open input_file_names
+        (e.g. sam.open_to_reads to skip headers). If report is given, it is
+        called at the end with a dictionary of 'runs', 'passes' and
+        'bytes_spilled'.
+    '''
+    if fan_in < 2:
+        raise ValueError('fan_in must be at least 2', fan_in)
+
+    if open_input is None:
+        open_input = partial(_open_spill, buffer_size=buffer_size)
+
+    stats = {'runs': len(input_file_names),
+             'passes': 1,
+             'bytes_spilled': 0,
+            }
+
+    run_names = list(input_file_names)
+    remove_runs = _remove_inputs
+    # Every intermediate run, so that none are left behind if merging fails.
+    intermediate_names = []
+    try:
+        while len(run_names) > fan_in:
+            merged_run_names = []
+            for start in range(0, len(run_names), fan_in):
+                group = run_names[start:start + fan_in]
+                with _spill_file(scratch_dir, compress) as merged_file:
+                    merged_run_names.append(merged_file.name)
+                    intermediate_names.append(merged_file.name)
+                    input_files = _open_inputs(open_input, group)
+                    _merge_to_file(input_files, merged_file, key, compress)
+
+                stats['bytes_spilled'] += os.path.getsize(merged_run_names[-1])
+                if remove_runs:
+                    for fn in group:
+                        os.remove(fn)
+
+            run_names = merged_run_names
+            stats['passes'] += 1
+            # Only the original inputs need the caller's opener.
+            open_input = partial(_open_spill, buffer_size=buffer_size)
+            remove_runs = True
+
+        input_files = _open_inputs(open_input, run_names)
+        _merge_to_file(input_files, output_file, key, False)
+
+        if remove_runs:
+            for fn in run_names:
+                os.remove(fn)
+    finally:
+        _remove_existing(intermediate_names)
+
+    if report is not None:
+        report(stats)
+
+def external_sort(input_file,
+                  sorted_file,
+                  chunk_size=3e6,
+                  memory_budget=None,
+                  key=None,
+                  scratch_dir=None,
+                  compress=False,
+                  num_processes=1,
+                  fan_in=64,
+                  buffer_size=2**20,
+                  report=None,
+                 ):
+    ''' Writes the lines in input_file in sorted order to sorted_file.
+        Never loads more than chunk_size lines into memory at the same time.
+        If memory_budget is given, also never holds more than roughly
+        memory_budget bytes of lines across all chunks being sorted at once.
+        Chunks are sorted by num_processes worker processes and spilled to
+        scratch_dir (gzip'ed at a fast level if compress), then merged with
+        merge_files using fan_in, buffer_size and report.
+        key, if given, must be picklable when num_processes > 1.
+    '''
+    if memory_budget is not None:
+        # One chunk being filled plus one in each worker.
+        chunk_bytes = memory_budget // (num_processes + 1)
+    else:
+        chunk_bytes = None
+
+    chunks = _chunks(input_file, chunk_size, chunk_bytes)
+    sort_kwargs = dict(key=key, scratch_dir=scratch_dir, compress=compress)
+
+    # Spilled chunks are removed as they are merged, and whatever is left is
+    # removed if sorting or merging fails.
+    chunk_file_names = []
+    try:
+        if num_processes > 1:
+            pool = multiprocessing.Pool(num_processes)
+            results = []
+            try:
+                for chunk in chunks:
+                    # Wait on the oldest outstanding chunk before filling another
+                    # so that at most num_processes chunks are in flight.
+                    in_flight = [r for r in results if not r.ready()]
+                    if len(in_flight) >= num_processes:
+                        in_flight[0].wait()
+                    results.append(pool.apply_async(_sort_chunk, (chunk,), sort_kwargs))
+                    del chunk
+            finally:
+                pool.close()
+                pool.join()
+                chunk_file_names.extend(r.get() for r in results if r.successful())
+
+            # Raises the first chunk's failure, if any.
+            for r in results:
+                r.get()
+        else:
+            for chunk in chunks:
+                chunk_file_names.append(_sort_chunk(chunk, **sort_kwargs))
 
-    chunk_files = [open(fn) for fn in chunk_file_names]
-    for line in merge(chunk_files):
-        sorted_file.write(line)
+        bytes_spilled = sum(os.path.getsize(fn) for fn in chunk_file_names)
 
-    for chunk_file in chunk_files:
-        chunk_file.close()
+        def report_with_chunks(stats):
+            stats['bytes_spilled'] += bytes_spilled
+            if report is not None:
+                report(stats)
 
-    for chunk_file_name in chunk_file_names:
-        os.remove(chunk_file_name)
+        merge_files(chunk_file_names,
+                    sorted_file,
+                    key=key,
+                    fan_in=fan_in,
+                    buffer_size=buffer_size,
+                    scratch_dir=scratch_dir,
+                    compress=compress,
+                    report=report_with_chunks,
+                    _remove_inputs=True,
+                   )
+    finally:
+        _remove_existing(chunk_file_names)
 
 def sort_simple(file_handle, sorted_file_name):
     ''' Writes the lines in file_handle in sorted order to sorted_file_name.
@@ -1,6 +1,7 @@
+import gzip
+import string
 from itertools import izip
 from collections import namedtuple
-import Bio.SeqIO
 
 Read = namedtuple('Read', ['name', 'seq'])
 make_record = '>{0}\n{1}\n'.format
@@ -8,8 +9,56 @@ def Read_to_record(self):
     return make_record(*self)
 Read.__str__ = Read_to_record
 
+def _record_to_Read(text):
+    header, _, body = text.partition('\n')
+    fields = header[1:].split(None, 1)
+    name = fields[0] if fields else ''
+    seq = body.translate(None, string.whitespace)
+    return Read(name, seq)
+
+def records(file_name, buffer_size=2**22):
+    ''' Yields the name (up to the first whitespace) and sequence, as is, of
+        each record in a fasta file (gzipped if the name ends in .gz), reading
+        buffer_size bytes at a time. Anything before the first > is skipped.
+    '''
+    if file_name.endswith('.gz'):
+        fasta_file = gzip.open(file_name)
+    else:
+        fasta_file = open(file_name, 'rb')
+
+    with fasta_file:
+        # Chunks of the record being read, joined once it is complete.
+        pending = []
+        started = False
+        for buffer in iter(lambda: fasta_file.read(buffer_size), ''):
+            if not started:
+                pending.append(buffer)
+                text = ''.join(pending)
+                if text.startswith('>'):
+                    buffer = text
+                elif '\n>' in text:
+                    buffer = text[text.index('\n>') + 1:]
+                else:
+                    # Keep the last character in case it is a \n.
+                    pending = [text[-1:]]
+                    continue
+                pending = []
+                started = True
+            elif buffer.startswith('>') and pending[-1].endswith('\n'):
+                # A record boundary split across buffers.
+                yield _record_to_Read(''.join(pending))
+                pending = []
+
+            pieces = buffer.split('\n>')
+            pending.append(pieces[0])
+            for piece in pieces[1:]:
+                yield _record_to_Read(''.join(pending))
+                pending = ['>', piece]
+
+        if started:
+            yield _record_to_Read(''.join(pending))
+
 def reads(file_name):
-    ''' Yields the name and sequence lines from a fasta file. '''
-    for record in Bio.SeqIO.parse(file_name, 'fasta'):
-        read = Read(record.name, str(record.seq).upper())
-        yield read
+    ''' Yields the name and upper-cased sequence from a fasta file. '''
+    for name, seq in records(file_name):
+        yield Read(name, seq.upper())
@@ -3,7 +3,7 @@
 from itertools import izip, chain
 from collections import namedtuple
 from .fastq_cython import *
-from .utilities import identity, base_order, reverse_complement, group_by
+from .utilities import identity, base_order, reverse_complement, group_by, chunks, threaded_map
 import numpy as np
 import string
 import gzip
@@ -55,15 +55,30 @@ def sanitize_qual(qual):
     sanitized = qual.translate(_sanitize_table)
     return sanitized
 
-def quality_and_complexity(reads, max_read_length):
+def _quality_and_complexity_chunk(reads, max_read_length):
+    q_array = np.zeros((max_read_length, MAX_EXPECTED_QUAL + 1), int)
+    c_array = np.zeros((max_read_length, 256), int)
+    average_q_distribution = np.zeros(MAX_EXPECTED_QUAL + 1, int)
+    process_reads(reads, q_array, c_array, average_q_distribution)
+    return q_array, c_array, average_q_distribution
+
+def quality_and_complexity(reads, max_read_length, num_threads=1, chunk_size=10000):
+    ''' If num_threads > 1, chunks of chunk_size reads are processed in
+        parallel on a thread pool.
+    '''
     q_array = np.zeros((max_read_length, MAX_EXPECTED_QUAL + 1), int)
     c_array = np.zeros((max_read_length, 256), int)
 
     average_q_distribution = np.zeros(MAX_EXPECTED_QUAL + 1, int)
     
-    for read in reads:
-        average_q = process_read(read.seq, read.qual, q_array, c_array)
-        average_q_distribution[int(average_q)] += 1
+    process_chunk = lambda chunk: _quality_and_complexity_chunk(chunk, max_read_length)
+    for chunk_q, chunk_c, chunk_average_q in threaded_map(process_chunk,
+                                                          chunks(reads, chunk_size),
+                                                          num_threads,
+                                                         ):
+        q_array += chunk_q
+        c_array += chunk_c
+        average_q_distribution += chunk_average_q
         
     # To avoid a lookup at every single base, c_array is 2*max_read_length x 256.
     # This pulls out only the columns corresponding to possible base
@@ -207,7 +222,12 @@ def read_pairs(R1_file_name, R2_file_name, **kwargs):
 
 def read_pairs_interleaved(lines, **kwargs):
     interleaved_reads = reads(lines, **kwargs)
-    grouped = group_by(interleaved_reads, key=lambda r: get_pair_name(r.name))
+    # A pair never has more than 2 reads, so there is no need to hold all of
+    # a malformed group before complaining about it.
+    grouped = group_by(interleaved_reads,
+                       key=lambda r: get_pair_name(r.name),
+                       max_group_size=2,
+                      )
     for pair_name, group in grouped:
         if len(group) != 2:
             raise ValueError(group)
@@ -1,32 +1,121 @@
 import numpy as np
 cimport cython
+from libc.stdlib cimport malloc, free
 
 cdef int SANGER_OFFSET_typed = 33
 SANGER_OFFSET = SANGER_OFFSET_typed
 
 @cython.boundscheck(False)
-def process_read(char* seq, char* qual, long[:, ::1] q_array, long[:, ::1] c_array):
-    cdef unsigned int i, q, b, seq_length
+cdef float _process_read(const char* seq,
+                         const char* qual,
+                         unsigned int seq_length,
+                         long[:, ::1] q_array,
+                         long[:, ::1] c_array,
+                         long num_average_qs,
+                        ) nogil:
+    ''' Returns -1 if the read is longer than q_array, has a quality outside
+        of it, or has an average quality of num_average_qs or more, since
+        bounds aren't checked on the arrays. Nothing is counted in that case.
+    '''
+    cdef unsigned int i, q, b
     cdef float average_q = 0
 
-    seq_length = len(seq)
+    if seq_length > q_array.shape[0] or seq_length > c_array.shape[0]:
+        return -1
+
+    # Check the whole read first so a bad one leaves no partial counts.
     for i in range(seq_length):
         # Automatic type conversion means ord() is unneccesary
         q = qual[i] - SANGER_OFFSET_typed
-        q_array[i, q] += 1
+        if q >= q_array.shape[1]:
+            return -1
         average_q += q
-        
-        b = seq[i]
-        c_array[i, b] += 1
 
     if seq_length != 0:
         average_q /= seq_length
 
+    if average_q >= num_average_qs:
+        return -1
+
+    for i in range(seq_length):
+        q = qual[i] - SANGER_OFFSET_typed
+        q_array[i, q] += 1
+
+        b = <unsigned char> seq[i]
+        c_array[i, b] += 1
+
+    return average_q
+
+@cython.boundscheck(False)
+def process_read(char* seq, char* qual, long[:, ::1] q_array, long[:, ::1] c_array):
+    cdef unsigned int seq_length = len(seq)
+    cdef float average_q
+
+    with nogil:
+        average_q = _process_read(seq, qual, seq_length, q_array, c_array, q_array.shape[1])
+
+    if average_q < 0:
+        raise IndexError('read length or quality out of range', seq, qual)
+
     return average_q
 
+@cython.boundscheck(False)
+def process_reads(reads,
+                  long[:, ::1] q_array,
+                  long[:, ::1] c_array,
+                  long[::1] average_q_distribution,
+                 ):
+    ''' Equivalent to calling process_read on every read in reads and
+        accumulating int(average_q) into average_q_distribution, but only holds
+        the GIL while collecting pointers to the reads' seqs and quals.
+    '''
+    # Keep a reference to each read so the pointers stay valid.
+    reads = list(reads)
+
+    cdef unsigned int num_reads = len(reads)
+    cdef unsigned int i
+    cdef float average_q
+    cdef long bad_read = -1
+    cdef const char **seqs = <const char **> malloc(num_reads * sizeof(char *))
+    cdef const char **quals = <const char **> malloc(num_reads * sizeof(char *))
+    cdef unsigned int *lengths = <unsigned int *> malloc(num_reads * sizeof(unsigned int))
+
+    try:
+        for i in range(num_reads):
+            read = reads[i]
+            seq, qual = read.seq, read.qual
+            seqs[i] = seq
+            quals[i] = qual
+            lengths[i] = len(seq)
+
+        with nogil:
+            for i in range(num_reads):
+                average_q = _process_read(seqs[i],
+                                          quals[i],
+                                          lengths[i],
+                                          q_array,
+                                          c_array,
+                                          average_q_distribution.shape[0],
+                                         )
+                if average_q < 0:
+                    bad_read = i
+                    break
+                average_q_distribution[<int> average_q] += 1
+    finally:
+        free(seqs)
+        free(quals)
+        free(lengths)
+
+    if bad_read >= 0:
+        read = reads[bad_read]
+        raise IndexError('read length or quality out of range', read.seq, read.qual)
+
 def RSQCI_length(char *quals, int length):
     cdef int i
-    for i in range(length):
-        if quals[length - 1 - i] - SANGER_OFFSET_typed != 2:
-            return i
-    return length
+    cdef int rsqci_length = length
+    with nogil:
+        for i in range(length):
+            if quals[length - 1 - i] - SANGER_OFFSET_typed != 2:
+                rsqci_length = i
+                break
+    return rsqci_length
@@ -1,8 +1,11 @@
 import pysam
 import glob
 import os
-from collections import namedtuple
-import Bio.SeqIO
+import mmap
+import bisect
+from collections import namedtuple, OrderedDict
+import numpy as np
+import fasta
 
 def get_all_fasta_file_names(genome_dir):
     fasta_file_names = [fn for fn in glob.glob('{0}/*.fa*'.format(genome_dir))
@@ -42,62 +45,403 @@ def get_genome_index(genome_dir):
         entries.update(parse_fai(fai_file_name))
     return entries
 
-def build_base_lookup(genome_dir, sam_file):
-    ''' Returns a memoized function for looking up single bases from reference.
+# 2-bit codes for packed genomes. Anything that isn't ACGT is stored as A and
+# recorded in the runs of Ns.
+_base_to_code = np.zeros(256, np.uint8)
+_is_N = np.ones(256, bool)
+for _code, _base in enumerate('ACGT'):
+    for _b in [_base, _base.lower()]:
+        _base_to_code[ord(_b)] = _code
+        _is_N[ord(_b)] = False
+_code_to_base = np.frombuffer('ACGT', np.uint8)
+_shifts = np.array([6, 4, 2, 0], np.uint8)
+# The 4 base characters packed into each possible byte.
+_byte_to_bases = _code_to_base[(np.arange(256, dtype=np.uint8)[:, np.newaxis] >> _shifts) & 3]
+
+packed_entry = namedtuple('packed_entry', ['length', 'byte_offset', 'first_run', 'last_run'])
+
+def _pack_sequence(seq):
+    ''' Returns the 2-bit packed bytes of seq and its runs of Ns as (start,
+        end) rows.
+    '''
+    chars = np.frombuffer(seq, np.uint8)
+    codes = _base_to_code[chars]
+    padding = -len(codes) % 4
+    if padding:
+        codes = np.concatenate([codes, np.zeros(padding, np.uint8)])
+    quads = codes.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+
+    is_N = np.concatenate([[False], _is_N[chars], [False]])
+    changes = np.flatnonzero(is_N[1:] != is_N[:-1])
+    runs = changes.reshape(-1, 2)
+    return packed.astype(np.uint8), runs
+
+def get_packed_prefix(genome_dir):
+    return '{0}/packed_genome'.format(genome_dir)
+
+def pack_genome(genome_dir, prefix=None):
+    ''' Converts the fastas in genome_dir into a 2-bit packed genome at prefix
+        (by default in genome_dir) if there isn't an up-to-date one already,
+        and returns prefix. Sequences are packed one reference at a time.
+        Soft-masking is not kept, and ambiguity codes other than N are
+        stored as N.
     '''
+    if prefix is None:
+        prefix = get_packed_prefix(genome_dir)
+
+    index_file_name = prefix + '.index'
+    fasta_file_names = get_all_fasta_file_names(genome_dir)
+    if os.path.exists(index_file_name):
+        packed_time = os.path.getmtime(index_file_name)
+        if all(os.path.getmtime(fn) <= packed_time for fn in fasta_file_names):
+            return prefix
+
+    make_fais(genome_dir)
     genome_index = get_genome_index(genome_dir)
-    references = {}
 
-    def base_lookup(tid, position):
-        if tid not in references:
-            seq_name = sam_file.getrname(tid)
+    # Written to temporary names and renamed so that a concurrent reader
+    # never sees a partial genome, with the index last.
+    suffix = '.{0}'.format(os.getpid())
+    entries = []
+    all_runs = []
+    byte_offset = 0
+    num_runs = 0
+    with open(prefix + '.bases' + suffix, 'wb') as bases_file:
+        for seq_name in sorted(genome_index):
             fasta_file_name = genome_index[seq_name].file_name
             with pysam.Fastafile(fasta_file_name) as fasta_file:
-                references[tid] = fasta_file.fetch(reference=seq_name)
+                seq = fasta_file.fetch(seq_name)
+            packed, runs = _pack_sequence(seq)
+            bases_file.write(packed.tostring())
+            entries.append((seq_name, len(seq), byte_offset, num_runs, num_runs + len(runs)))
+            all_runs.append(runs)
+            byte_offset += len(packed)
+            num_runs += len(runs)
+
+    all_runs = np.concatenate(all_runs) if all_runs else np.zeros((0, 2), int)
+    with open(prefix + '.runs' + suffix, 'wb') as runs_file:
+        np.save(runs_file, all_runs.astype(np.int64))
+
+    with open(index_file_name + suffix, 'w') as index_file:
+        for entry in entries:
+            index_file.write('\t'.join(map(str, entry)) + '\n')
+
+    for extension in ['.bases', '.runs', '.index']:
+        os.rename(prefix + extension + suffix, prefix + extension)
+
+    return prefix
+
+class PackedGenome(object):
+    ''' A 2-bit packed genome written by pack_genome, memory-mapped so that
+        every process on a machine shares one copy through the page cache.
+        Sequences come back upper case, as strings or as arrays of uint8
+        base characters.
+    '''
+    def __init__(self, prefix):
+        self.entries = {}
+        for line in open(prefix + '.index'):
+            fields = line.rstrip('\n').split('\t')
+            self.entries[fields[0]] = packed_entry(*map(int, fields[1:]))
+
+        # A plain array over an mmap rather than an np.memmap, since slicing
+        # an np.memmap is several times slower.
+        with open(prefix + '.bases', 'rb') as bases_file:
+            if os.path.getsize(prefix + '.bases') > 0:
+                bases_map = mmap.mmap(bases_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.bases = np.frombuffer(bases_map, np.uint8)
+            else:
+                self.bases = np.zeros(0, np.uint8)
+
+        # Runs of Ns are small enough to hold, and bisecting lists of them
+        # is faster than searching arrays for single regions.
+        self.runs = np.load(prefix + '.runs')
+        self.run_lists = {}
+        for seq_name, entry in self.entries.items():
+            runs = self._runs(entry)
+            self.run_lists[seq_name] = (list(runs[:, 0]), list(runs[:, 1]))
+
+    def _runs(self, entry):
+        return self.runs[entry.first_run:entry.last_run]
+
+    def fetch(self, seq_name, start=0, end=None, as_array=False):
+        ''' Returns the sequence of seq_name from start to end, clipped to the
+            reference like pysam's fetch.
+        '''
+        entry = self.entries[seq_name]
+        if end is None or end > entry.length:
+            end = entry.length
+        start = max(start, 0)
+        if end <= start:
+            region = np.zeros(0, np.uint8)
+        else:
+            first_byte = entry.byte_offset + start // 4
+            last_byte = entry.byte_offset + (end + 3) // 4
+            region = _byte_to_bases[self.bases[first_byte:last_byte]].ravel()
+            region = region[start % 4:start % 4 + (end - start)]
+
+            run_starts, run_ends = self.run_lists[seq_name]
+            i = bisect.bisect_right(run_ends, start)
+            while i < len(run_starts) and run_starts[i] < end:
+                region[max(run_starts[i], start) - start:min(run_ends[i], end) - start] = ord('N')
+                i += 1
 
-        base = references[tid][position]
-        return base
+        if as_array:
+            return region
+        else:
+            return region.tostring()
+
+    def bases_at(self, seq_name, positions, as_array=False):
+        ''' Looks up the bases at an array of positions in seq_name at once. '''
+        entry = self.entries[seq_name]
+        positions = np.asarray(positions, np.int64)
+        if len(positions) and (positions.min() < 0 or positions.max() >= entry.length):
+            raise IndexError('position outside of {0}'.format(seq_name))
+
+        packed = self.bases[entry.byte_offset + (positions >> 2)]
+        codes = (packed >> (6 - 2 * (positions & 3)).astype(np.uint8)) & 3
+        bases = _code_to_base[codes]
+
+        runs = self._runs(entry)
+        run_indices = np.searchsorted(runs[:, 1], positions, side='right')
+        in_range = run_indices < len(runs)
+        in_run = np.zeros(len(positions), bool)
+        in_run[in_range] = runs[run_indices[in_range], 0] <= positions[in_range]
+        bases[in_run] = ord('N')
+
+        if as_array:
+            return bases
+        else:
+            return bases.tostring()
+
+    def base(self, seq_name, position):
+        ''' Looks up one base without the overhead of an array. '''
+        entry = self.entries[seq_name]
+        if not 0 <= position < entry.length:
+            raise IndexError('position outside of {0}'.format(seq_name))
+
+        run_starts, run_ends = self.run_lists[seq_name]
+        i = bisect.bisect_right(run_ends, position)
+        if i < len(run_starts) and run_starts[i] <= position:
+            return 'N'
+
+        byte = self.bases[entry.byte_offset + (position >> 2)]
+        return 'ACGT'[(byte >> (6 - 2 * (position & 3))) & 3]
+
+def load_packed_genome(genome_dir):
+    ''' Returns the PackedGenome for genome_dir, packing it first if needed. '''
+    return PackedGenome(pack_genome(genome_dir))
+
+class LRUCache(object):
+    ''' Holds values up to a total weight of capacity (unbounded if None),
+        evicting the least recently used ones to make room. on_evict is called
+        with each evicted key and value.
+    '''
+    def __init__(self, capacity=None, weigh=None, on_evict=None):
+        self.capacity = capacity
+        self.weigh = weigh if weigh is not None else (lambda value: 1)
+        self.on_evict = on_evict
+        # Ordered from least to most recently used.
+        self.entries = OrderedDict()
+        self.most_recent = None
+        self.weight = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        ''' Returns the value for key, or None, marking it as just used. '''
+        value = self.entries.get(key)
+        if value is not None and key != self.most_recent:
+            # Reordering is relatively slow, so skip it for repeated lookups.
+            del self.entries[key]
+            self.entries[key] = value
+            self.most_recent = key
+        return value
+
+    def _evict_oldest(self):
+        key, value = self.entries.popitem(last=False)
+        if key == self.most_recent:
+            self.most_recent = None
+        self.weight -= self.weigh(value)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def make_room(self, weight):
+        ''' Evicts entries until weight more would fit. '''
+        while self.capacity is not None and self.entries and self.weight + weight > self.capacity:
+            self._evict_oldest()
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.weight -= self.weigh(self.entries.pop(key))
+        self.entries[key] = value
+        self.most_recent = key
+        self.weight += self.weigh(value)
+        while self.capacity is not None and self.weight > self.capacity and len(self.entries) > 1:
+            self._evict_oldest()
+
+    def clear(self):
+        while self.entries:
+            self._evict_oldest()
+
+class ReferenceCache(object):
+    ''' Fetches sequence from the fastas in genome_dir, keeping at most
+        max_open_files of them open. Files are opened as they are first
+        needed and the least recently used one is closed to make room.
+
+        If cache_bytes is None, whole references are kept in memory once they
+        have been fetched from. Otherwise, up to cache_bytes of sequence is
+        kept in blocks of block_size bases, dropping the least recently used
+        block to make room, so that a miss costs one block rather than a
+        whole reference. If cache_bytes is smaller than a block, nothing is
+        cached.
+
+        If stats (a dictionary) is given, it is kept updated with cache
+        'hits' and 'misses', the number of references or blocks 'evicted',
+        and files 'opened' and 'closed'. The hit rate is hits / (hits +
+        misses).
+    '''
+    def __init__(self, genome_dir, cache_bytes=None, max_open_files=128, stats=None, block_size=2**16):
+        self.genome_index = get_genome_index(genome_dir)
+        self.block_size = block_size
+        self.stats = stats if stats is not None else {}
+        for name in ['hits', 'misses', 'evicted', 'opened', 'closed']:
+            self.stats.setdefault(name, 0)
+
+        def close_file(fasta_file_name, fasta_file):
+            fasta_file.close()
+            self.stats['closed'] += 1
+
+        def count_eviction(key, seq):
+            self.stats['evicted'] += 1
+
+        self.files = LRUCache(max_open_files, on_evict=close_file)
+        self.references = LRUCache(cache_bytes, weigh=len, on_evict=count_eviction)
+
+    def get_file(self, seq_name):
+        fasta_file_name = self.genome_index[seq_name].file_name
+        fasta_file = self.files.get(fasta_file_name)
+        if fasta_file is None:
+            fasta_file = pysam.Fastafile(fasta_file_name)
+            self.stats['opened'] += 1
+            self.files.put(fasta_file_name, fasta_file)
+        return fasta_file
+
+    def fetch_uncached(self, seq_name, start, end):
+        return self.get_file(seq_name).fetch(seq_name, start, end)
+
+    def _cached(self, key, load):
+        seq = self.references.get(key)
+        if seq is not None:
+            self.stats['hits'] += 1
+            return seq
+
+        self.stats['misses'] += 1
+        seq = load()
+        self.references.put(key, seq)
+        return seq
+
+    def reference(self, seq_name):
+        ''' Returns the whole sequence of seq_name from the cache, loading it
+            if needed, or None if whole references aren't being cached.
+        '''
+        if self.references.capacity is not None:
+            return None
+        return self._cached(seq_name, lambda: self.get_file(seq_name).fetch(seq_name))
+
+    def _block(self, seq_name, block):
+        def load():
+            # Evict first so that memory use never goes over the budget.
+            self.references.make_room(self.block_size)
+            block_start = block * self.block_size
+            return self.fetch_uncached(seq_name, block_start, block_start + self.block_size)
+        return self._cached((seq_name, block), load)
+
+    def fetch(self, seq_name, start, end):
+        seq = self.reference(seq_name)
+        if seq is not None:
+            return seq[start:end]
+
+        if self.block_size > self.references.capacity:
+            return self.fetch_uncached(seq_name, start, end)
+
+        start = max(start, 0)
+        end = min(end, self.genome_index[seq_name].length)
+        if end <= start:
+            return ''
+
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+        offset = first_block * self.block_size
+        if first_block == last_block:
+            return self._block(seq_name, first_block)[start - offset:end - offset]
+        else:
+            blocks = [self._block(seq_name, block) for block in range(first_block, last_block + 1)]
+            return ''.join(blocks)[start - offset:end - offset]
+
+    def base(self, seq_name, position):
+        seq = self.reference(seq_name)
+        if seq is not None:
+            return seq[position]
+        else:
+            return self.fetch(seq_name, position, position + 1)
+
+    def close(self):
+        self.files.clear()
+
+def build_base_lookup(genome_dir, sam_file, packed=False, cache_bytes=None, max_open_files=128, stats=None, block_size=2**16):
+    ''' Returns a memoized function for looking up single bases from reference.
+        If packed == True, looks bases up in the shared packed genome instead
+        of loading whole references.
+        cache_bytes, max_open_files, stats and block_size are as for
+        ReferenceCache.
+    '''
+    if packed:
+        packed_genome = load_packed_genome(genome_dir)
+        def packed_base_lookup(tid, position):
+            return packed_genome.base(sam_file.getrname(tid), position)
+        return packed_base_lookup
+
+    cache = ReferenceCache(genome_dir, cache_bytes, max_open_files, stats, block_size)
+
+    def base_lookup(tid, position):
+        return cache.base(sam_file.getrname(tid), position)
 
     return base_lookup
 
-def build_region_fetcher(genome_dir, load_references=False, sam_file=None):
+def build_region_fetcher(genome_dir, load_references=False, sam_file=None, packed=False,
+                         cache_bytes=None, max_open_files=128, stats=None, block_size=2**16):
     ''' Returns a function for fetching regions from the genome in genome_dir.
         If load_references == True, loads entire reference sequences into memory
-        the first time they are fetched from.
+        the first time they are fetched from or, if cache_bytes is given, keeps
+        up to cache_bytes of blocks of them (see ReferenceCache for
+        cache_bytes, max_open_files, stats and block_size).
+        If packed == True, fetches from the shared packed genome, upper cased,
+        instead.
         If the returned function is given a negative start or an end that is
         longer than the seq_name's sequence, the region returned will be
         padded with -.
         If sam_file is given, use sam_file.getrname to transform tids into
         RNAMEs.
     '''
-    genome_index = get_genome_index(genome_dir)
-    fasta_files = {fasta_file_name: pysam.Fastafile(fasta_file_name)
-                   for fasta_file_name in get_all_fasta_file_names(genome_dir)}
-    seq_name_to_file = {seq_name: fasta_files[genome_index[seq_name].file_name]
-                        for seq_name in genome_index}
-
     def possibly_transform_tid(seq_name):
         ''' pysam AlignedRead's gives ints. ''' 
         if isinstance(seq_name, int):
             seq_name = sam_file.getrname(seq_name)
         return seq_name
 
-    references = {}
-    def lookup_loaded(seq_name, start, end):
-        if seq_name not in references:
-            references[seq_name] = seq_name_to_file[seq_name].fetch(seq_name)
-
-        region = references[seq_name][start:end]
-        return region
-
-    def lookup_unloaded(seq_name, start, end):
-        region = seq_name_to_file[seq_name].fetch(seq_name, start, end)
-        return region
-
-    if load_references:
-        lookup = lookup_loaded
+    if packed:
+        lookup = load_packed_genome(genome_dir).fetch
     else:
-        lookup = lookup_unloaded
+        cache = ReferenceCache(genome_dir, cache_bytes, max_open_files, stats, block_size)
+        if load_references:
+            lookup = cache.fetch
+        else:
+            lookup = cache.fetch_uncached
 
     def region_fetcher(seq_name, start, end):
         seq_name = possibly_transform_tid(seq_name)
@@ -116,12 +460,86 @@ def build_region_fetcher(genome_dir, load_references=False, sam_file=None):
 
     return region_fetcher
 
+def build_extent_fetcher(genome_dir, sam_file, packed=False, **cache_kwargs):
+    ''' Returns a function that takes a tid, start and end and returns the
+        upper case reference bases from start to end as a uint8 array, for
+        comparing against read bases in bulk (see
+        sam.group_mismatch_positions). Whole references are cached as for
+        build_region_fetcher with load_references=True.
+    '''
+    if packed:
+        packed_genome = load_packed_genome(genome_dir)
+        def packed_extent_fetcher(tid, start, end):
+            return packed_genome.fetch(sam_file.getrname(tid), start, end, as_array=True)
+        return packed_extent_fetcher
+
+    cache = ReferenceCache(genome_dir, **cache_kwargs)
+
+    def extent_fetcher(tid, start, end):
+        region = cache.fetch(sam_file.getrname(tid), start, end)
+        return np.frombuffer(region.upper(), np.uint8)
+
+    return extent_fetcher
+
+def _header_names(text):
+    ''' Returns the name (up to the first whitespace) in each header line of
+        text, like fasta.records.
+    '''
+    names = []
+    for line in text.split('\n'):
+        if line.startswith('>'):
+            fields = line[1:].split(None, 1)
+            names.append(fields[0] if fields else '')
+    return names
+
+def _read_fai_entries(fasta_file_name, entries):
+    ''' Reads the sequences described by fai entries straight from their
+        byte ranges in fasta_file_name. samtools leaves empty records out of
+        fais, so these are recovered from the headers between the ranges.
+        Returns None if those headers don't match the fai.
+    '''
+    seqs = {}
+    with open(fasta_file_name, 'rb') as fasta_file:
+        end_of_previous = 0
+        for seq_name, entry in sorted(entries.items(), key=lambda (n, e): e.offset):
+            fasta_file.seek(end_of_previous)
+            names = _header_names(fasta_file.read(entry.offset - end_of_previous))
+            # The last header before a range is its own; any others head
+            # empty records.
+            if names[-1:] != [seq_name]:
+                return None
+            for name in names[:-1]:
+                seqs[name] = ''
+
+            full_lines, remainder = divmod(entry.length, entry.bases_per_line)
+            num_bytes = full_lines * entry.bytes_per_line + remainder
+            seqs[seq_name] = fasta_file.read(num_bytes).translate(None, '\r\n')
+            end_of_previous = entry.offset + num_bytes
+
+        fasta_file.seek(end_of_previous)
+        for name in _header_names(fasta_file.read()):
+            seqs[name] = ''
+
+    return seqs
+
 def load_entire_genome(genome_dir):
+    ''' Returns a dictionary of every sequence in genome_dir. Sequences of
+        fastas with an up-to-date fai are read from the byte ranges it gives,
+        and the rest are parsed.
+    '''
     seqs = {}
     fasta_file_names = get_all_fasta_file_names(genome_dir)
     for fasta_file_name in fasta_file_names:
-        for record in Bio.SeqIO.parse(fasta_file_name, 'fasta'):
-            seqs[record.id] = str(record.seq)
+        fai_file_name = fasta_file_name + '.fai'
+        fasta_seqs = None
+        if (not fasta_file_name.endswith('.gz') and
+            os.path.exists(fai_file_name) and
+            os.path.getmtime(fai_file_name) >= os.path.getmtime(fasta_file_name)):
+            fasta_seqs = _read_fai_entries(fasta_file_name, parse_fai(fai_file_name))
+
+        if fasta_seqs is None:
+            fasta_seqs = dict(fasta.records(fasta_file_name))
+        seqs.update(fasta_seqs)
     return seqs
 
 def max_RNAME_length(genome_index):
@@ -1,11 +1,31 @@
 import os
+import sys
+import errno
+import glob
+import shutil
+import time
+import math
+import hashlib
+from contextlib import contextmanager
 import tempfile
 import logging
+import multiprocessing
 import subprocess32 as subprocess
 import threading
+from concurrent import futures
+from itertools import chain, imap
 import fastq
 import sam
+import utilities
+import pipeline
 import pysam
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# fcntl doesn't export this Linux-specific constant.
+F_SETPIPE_SZ = 1031
 
 def build_bowtie2_index(index_prefix, sequence_file_names):
     bowtie2_build_command = ['bowtie2-build',
@@ -14,8 +34,366 @@ def build_bowtie2_index(index_prefix, sequence_file_names):
                             ]
     subprocess.check_call(bowtie2_build_command)
 
-def map_bwa(file_name, genome, sai_file_name, sam_file_name, error_file_name, threads=1):
-    ''' Map reads in file_name to genome with bwa. '''
+def build_star_index(index_dir, sequence_file_names, num_threads=1):
+    genome_length = sum(os.path.getsize(fn) for fn in sequence_file_names)
+    # STAR's recommendation for small genomes.
+    SA_index_bases = min(14, int(math.log(max(genome_length, 2), 2) / 2 - 1))
+    star_command = ['STAR',
+                    '--runMode', 'genomeGenerate',
+                    '--genomeDir', index_dir,
+                    '--genomeFastaFiles'] + list(sequence_file_names) + [
+                    '--genomeSAindexNbases', str(SA_index_bases),
+                    '--runThreadN', str(num_threads),
+                    '--outFileNamePrefix', '{0}/'.format(index_dir),
+                   ]
+    subprocess.check_call(star_command)
+
+# Where cached indexes are kept if no cache_root is given.
+index_cache_root = os.path.expanduser('~/.cache/Sequencing/indexes')
+
+@contextmanager
+def _locked(lock_file_name, blocking=True):
+    ''' Holds an exclusive flock on lock_file_name. If not blocking and the
+        lock is held elsewhere, yields False instead of waiting.
+    '''
+    with open(lock_file_name, 'a') as lock_file:
+        if fcntl is None:
+            yield True
+            return
+
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except IOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _index_key(sequence_file_names, parameters):
+    hasher = hashlib.sha1()
+    for file_name in sequence_file_names:
+        with open(file_name, 'rb') as sequence_file:
+            for block in iter(lambda: sequence_file.read(2**20), ''):
+                hasher.update(block)
+        hasher.update('\0')
+    hasher.update(repr(parameters))
+    return hasher.hexdigest()
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, fn))
+               for root, _, fns in os.walk(directory)
+               for fn in fns)
+
+def _evict_indexes(cache_root, disk_budget, keep, protect_seconds):
+    ''' Removes the least recently used indexes in cache_root, other than
+        keep and those used in the last protect_seconds, until they take up no
+        more than disk_budget bytes. Builds in progress count toward the
+        budget. Partial builds left by killed processes are removed once older
+        than protect_seconds.
+    '''
+    with _locked(os.path.join(cache_root, 'evict.lock')):
+        entries = []
+        now = time.time()
+        for name in os.listdir(cache_root):
+            index_dir = os.path.join(cache_root, name)
+            if not os.path.isdir(index_dir):
+                continue
+            key, building, _ = name.partition('.building.')
+            last_used = os.path.getmtime(index_dir)
+            if building and now - last_used >= protect_seconds:
+                # Builds hold their key's lock, so if it is free, nothing
+                # will finish this one.
+                with _locked(os.path.join(cache_root, key + '.lock'), blocking=False) as acquired:
+                    if acquired:
+                        logging.info('Removing abandoned build {0}'.format(name))
+                        shutil.rmtree(index_dir)
+                        continue
+            entries.append((last_used, key, building, _directory_size(index_dir)))
+
+        total_size = sum(size for _, _, _, size in entries)
+        for last_used, key, building, size in sorted(entries):
+            if total_size <= disk_budget:
+                break
+            if building or key == keep or now - last_used < protect_seconds:
+                continue
+
+            index_dir = os.path.join(cache_root, key)
+            with _locked(index_dir + '.lock', blocking=False) as acquired:
+                # Skip anything that is being built or looked up right now.
+                if acquired:
+                    logging.info('Evicting index {0} ({1} bytes)'.format(key, size))
+                    shutil.rmtree(index_dir)
+                    total_size -= size
+
+def cached_index(build, sequence_file_names, parameters, cache_root=None, disk_budget=None, protect_seconds=3600):
+    ''' Returns a directory holding the index that build(directory) makes
+        from sequence_file_names, building it only if no index has been cached
+        under cache_root for the same sequence contents and parameters.
+        Concurrent callers wait on a lock file for a single build. If
+        disk_budget (in bytes) is given, least recently used indexes are then
+        evicted to stay under it, sparing any used in the last protect_seconds.
+    '''
+    if cache_root is None:
+        cache_root = index_cache_root
+    if not os.path.isdir(cache_root):
+        try:
+            os.makedirs(cache_root)
+        except OSError:
+            # Another process made it first.
+            pass
+
+    key = _index_key(sequence_file_names, parameters)
+    index_dir = os.path.join(cache_root, key)
+    with _locked(index_dir + '.lock'):
+        if not os.path.isdir(index_dir):
+            building_dir = tempfile.mkdtemp(prefix=key + '.building.', dir=cache_root)
+            try:
+                build(building_dir)
+            except:
+                shutil.rmtree(building_dir)
+                raise
+            # Renaming means a finished index is never seen half-built.
+            os.rename(building_dir, index_dir)
+        else:
+            logging.info('Using cached index {0}'.format(index_dir))
+
+        # The directory's mtime records when it was last used.
+        os.utime(index_dir, None)
+
+    if disk_budget is not None:
+        _evict_indexes(cache_root, disk_budget, key, protect_seconds)
+
+    return index_dir
+
+def cached_bowtie2_index(sequence_file_names, **cache_kwargs):
+    ''' Returns the prefix of a cached bowtie2 index of sequence_file_names
+        (see cached_index for cache_kwargs).
+    '''
+    build = lambda index_dir: build_bowtie2_index('{0}/index'.format(index_dir), sequence_file_names)
+    index_dir = cached_index(build, sequence_file_names, ('bowtie2',), **cache_kwargs)
+    return '{0}/index'.format(index_dir)
+
+def cached_star_index(sequence_file_names, num_threads=1, **cache_kwargs):
+    ''' Returns the directory of a cached STAR index of sequence_file_names
+        (see cached_index for cache_kwargs).
+    '''
+    build = lambda index_dir: build_star_index(index_dir, sequence_file_names, num_threads=num_threads)
+    return cached_index(build, sequence_file_names, ('STAR',), **cache_kwargs)
+
+def _default_registry_dir():
+    # Node-local, so that pieces on different nodes each load their own copy.
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    else:
+        return tempfile.gettempdir()
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+class SharedIndex(object):
+    ''' Keeps one copy of an aligner index in memory per node for as long as
+        any process on the node is using it.
+
+        Users are recorded by pid in a registry file under registry_dir, so
+        entries left by processes that died without releasing are ignored.
+        The first user loads the index and the last one to release it
+        removes it. For STAR this is --genomeLoad LoadAndExit/Remove and
+        mappers should be run with --genomeLoad LoadAndKeep. bowtie2 has no
+        shared memory segment; with --mm every process maps the same index
+        files from the page cache, so loading just reads them through once.
+        mapping_options has the keyword arguments for map_star or
+        map_bowtie2.
+    '''
+    aligners = ['STAR', 'bowtie2']
+
+    def __init__(self, aligner, index, registry_dir=None):
+        if aligner not in self.aligners:
+            raise ValueError('no shared index mode for {0}'.format(aligner))
+        if registry_dir is None:
+            registry_dir = _default_registry_dir()
+
+        self.aligner = aligner
+        self.index = os.path.abspath(index)
+        key = hashlib.sha1('{0}\t{1}'.format(aligner, self.index)).hexdigest()
+        self.registry_file_name = '{0}/Sequencing_shared_index_{1}'.format(registry_dir, key)
+        self.held = 0
+
+    @property
+    def mapping_options(self):
+        if self.aligner == 'STAR':
+            return {'genome_load': 'LoadAndKeep'}
+        else:
+            return {'memory_mapped_IO': True}
+
+    def _read_users(self):
+        if not os.path.exists(self.registry_file_name):
+            return []
+        with open(self.registry_file_name) as registry_file:
+            pids = [int(line) for line in registry_file]
+        return [pid for pid in pids if _process_exists(pid)]
+
+    def _write_users(self, pids):
+        temp_file_name = '{0}.{1}'.format(self.registry_file_name, os.getpid())
+        with open(temp_file_name, 'w') as temp_file:
+            for pid in pids:
+                temp_file.write('{0}\n'.format(pid))
+        os.rename(temp_file_name, self.registry_file_name)
+
+    def _run_star(self, genome_load):
+        scratch_dir = tempfile.mkdtemp(prefix='shared_index_')
+        try:
+            subprocess.check_output(['STAR',
+                                     '--genomeDir', self.index,
+                                     '--genomeLoad', genome_load,
+                                     '--outFileNamePrefix', scratch_dir + '/',
+                                    ],
+                                    stderr=subprocess.STDOUT,
+                                   )
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    def _load(self):
+        if self.aligner == 'STAR':
+            self._run_star('LoadAndExit')
+        else:
+            for file_name in glob.glob(self.index + '.*bt2*'):
+                with open(file_name, 'rb') as index_file:
+                    for _ in iter(lambda: index_file.read(2**24), ''):
+                        pass
+
+    def _remove(self):
+        if self.aligner == 'STAR':
+            self._run_star('Remove')
+
+    def acquire(self):
+        with _locked(self.registry_file_name + '.lock'):
+            pids = self._read_users()
+            if not pids:
+                logging.info('Loading shared {0} index {1}'.format(self.aligner, self.index))
+                self._load()
+            pids.append(os.getpid())
+            self._write_users(pids)
+        self.held += 1
+        return self
+
+    def release(self):
+        if self.held == 0:
+            return
+        with _locked(self.registry_file_name + '.lock'):
+            pids = self._read_users()
+            if os.getpid() in pids:
+                pids.remove(os.getpid())
+            if not pids:
+                logging.info('Removing shared {0} index {1}'.format(self.aligner, self.index))
+                self._remove()
+            self._write_users(pids)
+        self.held -= 1
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.release()
+
+def _error_output(error_file, max_bytes=2**16):
+    ''' Returns the last max_bytes written to error_file, or '' if it can't
+        be read back (e.g. /dev/null).
+    '''
+    try:
+        error_file.flush()
+        with open(error_file.name) as error_fh:
+            error_fh.seek(0, os.SEEK_END)
+            error_fh.seek(max(0, error_fh.tell() - max_bytes))
+            return error_fh.read()
+    except (AttributeError, IOError):
+        return ''
+
+def _command_error(process, command, error_file):
+    return pipeline.PipelineError(os.path.basename(command[0]),
+                                  process.returncode,
+                                  command,
+                                  _error_output(error_file),
+                                 )
+
+def _sort_sam_output(command, error_file, bam_file_name, by_name=False, threads=1, **sorter_kwargs):
+    ''' Runs command and streams the SAM it writes to stdout into a
+        sam.BufferedAlignmentSorter writing bam_file_name, so no SAM text
+        touches the disk. If command fails, raises a PipelineError carrying
+        the end of what it wrote to error_file.
+    '''
+    process = subprocess.Popen(command,
+                               stdout=subprocess.PIPE,
+                               stderr=error_file,
+                              )
+    try:
+        sam_file = pysam.AlignmentFile(process.stdout)
+        sorter = sam.BufferedAlignmentSorter(sam_file.references,
+                                             sam_file.lengths,
+                                             bam_file_name,
+                                             by_name=by_name,
+                                             num_threads=threads,
+                                             **sorter_kwargs)
+        with sorter:
+            for alignment in sam_file:
+                sorter.write(alignment)
+            
+            # Checked inside the with so that a failed run isn't merged.
+            process.wait()
+            if process.returncode != 0:
+                raise _command_error(process, command, error_file)
+    except:
+        exc_info = sys.exc_info()
+        # A command that dies usually leaves pysam with a truncated stream,
+        # and its own error output says more about why.
+        process.stdout.close()
+        try:
+            process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+        if process.returncode > 0 and not isinstance(exc_info[1], subprocess.CalledProcessError):
+            raise _command_error(process, command, error_file)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+def _run_sam_command(command, error_file, sam_file_name=None, bam_file_name=None, **sort_kwargs):
+    if bam_file_name is not None:
+        _sort_sam_output(command, error_file, bam_file_name, **sort_kwargs)
+    else:
+        with open(sam_file_name, 'w') as sam_file:
+            subprocess.check_call(command,
+                                  stdout=sam_file,
+                                  stderr=error_file,
+                                 )
+
+def _launch_bwa_aln(index_location, file_name, sai_file, error_file, threads):
+    bwa_aln_command = ['bwa', 'aln',
+                       '-t', str(threads),
+                       index_location,
+                       file_name,
+                      ]
+    process = subprocess.Popen(bwa_aln_command,
+                               stdout=sai_file,
+                               stderr=error_file,
+                              )
+    return process, bwa_aln_command
+
+def map_bwa(file_name, genome, sai_file_name, sam_file_name, error_file_name, threads=1,
+            bam_file_name=None, by_name=False):
+    ''' Map reads in file_name to genome with bwa. If bam_file_name is given,
+        samse output is sorted straight into it (see _sort_sam_output) instead
+        of being written to sam_file_name.
+    '''
     index_location = '{0}/{1}'.format(bwa_indexes_location, genome)
     with open(sai_file_name, 'w') as sai_file, open(error_file_name, 'w') as error_file:
         bwa_aln_command = ['bwa', 'aln',
@@ -28,17 +406,20 @@ def map_bwa(file_name, genome, sai_file_name, sam_file_name, error_file_name, th
                               stderr=error_file,
                              )
     
-    with open(sam_file_name, 'w') as sam_file, open(error_file_name, 'a') as error_file:
+    with open(error_file_name, 'a') as error_file:
         bwa_samse_command = ['bwa', 'samse',
                              '-n', '100',
                              index_location,
                              sai_file_name,
                              file_name,
                             ]
-        subprocess.check_call(bwa_samse_command,
-                              stdout=sam_file,
-                              stderr=error_file,
-                             )
+        _run_sam_command(bwa_samse_command,
+                         error_file,
+                         sam_file_name=sam_file_name,
+                         bam_file_name=bam_file_name,
+                         by_name=by_name,
+                         threads=threads,
+                        )
     
 def map_paired_bwa(R1_file_name, R2_file_name,
                    genome,
@@ -46,21 +427,42 @@ def map_paired_bwa(R1_file_name, R2_file_name,
                    sam_file_name,
                    error_file_name,
                    threads=1,
+                   bam_file_name=None,
+                   by_name=False,
                   ):
-    ''' Map paired end reads in R1_file_name and R2_file_name to genome with bwa. '''
+    ''' Map paired end reads in R1_file_name and R2_file_name to genome with bwa.
+        R1 and R2 are run through bwa aln at the same time, splitting threads
+        between them. If bam_file_name is given, sampe output is sorted
+        straight into it (see _sort_sam_output) instead of being written to
+        sam_file_name.
+    '''
     index_location = '{0}/{1}'.format(bwa_indexes_location, genome)
-    with open(R1_sai_file_name, 'w') as R1_sai_file, open(error_file_name, 'w') as error_file:
-        bwa_aln_R1_command = ['bwa', 'aln', '-t', str(threads), index_location, R1_file_name]
-        subprocess.check_call(bwa_aln_R1_command,
-                              stdout=R1_sai_file,
-                              stderr=error_file,
-                             )
-    with open(R2_sai_file_name, 'w') as R2_sai_file, open(error_file_name, 'w') as error_file:
-        bwa_aln_R2_command = ['bwa', 'aln', '-t', str(threads), index_location, R2_file_name]
-        subprocess.check_call(bwa_aln_R2_command,
-                              stdout=R2_sai_file,
-                              stderr=error_file,
-                             )
+    R1_threads = max(1, (threads + 1) // 2)
+    R2_threads = max(1, threads // 2)
+
+    with open(R1_sai_file_name, 'w') as R1_sai_file, \
+         open(R2_sai_file_name, 'w') as R2_sai_file, \
+         open(error_file_name, 'w') as error_file:
+
+        alns = [_launch_bwa_aln(index_location, R1_file_name, R1_sai_file, error_file, R1_threads)]
+        try:
+            alns.append(_launch_bwa_aln(index_location, R2_file_name, R2_sai_file, error_file, R2_threads))
+
+            # Polled rather than waited on in turn, so that whichever aln
+            # fails first can stop the other one.
+            while True:
+                finished = [bwa_aln_process.poll() is not None for bwa_aln_process, _ in alns]
+                for bwa_aln_process, bwa_aln_command in alns:
+                    if bwa_aln_process.returncode not in (None, 0):
+                        raise _command_error(bwa_aln_process, bwa_aln_command, error_file)
+                if all(finished):
+                    break
+                time.sleep(0.05)
+        finally:
+            for bwa_aln_process, _ in alns:
+                if bwa_aln_process.poll() is None:
+                    bwa_aln_process.kill()
+                    bwa_aln_process.wait()
 
     bwa_sampe_command = ['bwa', 'sampe',
                          '-n', '100',
@@ -70,11 +472,14 @@ def map_paired_bwa(R1_file_name, R2_file_name,
                          R1_sai_file_name, R2_sai_file_name,
                          R1_file_name, R2_file_name,
                         ]
-    with open(sam_file_name, 'w') as sam_file, open(error_file_name, 'a') as error_file:
-        subprocess.check_call(bwa_sampe_command,
-                              stdout=sam_file,
-                              stderr=error_file,
-                             )
+    with open(error_file_name, 'a') as error_file:
+        _run_sam_command(bwa_sampe_command,
+                         error_file,
+                         sam_file_name=sam_file_name,
+                         bam_file_name=bam_file_name,
+                         by_name=by_name,
+                         threads=threads,
+                        )
 
 class DoNothing(object):
     def __enter__(self):
@@ -122,18 +527,80 @@ class PairedTemporaryFifos(object):
         os.remove(self.R2_file_name)
         os.rmdir(self.temp_dir)
 
-class ThreadFastqWriter(threading.Thread):
-    def __init__(self, reads, file_name):
+def _enlarge_pipe(fd, size=2**20):
+    ''' Tries to grow the kernel buffer of the pipe fd to size bytes, or to
+        the largest size allowed. Only possible on Linux; elsewhere the default
+        buffer is kept.
+    '''
+    if fcntl is None:
+        return
+
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except IOError:
+        try:
+            with open('/proc/sys/fs/pipe-max-size') as max_size_fh:
+                max_size = int(max_size_fh.read())
+            fcntl.fcntl(fd, F_SETPIPE_SZ, min(size, max_size))
+        except (IOError, ValueError):
+            pass
+
+class ThreadPipeWriter(threading.Thread):
+    ''' Writes str() of each record in records to the file descriptor fd,
+        records_per_write at a time, then closes fd. join() re-raises any
+        exception hit while writing.
+    '''
+    def __init__(self, records, fd, records_per_write=10000):
         threading.Thread.__init__(self)
         self.daemon = True
-        self.reads = reads
-        self.file_name = file_name
+        self.records = records
+        self.fd = fd
+        self.records_per_write = records_per_write
+        self.exc_info = None
         self.start()
 
     def run(self):
-        with open(self.file_name, 'w') as fifo_fh:
-            for read in self.reads:
-                fifo_fh.write(str(read))
+        try:
+            with os.fdopen(self.fd, 'w') as pipe_fh:
+                for chunk in utilities.chunks(self.records, self.records_per_write):
+                    pipe_fh.write(''.join(imap(str, chunk)))
+        except:
+            self.exc_info = sys.exc_info()
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_traceback = self.exc_info
+            raise exc_type, exc_value, exc_traceback
+
+class ThreadFastqWriter(ThreadPipeWriter):
+    ''' ThreadPipeWriter of reads into the FIFO file_name. Opening the FIFO
+        blocks until a reader opens it, so if the reader might exit without
+        doing so, call cancel() before join().
+    '''
+    def __init__(self, reads, file_name, reads_per_write=10000):
+        self.file_name = file_name
+        ThreadPipeWriter.__init__(self, reads, None, reads_per_write)
+
+    def run(self):
+        try:
+            self.fd = os.open(self.file_name, os.O_WRONLY)
+        except:
+            self.exc_info = sys.exc_info()
+            return
+        ThreadPipeWriter.run(self)
+
+    def cancel(self):
+        ''' Waits for the thread to finish after the reader has exited,
+            briefly opening the FIFO for reading until it does, so that a
+            pending open() returns and the next write fails with EPIPE.
+        '''
+        while self.is_alive():
+            try:
+                os.close(os.open(self.file_name, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            threading.Thread.join(self, 0.01)
 
 class ThreadPairedFastqWriter(threading.Thread):
     def __init__(self, read_pairs, R1_fn, R2_fn):
@@ -158,7 +625,13 @@ def launch_bowtie2(index_prefix,
                    bam_output,
                    by_name,
                    custom_binary,
+                   stdin=None,
                    **options):
+    ''' If stdin is given, bowtie2 reads from it, and R1_fn should be '-'.
+        If the interleaved option is set, R1_fn holds interleaved pairs.
+    '''
+    interleaved = options.pop('interleaved', False)
+
     kwarg_to_bowtie2_argument = [
         ('aligned_reads_file_name',   ['--al', options.get('aligned_reads_file_name')]),
         ('unaligned_reads_file_name', ['--un', options.get('unaligned_reads_file_name')]),
@@ -210,7 +683,9 @@ def launch_bowtie2(index_prefix,
 
     bowtie2_command.extend(['-x', index_prefix])
 
-    if R2_fn != None:
+    if interleaved:
+        bowtie2_command.extend(['--interleaved', R1_fn])
+    elif R2_fn != None:
         bowtie2_command.extend(['-1', R1_fn])
         bowtie2_command.extend(['-2', R2_fn])
     else:
@@ -219,16 +694,8 @@ def launch_bowtie2(index_prefix,
     error_file = open(error_file_name, 'w')
     if not bam_output:
         bowtie2_command.extend(['-S', output_file_name])
-
-        bowtie2_process = subprocess.Popen(bowtie2_command,
-                                           stderr=error_file,
-                                          )
-        process_to_return = bowtie2_process
+        commands = [bowtie2_command]
     else:
-        bowtie2_process = subprocess.Popen(bowtie2_command,
-                                           stdout=subprocess.PIPE,
-                                           stderr=error_file,
-                                          )
         view_command = ['samtools', 'view', '-ubh', '-']
         sort_command = ['samtools', 'sort',
                         '-T', output_file_name,
@@ -238,18 +705,13 @@ def launch_bowtie2(index_prefix,
             sort_command.append('-n')
 
         sort_command.append('-')
+        commands = [bowtie2_command, view_command, sort_command]
 
-        view_process = subprocess.Popen(view_command,
-                                        stdin=bowtie2_process.stdout,
-                                        stdout=subprocess.PIPE,
-                                       )
-        sort_process = subprocess.Popen(sort_command,
-                                        stdin=view_process.stdout,
-                                        stderr=subprocess.PIPE,
-                                       )
-        bowtie2_process.stdout.close()
-        view_process.stdout.close()
-        process_to_return = sort_process
+    process_to_return = pipeline.Pipeline(commands,
+                                          names=['bowtie2', 'samtools view', 'samtools sort'][:len(commands)],
+                                          stdin=stdin,
+                                          stderr_files={'bowtie2': error_file},
+                                         ).start()
 
     return process_to_return, bowtie2_command
 
@@ -265,17 +727,11 @@ def _map_bowtie2(index_prefix,
                  read_pairs=None,
                  yield_mappings=False,
                  yield_unaligned=False,
+                 binary_mappings=False,
+                 prefetch_mappings=False,
                  **options):
-    using_input_fifos = reads != None or read_pairs != None
     is_paired = R2_fn != None or read_pairs != None
 
-    if reads:
-        input_fifo_source = TemporaryFifo(name='input_fifo.fastq')
-    elif read_pairs:
-        input_fifo_source = PairedTemporaryFifos(name='input')
-    else:
-        input_fifo_source = DoNothing()
-
     if yield_unaligned:
         if is_paired:
             output_fifo_source = PairedTemporaryFifos(name='unaligned')
@@ -286,14 +742,24 @@ def _map_bowtie2(index_prefix,
     else:
         output_fifo_source = DoNothing()
     
-    with input_fifo_source, output_fifo_source:
-        if reads:
-            R1_fn = input_fifo_source.file_name
-            writer = ThreadFastqWriter(reads, R1_fn)
-        elif read_pairs:
-            R1_fn = input_fifo_source.R1_file_name
-            R2_fn = input_fifo_source.R2_file_name
-            writer = ThreadPairedFastqWriter(read_pairs, R1_fn, R2_fn)
+    with output_fifo_source:
+        # Reads are fed to bowtie2 over a pipe on stdin, with pairs
+        # interleaved so that one stream carries both mates.
+        if reads or read_pairs:
+            input_fd, writer_fd = os.pipe()
+            # bowtie2 must not inherit the write end, or it would never see
+            # EOF on its stdin.
+            if fcntl is not None:
+                fcntl.fcntl(writer_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            _enlarge_pipe(writer_fd)
+            R1_fn, R2_fn = '-', None
+            if reads:
+                records = reads
+            else:
+                records = chain.from_iterable(read_pairs)
+                options['interleaved'] = True
+        else:
+            input_fd = None
 
         if yield_unaligned:
             if is_paired:
@@ -315,8 +781,13 @@ def _map_bowtie2(index_prefix,
                                                           bam_output,
                                                           by_name,
                                                           custom_binary,
+                                                          stdin=input_fd,
                                                           **options)
 
+        if input_fd is not None:
+            os.close(input_fd)
+            writer = ThreadPipeWriter(records, writer_fd)
+
         if yield_unaligned:
             if is_paired:
                 for read_pair in fastq.read_pairs(unal_R1_fn, unal_R2_fn):
@@ -325,17 +796,32 @@ def _map_bowtie2(index_prefix,
                 for read in fastq.reads(unal_R1_fn):
                     yield read
         elif yield_mappings:
-            sam_file = pysam.Samfile(output_file_name, 'r')
+            if binary_mappings:
+                # samtools turns the SAM text into uncompressed BAM in its own
+                # process, so pysam only has to decode binary records.
+                view_command = ['samtools', 'view', '-u', output_file_name]
+                view_process = pipeline.Pipeline([view_command], stdout=subprocess.PIPE).start()
+                sam_file = pysam.AlignmentFile(view_process.stdout)
+            else:
+                sam_file = pysam.Samfile(output_file_name, 'r')
             yield sam_file
-            for read in sam_file:
+
+            mappings = iter(sam_file)
+            if prefetch_mappings:
+                mappings = utilities.prefetch(mappings)
+            for read in mappings:
                 yield read
 
-        _, err_output = bowtie2_process.communicate()
-        if bowtie2_process.returncode != 0:
-            raise subprocess.CalledProcessError(bowtie2_process.returncode,
-                                                bowtie2_command,
-                                                err_output,
-                                               )
+            if binary_mappings:
+                view_process.wait()
+
+        # Raises a PipelineError, a CalledProcessError, for the first stage
+        # to fail.
+        bowtie2_process.wait()
+        if input_fd is not None:
+            # Surfaces an error from producing or writing the reads, which
+            # bowtie2 would otherwise see only as an early end of input.
+            writer.join()
         if bam_output:
             sam.index_bam(output_file_name)
 
@@ -351,8 +837,14 @@ def map_bowtie2(index_prefix,
                 read_pairs=None,
                 yield_mappings=False,
                 yield_unaligned=False,
+                binary_mappings=False,
+                prefetch_mappings=False,
                 **options):
-
+    ''' If yield_mappings, returns the header and a generator of mappings. With
+        binary_mappings, bowtie2's output is converted to uncompressed BAM by
+        samtools view before pysam reads it. With prefetch_mappings, mappings
+        are read ahead on a background thread.
+    '''
     if reads and read_pairs:
         raise RuntimeError('Can\'t give unpaired_Reads and paired_Reads')
 
@@ -362,11 +854,6 @@ def map_bowtie2(index_prefix,
     if output_file_name == None and yield_mappings == False:
         raise RuntimeError('Need to give output_file_name or yield_mappings')
     
-    if read_pairs:
-        # Can't used named pipes for paired Reads without custom binary because
-        # of buffer size mismatch.
-        custom_binary = True
-
     generator = _map_bowtie2(index_prefix,
                              R1_fn=R1_fn,
                              R2_fn=R2_fn,
@@ -379,6 +866,8 @@ def map_bowtie2(index_prefix,
                              read_pairs=read_pairs,
                              yield_mappings=yield_mappings,
                              yield_unaligned=yield_unaligned,
+                             binary_mappings=binary_mappings,
+                             prefetch_mappings=prefetch_mappings,
                              **options)
     if yield_unaligned:
         return generator
@@ -471,7 +960,10 @@ def map_tophat_paired(R1_fn,
     if not no_sort:
         sam.index_bam(accepted_hits_fn)
 
-def map_star(R1_fn, index_dir, output_prefix, R2_fn=None, num_threads=1):
+def map_star(R1_fn, index_dir, output_prefix, R2_fn=None, num_threads=1, genome_load=None):
+    ''' genome_load, if given, is passed as STAR's --genomeLoad (e.g.
+        'LoadAndKeep' inside a SharedIndex).
+    '''
     star_command = ['STAR',
                     '--genomeDir', index_dir,
                     '--outSAMtype', 'BAM', 'SortedByCoordinate',
@@ -481,11 +973,186 @@ def map_star(R1_fn, index_dir, output_prefix, R2_fn=None, num_threads=1):
                     '--outFileNamePrefix', output_prefix,
                     '--readFilesIn', R1_fn,
                    ]
+    # R2_fn has to directly follow R1_fn as the second --readFilesIn value.
     if R2_fn is not None:
         star_command.append(R2_fn)
+    if genome_load is not None:
+        star_command.extend(['--genomeLoad', genome_load])
 
     print ' '.join(star_command)
     subprocess.check_output(star_command)
 
     bam_fn = '{0}Aligned.sortedByCoord.out.bam'.format(output_prefix)
     sam.index_bam(bam_fn)
+
+def _available_memory():
+    ''' Bytes of memory available for new processes, or None if unknown. '''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def choose_shard_layout(index_size, num_cpus=None, available_memory=None, shared_index=False, min_threads=2):
+    ''' Returns (num_shards, threads_per_shard) for running aligners with an
+        index of index_size bytes on num_cpus CPUs (default: all of them).
+        Each shard gets at least min_threads threads. Unless shared_index (e.g.
+        bowtie2 --mm), each shard loads its own copy of the index, so no more
+        shards are run than fit in available_memory (default: MemAvailable).
+    '''
+    if num_cpus is None:
+        num_cpus = multiprocessing.cpu_count()
+    if available_memory is None:
+        available_memory = _available_memory()
+
+    num_shards = max(1, num_cpus // min_threads)
+    if not shared_index and available_memory is not None and index_size > 0:
+        num_shards = max(1, min(num_shards, available_memory // index_size))
+
+    threads_per_shard = max(1, num_cpus // num_shards)
+    return num_shards, threads_per_shard
+
+def map_sharded(map_shard,
+                records,
+                output_file_name,
+                num_shards,
+                threads_per_shard,
+                by_name=False,
+                records_per_chunk=10000,
+                scratch_dir=None,
+                timings=None,
+               ):
+    ''' Splits records across num_shards concurrent calls of
+        map_shard(shard_records, shard_bam_file_name, threads_per_shard), each
+        of which must align its records into a sorted BAM, then merges the
+        shard BAMs into output_file_name with sam.merge_sorted_bam_files.
+        Shards pull records_per_chunk records at a time from a shared
+        iterator, so faster shards take more of the input.
+        If timings (a list) is given, a dictionary of 'shard', 'threads',
+        'records' and 'seconds' is appended to it for each shard.
+    '''
+    chunks = utilities.chunks(records, records_per_chunk)
+    chunks_lock = threading.Lock()
+    shard_counts = [0 for _ in range(num_shards)]
+
+    def shard_records(shard):
+        while True:
+            with chunks_lock:
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            shard_counts[shard] += len(chunk)
+            for record in chunk:
+                yield record
+
+    temp_dir = tempfile.mkdtemp(prefix='shards_', dir=scratch_dir)
+    shard_file_names = ['{0}/shard_{1}.bam'.format(temp_dir, shard) for shard in range(num_shards)]
+
+    def run_shard(shard):
+        start_time = time.time()
+        map_shard(shard_records(shard), shard_file_names[shard], threads_per_shard)
+        return {'shard': shard,
+                'threads': threads_per_shard,
+                'records': shard_counts[shard],
+                'seconds': time.time() - start_time,
+               }
+
+    try:
+        # The aligners run in their own processes, so threads are enough to
+        # drive them.
+        with futures.ThreadPoolExecutor(max_workers=num_shards) as executor:
+            shard_timings = list(executor.map(run_shard, range(num_shards)))
+
+        for shard_timing in shard_timings:
+            logging.info('shard {shard}: {records} records in {seconds:0.1f}s with {threads} threads'.format(**shard_timing))
+        if timings is not None:
+            timings.extend(shard_timings)
+
+        sam.merge_sorted_bam_files(shard_file_names, output_file_name, by_name=by_name)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def map_bowtie2_sharded(index_prefix,
+                        output_file_name,
+                        reads=None,
+                        read_pairs=None,
+                        num_shards=None,
+                        threads_per_shard=None,
+                        by_name=False,
+                        records_per_chunk=10000,
+                        scratch_dir=None,
+                        timings=None,
+                        **options):
+    ''' map_bowtie2 of reads or read_pairs into the sorted BAM
+        output_file_name, run as num_shards bowtie2 processes with
+        threads_per_shard threads each (see map_sharded). If not given, the
+        layout is picked by choose_shard_layout from the size of the index.
+    '''
+    if (reads is None) == (read_pairs is None):
+        raise RuntimeError('Need to give exactly one of reads and read_pairs')
+
+    if num_shards is None or threads_per_shard is None:
+        index_size = sum(os.path.getsize(fn) for fn in glob.glob(index_prefix + '*.bt2*'))
+        shared_index = options.get('memory_mapped_IO', False)
+        num_shards, threads_per_shard = choose_shard_layout(index_size, shared_index=shared_index)
+
+    input_name = 'reads' if reads is not None else 'read_pairs'
+
+    def map_shard(shard_records, shard_file_name, threads):
+        shard_options = dict(options)
+        shard_options[input_name] = shard_records
+        shard_options['threads'] = threads
+        if shard_options.get('error_file_name', '/dev/null') != '/dev/null':
+            # Shards would clobber a shared error file.
+            shard_name = os.path.splitext(os.path.basename(shard_file_name))[0]
+            shard_options['error_file_name'] = '{0}.{1}'.format(shard_options['error_file_name'], shard_name)
+        map_bowtie2(index_prefix,
+                    output_file_name=shard_file_name,
+                    bam_output=True,
+                    by_name=by_name,
+                    **shard_options)
+
+    map_sharded(map_shard,
+                reads if reads is not None else read_pairs,
+                output_file_name,
+                num_shards,
+                threads_per_shard,
+                by_name=by_name,
+                records_per_chunk=records_per_chunk,
+                scratch_dir=scratch_dir,
+                timings=timings,
+               )
+
+def map_star_sharded(reads, index_dir, output_file_name, num_shards, threads_per_shard,
+                     records_per_chunk=10000, scratch_dir=None, timings=None):
+    ''' map_star of unpaired reads into the coordinate-sorted BAM
+        output_file_name, run as num_shards STAR processes with
+        threads_per_shard threads each (see map_sharded). Each shard's reads
+        reach STAR through a FIFO.
+    '''
+    def map_shard(shard_records, shard_file_name, threads):
+        output_prefix = shard_file_name[:-len('.bam')] + '_'
+        fifo = TemporaryFifo(name='reads.fastq')
+        with fifo:
+            writer = ThreadFastqWriter(shard_records, fifo.file_name)
+            try:
+                map_star(fifo.file_name, index_dir, output_prefix, num_threads=threads)
+            finally:
+                # Unblocks the writer if STAR exited without reading all of
+                # the FIFO.
+                writer.cancel()
+            writer.join()
+        os.rename('{0}Aligned.sortedByCoord.out.bam'.format(output_prefix), shard_file_name)
+
+    map_sharded(map_shard,
+                reads,
+                output_file_name,
+                num_shards,
+                threads_per_shard,
+                records_per_chunk=records_per_chunk,
+                scratch_dir=scratch_dir,
+                timings=timings,
+               )
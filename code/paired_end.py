@@ -1,7 +1,14 @@
 import numpy as np
 import pysam
 import logging
-from collections import Counter
+from collections import Counter, deque
+from itertools import islice
+import multiprocessing
+import bisect
+import tempfile
+import shutil
+import os
+import hashlib
 import Sequencing.sam as sam
 import Sequencing.utilities as utilities
 import Sequencing.fastq as fastq
@@ -48,6 +55,61 @@ def is_discordant(R1_m, R2_m, max_insert_length):
 
     return discordant
 
+def _mean_qual(qual):
+    # Same values, and therefore the same float result, as
+    # np.mean(fastq.decode_sanger(qual)).
+    return np.mean(np.frombuffer(qual, np.uint8).astype(int) - fastq.SANGER_OFFSET)
+
+def _ref_array(left_mapping, right_mapping):
+    ''' Array equivalent of merging the ref_dicts of left_mapping and
+    right_mapping. Returns (offset, bases), where bases[p - offset] is the
+    reference base at p, or 0 if neither mapping covers p.
+    '''
+    covered = []
+    for mapping in [left_mapping, right_mapping]:
+        ops, ref_positions, _, ref_bases, _, _ = sam.alignment_arrays(mapping)
+        not_inserted = (ops != sam.BAM_CINS)
+        # Unlike ref_dict_from_mapping, no check for repeated positions is
+        # needed since cigar columns that consume the reference always advance.
+        covered.append((ref_positions[not_inserted], ref_bases[not_inserted]))
+
+    all_positions = np.concatenate([positions for positions, _ in covered])
+    offset = all_positions.min() if len(all_positions) > 0 else 0
+    bases = np.zeros(all_positions.max() - offset + 1 if len(all_positions) > 0 else 0, np.uint8)
+
+    for positions, these_bases in covered:
+        existing = bases[positions - offset]
+        if np.any((existing != 0) & (existing != these_bases)):
+            # contradiction
+            raise ValueError(left_mapping, right_mapping)
+        bases[positions - offset] = these_bases
+
+    return offset, bases
+
+def _count_realigned_mismatches(seq, cigar, ref_start, read_start, ref_array):
+    ''' Counts the mismatches between seq and the reference when seq is
+    aligned according to cigar starting at ref_start and read_start.
+    Equivalent to the length of realigned_mismatches' result. A cigar of only
+    insertions has no columns to compare, so ref_start may be None for one, as
+    it is when the overlap starts or ends with an insertion.
+    '''
+    if cigar and all(op == sam.BAM_CINS for op, _ in cigar):
+        return 0
+
+    offset, ref_bases = ref_array
+    ops, read_positions, ref_positions = sam.cigar_to_columns(cigar, ref_start, read_start)
+    aligned = (ops == sam.BAM_CMATCH)
+    read_bases = np.frombuffer(seq, np.uint8)[read_positions[aligned]]
+    ref_indices = ref_positions[aligned] - offset
+
+    missing = (ref_indices < 0) | (ref_indices >= len(ref_bases))
+    if not np.any(missing):
+        missing = (ref_bases[ref_indices] == 0)
+    if np.any(missing):
+        raise KeyError(ref_positions[aligned][missing][0])
+
+    return np.count_nonzero(read_bases != ref_bases[ref_indices])
+
 def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
     ''' Takes two pysam mappings representing opposite ends of a fragment and
     combines them into one mapping, (ab)using BAM_CREF_SKIP to bridge the gap
@@ -63,59 +125,47 @@ def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
     left_md = dict(left_mapping.tags)['MD']
     right_md = dict(right_mapping.tags)['MD']
 
-    right_aligned_pairs = sam.cigar_to_aligned_pairs(right_mapping.cigar, right_mapping.reference_start)
+    # pysam builds a new string on every access to seq or qual.
+    left_seq, left_qual = left_mapping.seq, left_mapping.qual
+    right_seq, right_qual = right_mapping.seq, right_mapping.qual
 
-    right_after_overlap_pair_index = len(right_aligned_pairs)
-    for i, (read, ref) in enumerate(right_aligned_pairs):
-        if ref != None and ref >= left_mapping.aend:
-            right_after_overlap_pair_index = i
-            break
-    
-    right_overlap_pairs = right_aligned_pairs[:right_after_overlap_pair_index]
-    right_after_overlap_pairs = right_aligned_pairs[right_after_overlap_pair_index:]
-    
-    right_reads_after = [read for read, ref in right_after_overlap_pairs if read != None and read != 'N']
-    right_refs_after = [ref for read, ref in right_after_overlap_pairs if ref != None]
-    
-    right_overlap_cigar = sam.aligned_pairs_to_cigar(right_overlap_pairs)
-    right_after_overlap_cigar = sam.aligned_pairs_to_cigar(right_after_overlap_pairs)
-    right_after_overlap_md = sam.truncate_md_string_from_beginning(right_md, len(right_refs_after))
-    
-    right_after_overlap_read_start = len(right_mapping.seq) - len(right_reads_after)
+    left_cigar, right_cigar = left_mapping.cigar, right_mapping.cigar
 
-    right_overlap_seq = right_mapping.seq[:right_after_overlap_read_start] 
-    right_overlap_qual = right_mapping.qual[:right_after_overlap_read_start] 
+    # Splits are done on cigar blocks instead of lists of aligned pairs.
+    (right_overlap_cigar,
+     right_after_overlap_cigar,
+     _, _,
+     num_right_reads_after,
+     num_right_refs_after,
+    ) = sam.split_cigar_at_ref(right_cigar, right_mapping.reference_start, left_mapping.aend, False)
 
-    right_after_overlap_seq = right_mapping.seq[right_after_overlap_read_start:]
-    right_after_overlap_qual = right_mapping.qual[right_after_overlap_read_start:]
-    
+    right_after_overlap_md = sam.truncate_md_string_from_beginning(right_md, num_right_refs_after)
     
-    left_aligned_pairs = sam.cigar_to_aligned_pairs(left_mapping.cigar, left_mapping.reference_start)
+    right_after_overlap_read_start = len(right_seq) - num_right_reads_after
 
-    left_before_overlap_pair_index = -1
-    for i, (read, ref) in list(enumerate(left_aligned_pairs))[::-1]:
-        if ref != None and ref < right_mapping.pos:
-            left_before_overlap_pair_index = i
-            break
+    right_overlap_seq = right_seq[:right_after_overlap_read_start] 
+    right_overlap_qual = right_qual[:right_after_overlap_read_start] 
 
-    left_overlap_pairs = left_aligned_pairs[left_before_overlap_pair_index + 1:]
-    left_before_overlap_pairs = left_aligned_pairs[:left_before_overlap_pair_index + 1]
-
-    left_reads_before = [read for read, ref in left_before_overlap_pairs if read != None and read != 'N']
-    left_refs_before = [ref for read, ref in left_before_overlap_pairs if ref != None]
+    right_after_overlap_seq = right_seq[right_after_overlap_read_start:]
+    right_after_overlap_qual = right_qual[right_after_overlap_read_start:]
     
-    left_overlap_cigar = sam.aligned_pairs_to_cigar(left_overlap_pairs)
-    left_before_overlap_cigar = sam.aligned_pairs_to_cigar(left_before_overlap_pairs)
-    left_before_overlap_md = sam.truncate_md_string_up_to(left_md, len(left_refs_before))
+    (left_before_overlap_cigar,
+     left_overlap_cigar,
+     num_left_reads_before,
+     num_left_refs_before,
+     _, _,
+    ) = sam.split_cigar_at_ref(left_cigar, left_mapping.reference_start, right_mapping.pos, True)
+
+    left_before_overlap_md = sam.truncate_md_string_up_to(left_md, num_left_refs_before)
     
-    left_overlap_read_start = len(left_reads_before)
-    left_overlap_seq = left_mapping.seq[left_overlap_read_start:] 
-    left_overlap_qual = left_mapping.qual[left_overlap_read_start:] 
+    left_overlap_read_start = num_left_reads_before
+    left_overlap_seq = left_seq[left_overlap_read_start:] 
+    left_overlap_qual = left_qual[left_overlap_read_start:] 
 
-    left_before_overlap_seq = left_mapping.seq[:left_overlap_read_start]
-    left_before_overlap_qual = left_mapping.qual[:left_overlap_read_start]
+    left_before_overlap_seq = left_seq[:left_overlap_read_start]
+    left_before_overlap_qual = left_qual[:left_overlap_read_start]
 
-    if left_overlap_pairs or right_overlap_pairs:
+    if left_overlap_cigar or right_overlap_cigar:
         gap_length = 0
 
         left_has_splicing = sam.contains_splicing(left_mapping)
@@ -125,8 +175,8 @@ def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
             # If the two mappings agree about the location of indels in their overlap,
             # use the seq from the mapping with the higher average quality in the
             # overlap.
-            left_mean_qual = np.mean(fastq.decode_sanger(left_overlap_qual))
-            right_mean_qual = np.mean(fastq.decode_sanger(right_overlap_qual))
+            left_mean_qual = _mean_qual(left_overlap_qual)
+            right_mean_qual = _mean_qual(right_overlap_qual)
 
             if left_mean_qual > right_mean_qual:
                 use_overlap_from = 'left'
@@ -159,21 +209,44 @@ def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
 
             # The leftmost aligned_pair from the right mapping is guaranteed by the
             # mapping process to not involve a gap.
-            _, overlap_ref_start = right_overlap_pairs[0]
+            first_op, _ = right_overlap_cigar[0]
+            if first_op == sam.BAM_CINS:
+                overlap_ref_start = None
+            else:
+                overlap_ref_start = right_mapping.reference_start
             # Similarly, the rightmost aligned_pair from the left mapping can't be a
             # gap.
-            _, overlap_ref_end = left_overlap_pairs[-1]
+            last_op, _ = left_overlap_cigar[-1]
+            if last_op == sam.BAM_CINS:
+                overlap_ref_end = None
+            else:
+                overlap_ref_end = left_mapping.reference_start + sam.total_reference_nucs(left_cigar) - 1
 
-            realigned_left_cigar = sam.truncate_cigar_blocks_up_to(right_mapping.cigar, len(left_overlap_seq))
-            realigned_right_cigar = sam.truncate_cigar_blocks_from_beginning(left_mapping.cigar, len(right_overlap_seq))
+            realigned_left_cigar = sam.truncate_cigar_blocks_up_to(right_cigar, len(left_overlap_seq))
+            realigned_right_cigar = sam.truncate_cigar_blocks_from_beginning(left_cigar, len(right_overlap_seq))
 
-            ref_dict = sam.merge_ref_dicts(sam.ref_dict_from_mapping(left_mapping),
-                                           sam.ref_dict_from_mapping(right_mapping),
-                                          )
+            ref_array = _ref_array(left_mapping, right_mapping)
+
+            # The right realignment is laid out backwards from overlap_ref_end.
+            if overlap_ref_end is None:
+                realigned_right_start = None
+            else:
+                realigned_right_start = overlap_ref_end - sam.total_reference_nucs(realigned_right_cigar) + 1
+            realigned_right_read_start = len(right_overlap_seq) - sam.total_read_nucs(realigned_right_cigar)
 
             try:
-                left_using_right_mismatches = realigned_mismatches(left_overlap_seq, overlap_ref_start, realigned_left_cigar, ref_dict)
-                right_using_left_mismatches = realigned_mismatches_backwards(right_overlap_seq, overlap_ref_end, realigned_right_cigar, ref_dict)
+                left_using_right_mismatches = _count_realigned_mismatches(left_overlap_seq,
+                                                                          realigned_left_cigar,
+                                                                          overlap_ref_start,
+                                                                          0,
+                                                                          ref_array,
+                                                                         )
+                right_using_left_mismatches = _count_realigned_mismatches(right_overlap_seq,
+                                                                          realigned_right_cigar,
+                                                                          realigned_right_start,
+                                                                          realigned_right_read_start,
+                                                                          ref_array,
+                                                                         )
             except ValueError:
                 print left_mapping
                 print right_mapping
@@ -183,19 +256,19 @@ def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
                 logging.info('disagreements in {0}'.format(left_mapping.qname))
                 logging.info('left overlap cigar is  {0}'.format(str(left_overlap_cigar)))
                 logging.info('right overlap cigar is {0}'.format(str(right_overlap_cigar)))
-                logging.info('left_using_right_mismatches - {0}'.format(len(left_using_right_mismatches)))
-                logging.info('right_using_left_mismatches - {0}'.format(len(right_using_left_mismatches)))
+                logging.info('left_using_right_mismatches - {0}'.format(left_using_right_mismatches))
+                logging.info('right_using_left_mismatches - {0}'.format(right_using_left_mismatches))
 
-            if len(left_using_right_mismatches) < len(right_using_left_mismatches):
+            if left_using_right_mismatches < right_using_left_mismatches:
                 use_overlap_from = 'right'
-            elif len(right_using_left_mismatches) < len(left_using_right_mismatches):
+            elif right_using_left_mismatches < left_using_right_mismatches:
                 use_overlap_from = 'left'
             else:
                 logging.info('disagreements in {0}'.format(left_mapping.qname))
                 logging.info('left overlap cigar is  {0}'.format(str(left_overlap_cigar)))
                 logging.info('right overlap cigar is {0}'.format(str(right_overlap_cigar)))
-                logging.info('left_using_right_mismatches - {0}'.format(len(left_using_right_mismatches)))
-                logging.info('right_using_left_mismatches - {0}'.format(len(right_using_left_mismatches)))
+                logging.info('left_using_right_mismatches - {0}'.format(left_using_right_mismatches))
+                logging.info('right_using_left_mismatches - {0}'.format(right_using_left_mismatches))
                 logging.info('ambiguous disagreement')
                 return False
 
@@ -218,9 +291,9 @@ def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
     gap_cigar = [(sam.BAM_CREF_SKIP, gap_length)]
     
     if use_overlap_from == 'left':
-        combined_mapping.seq = left_mapping.seq + right_after_overlap_seq
-        combined_mapping.qual = left_mapping.qual + right_after_overlap_qual
-        combined_mapping.cigar = left_mapping.cigar + gap_cigar + right_after_overlap_cigar
+        combined_mapping.seq = left_seq + right_after_overlap_seq
+        combined_mapping.qual = left_qual + right_after_overlap_qual
+        combined_mapping.cigar = left_cigar + gap_cigar + right_after_overlap_cigar
     
         combined_md = sam.combine_md_strings(left_md, right_after_overlap_md)
         combined_mapping.setTag('MD', combined_md)
@@ -229,9 +302,9 @@ def combine_paired_mappings(R1_mapping, R2_mapping, verbose=False):
         overlap_qual_tag = right_overlap_qual
 
     elif use_overlap_from == 'right':
-        combined_mapping.seq = left_before_overlap_seq + right_mapping.seq
-        combined_mapping.qual = left_before_overlap_qual + right_mapping.qual
-        combined_mapping.cigar = left_before_overlap_cigar + gap_cigar + right_mapping.cigar
+        combined_mapping.seq = left_before_overlap_seq + right_seq
+        combined_mapping.qual = left_before_overlap_qual + right_qual
+        combined_mapping.cigar = left_before_overlap_cigar + gap_cigar + right_cigar
 
         combined_md = sam.combine_md_strings(left_before_overlap_md, right_md)
         combined_mapping.setTag('MD', combined_md)
@@ -463,30 +536,29 @@ def remove_cigar_op(cigar, index):
 
 def mapping_from_line(line):
     combined_mapping = pysam.AlignedRead()
-    parsed_line = sam.parse_line(line)
-    if parsed_line['strand'] == '-':
+    record = sam.SAMRecord(line)
+    if record.strand == '-':
         combined_mapping.is_reverse = True
-    combined_mapping.seq = parsed_line['SEQ']
-    combined_mapping.qual = parsed_line['QUAL']
-    combined_mapping.cigarstring = parsed_line['CIGAR']
+    combined_mapping.seq = record.SEQ
+    combined_mapping.qual = record.QUAL
+    combined_mapping.cigarstring = record.CIGAR
     
     # This should obviously be made more general.
     for tag_name in ['Xs', 'Xq', 'Xw']:
-        if tag_name in parsed_line:
-            tag = [(tag_name, parsed_line[tag_name])]
+        value = record.get_tag(tag_name)
+        if value is not None:
+            tag = [(tag_name, value)]
             combined_mapping.tags = combined_mapping.tags + tag 
 
     return combined_mapping
 
-def filter_mappings(mappings,
-                    minimum_mapq=42,
-                    max_insert_length=1000,
-                    counts_dict=None,
-                    verbose=False,
-                    unmapped_fns=None,
-                   ):
-    ''' Filters out unmapped, nonuniquely mapped, or discordantly mapped
-        reads.
+# Pair categories assigned by _classify_pairs, in the order they are checked.
+UNMAPPED, DISCORDANT, DISORIENTED, NONUNIQUE, UNIQUE = range(5)
+
+def empty_pair_counts():
+    ''' Returns the counts that filter_mappings fills in, with histograms in
+    place of Counters so that counts from separate chunks can be merged with
+    merge_pair_counts.
     '''
     pair_counts = {'total': 0,
                    'unmapped': 0,
@@ -494,86 +566,359 @@ def filter_mappings(mappings,
                    'nonunique': 0,
                    'discordant': 0,
                    'disoriented': 0,
-                   'unique': Counter(),
-                   'mapqs': Counter(),
-                   'fragment_lengths': Counter(),
-                   'tids': Counter(),
+                   'unique': sam.Histogram(),
+                   'mapqs': sam.Histogram(),
+                   'fragment_lengths': sam.Histogram(),
+                   'tids': sam.Histogram(),
                   }
+    return pair_counts
 
-    if unmapped_fns:
-        R1_unmapped_fn, R2_unmapped_fn = unmapped_fns
-        R1_unmapped_fh = open(R1_unmapped_fn, 'w')
-        R2_unmapped_fh = open(R2_unmapped_fn, 'w')
+def merge_pair_counts(first, second):
+    ''' Adds the counts in second to first and returns first. '''
+    for key, value in second.items():
+        first[key] += value
+    return first
+
+def pair_counts_to_counters(pair_counts):
+    ''' Converts the histograms in pair_counts to Counters, as reported by
+    filter_mappings in counts_dict.
+    '''
+    converted = {}
+    for key, value in pair_counts.items():
+        if isinstance(value, sam.Histogram):
+            value = value.to_counter()
+        converted[key] = value
+    return converted
+
+def _check_pairs(groups, pairs_per_batch, collect_fields=True):
+    ''' Yields (key of first group, list of up to pairs_per_batch (R1, R2)
+    pairs, fields of those pairs for _classify_pairs) from (key, mappings with
+    the same qname) groups. If a malformed group is encountered, the pairs
+    before it are yielded before ValueError is raised. If not collect_fields,
+    fields are left empty.
+    '''
+    batch = []
+    fields = []
+    for key, aligned_pair in groups:
+        if not batch:
+            first_key = key
 
-    for _, aligned_pair in utilities.group_by(mappings, key=lambda m: m.qname):
         if len(aligned_pair) != 2:
+            if batch:
+                yield first_key, batch, fields
             raise ValueError(len(aligned_pair))
 
-        pair_counts['total'] += 1
-        
         R1_aligned, R2_aligned = aligned_pair
+        R1_flag = R1_aligned.flag
+        R2_flag = R2_aligned.flag
         # If R2 is mapped but R1 isn't, R2 gets reported first.
-        if not R1_aligned.is_read1:
+        if not R1_flag & 0x40:
             R1_aligned, R2_aligned = R2_aligned, R1_aligned
+            R1_flag, R2_flag = R2_flag, R1_flag
 
-        if (not R1_aligned.is_read1) or (not R2_aligned.is_read2):
+        if (not R1_flag & 0x40) or (not R2_flag & 0x80):
+            if batch:
+                yield first_key, batch, fields
             raise ValueError(R1_aligned, R2_aligned)
-        
-        pair_counts['mapqs'][R1_aligned.mapq] += 1
-        pair_counts['mapqs'][R2_aligned.mapq] += 1
 
-        if R1_aligned.is_unmapped or R2_aligned.is_unmapped:
-            pair_counts['unmapped'] += 1
-            
-            if verbose:
-                logging.info('{0} was unmapped'.format(R1_aligned.qname))
-            
-            if unmapped_fns:
-                R1_read = sam.mapping_to_Read(R1_aligned)
-                R2_read = sam.mapping_to_Read(R2_aligned)
-                R1_unmapped_fh.write(str(R1_read))
-                R2_unmapped_fh.write(str(R2_read))
-        
-        elif is_discordant(R1_aligned, R2_aligned, max_insert_length):
-            pair_counts['discordant'] += 1
-        
-        else:
-            pair_counts['tids'][R1_aligned.tid] += 1
+        batch.append((R1_aligned, R2_aligned))
+        # Extracting fields here saves a second pass over the pairs.
+        if collect_fields:
+            fields.extend((R1_flag, R1_aligned.tid, R1_aligned.pos, R1_aligned.aend or -1, R1_aligned.mapq, R1_aligned.tlen,
+                           R2_flag, R2_aligned.tid, R2_aligned.pos, R2_aligned.aend or -1, R2_aligned.mapq,
+                          ))
+        if len(batch) == pairs_per_batch:
+            yield first_key, batch, fields
+            batch = []
+            fields = []
+
+    if batch:
+        yield first_key, batch, fields
+
+def _classify_pairs(pairs, fields, minimum_mapq, max_insert_length):
+    ''' Returns an array with the category of each (R1, R2) pair in pairs as
+    filter_mappings would assign it, and the counts for pairs. fields are the
+    flattened fields of pairs as collected by _check_pairs.
+    '''
+    fields = np.array(fields, int).reshape(-1, 11)
+
+    (R1_flag, R1_tid, R1_start, R1_end, R1_mapq, R1_tlen,
+     R2_flag, R2_tid, R2_start, R2_end, R2_mapq,
+    ) = fields.T
+
+    unmapped = ((R1_flag | R2_flag) & 0x4) != 0
+
+    extent = np.maximum(R1_end, R2_end) - np.minimum(R1_start, R2_start)
+    discordant = (R1_tid != R2_tid) | (extent > max_insert_length)
+
+    R1_reverse = (R1_flag & 0x10) != 0
+    R2_reverse = (R2_flag & 0x10) != 0
+    disoriented = np.where(R1_reverse,
+                           R2_reverse | (R1_start < R2_start),
+                           ~R2_reverse | (R2_start < R1_start),
+                          )
+
+    nonunique = (R1_mapq < minimum_mapq) | (R2_mapq < minimum_mapq)
+
+    categories = np.select([unmapped, discordant, disoriented, nonunique],
+                           [UNMAPPED, DISCORDANT, DISORIENTED, NONUNIQUE],
+                           UNIQUE,
+                          )
+
+    concordant = (categories == DISORIENTED) | (categories == NONUNIQUE) | (categories == UNIQUE)
+    unique = (categories == UNIQUE)
+
+    pair_counts = empty_pair_counts()
+    pair_counts['total'] = len(pairs)
+    pair_counts['unmapped'] = int(np.count_nonzero(categories == UNMAPPED))
+    pair_counts['discordant'] = int(np.count_nonzero(categories == DISCORDANT))
+    pair_counts['disoriented'] = int(np.count_nonzero(categories == DISORIENTED))
+    pair_counts['nonunique'] = int(np.count_nonzero(categories == NONUNIQUE))
+    pair_counts['mapqs'].add_values(np.concatenate([R1_mapq, R2_mapq]))
+    pair_counts['tids'].add_values(R1_tid[concordant])
+    pair_counts['unique'].add_values(R1_tid[unique])
+    pair_counts['fragment_lengths'].add_values(np.abs(R1_tlen[unique]))
+    pair_counts['indel'] = sum(1 for i in np.flatnonzero(unique)
+                               if sam.contains_indel_pysam(pairs[i][0]) or sam.contains_indel_pysam(pairs[i][1]))
+
+    return categories, pair_counts
+
+def _filter_batches(classified_batches, counts_dict, verbose, unmapped_fns):
+    ''' Given (pairs, (categories, pair_counts)) batches, yields the unique
+    pairs in order, writes and logs the others as filter_mappings does, and
+    fills counts_dict with the merged counts at the end.
+    '''
+    pair_counts = empty_pair_counts()
 
-            if is_disoriented(R1_aligned, R2_aligned):
-                pair_counts['disoriented'] += 1
-            elif R1_aligned.mapq < minimum_mapq or R2_aligned.mapq < minimum_mapq:
-                pair_counts['nonunique'] += 1
-                if verbose:
-                    logging.info('{0} was nonunique, {1}, {2}'.format(R1_aligned.qname, R1_aligned.mapq, R2_aligned.mapq))
-            else:
-                pair_counts['unique'][R1_aligned.tid] += 1
+    if unmapped_fns:
+        R1_unmapped_fn, R2_unmapped_fn = unmapped_fns
+        R1_unmapped_fh = open(R1_unmapped_fn, 'w')
+        R2_unmapped_fh = open(R2_unmapped_fn, 'w')
 
-                fragment_length = abs(R1_aligned.tlen)
-                pair_counts['fragment_lengths'][fragment_length] += 1
-                
-                if sam.contains_indel_pysam(R1_aligned) or sam.contains_indel_pysam(R2_aligned):
-                    pair_counts['indel'] += 1
-                
+    # Only pairs that are yielded, written, or logged need to be visited.
+    visited = [UNIQUE]
+    if verbose or unmapped_fns:
+        visited.append(UNMAPPED)
+    if verbose:
+        visited.append(NONUNIQUE)
+
+    for pairs, (categories, batch_counts) in classified_batches:
+        merge_pair_counts(pair_counts, batch_counts)
+
+        for i in np.flatnonzero(np.in1d(categories, visited)):
+            R1_aligned, R2_aligned = pairs[i]
+            category = categories[i]
+            if category == UNIQUE:
                 yield R1_aligned, R2_aligned
 
+            elif category == UNMAPPED:
+                if verbose:
+                    logging.info('{0} was unmapped'.format(R1_aligned.qname))
+                
+                if unmapped_fns:
+                    R1_read = sam.mapping_to_Read(R1_aligned)
+                    R2_read = sam.mapping_to_Read(R2_aligned)
+                    R1_unmapped_fh.write(str(R1_read))
+                    R2_unmapped_fh.write(str(R2_read))
+
+            elif category == NONUNIQUE and verbose:
+                logging.info('{0} was nonunique, {1}, {2}'.format(R1_aligned.qname, R1_aligned.mapq, R2_aligned.mapq))
+
     if counts_dict != None:
-        counts_dict.update(pair_counts)
-
-def extract_fragment_lengths(bam_file_name):
-    def concordantly_mapped(mapping):
-        return not mapping.mate_is_unmapped and \
-               not mapping.is_unmapped and \
-               mapping.rnext == mapping.tid and \
-               abs(mapping.tlen) < 10000
-
-    bam_fh = pysam.Samfile(bam_file_name)
-    TLENs = (abs(mapping.tlen) for mapping in bam_fh if mapping.is_read1 and concordantly_mapped(mapping))
-    fragment_lengths = Counter(TLENs)
-    
-    # Note that counts_to_array implicitly discards negative key values.
-    fragment_lengths = utilities.counts_to_array(fragment_lengths)
+        counts_dict.update(pair_counts_to_counters(pair_counts))
+
+def filter_mappings(mappings,
+                    minimum_mapq=42,
+                    max_insert_length=1000,
+                    counts_dict=None,
+                    verbose=False,
+                    unmapped_fns=None,
+                    pairs_per_batch=10000,
+                   ):
+    ''' Filters out unmapped, nonuniquely mapped, or discordantly mapped
+        reads. Pairs are classified pairs_per_batch at a time.
+    '''
+    groups = utilities.group_by(mappings, key=lambda m: m.qname)
+    classified_batches = ((pairs, _classify_pairs(pairs, fields, minimum_mapq, max_insert_length))
+                          for _, pairs, fields in _check_pairs(groups, pairs_per_batch))
+
+    for R1_aligned, R2_aligned in _filter_batches(classified_batches, counts_dict, verbose, unmapped_fns):
+        yield R1_aligned, R2_aligned
+
+def _chunk_boundaries(bam_file, pairs_per_chunk):
+    ''' Yields (virtual file offset, number of mappings) for consecutive
+    chunks of bam_file of about pairs_per_chunk pairs that start on qname
+    boundaries. Only the mappings around each boundary are examined in
+    Python; the rest are skipped by pysam.
+    '''
+    while True:
+        offset = bam_file.tell()
+        num_skipped = sum(1 for _ in islice(bam_file, 2 * pairs_per_chunk - 1))
+        try:
+            last = next(bam_file)
+        except StopIteration:
+            if num_skipped:
+                yield offset, num_skipped
+            return
+
+        num_mappings = num_skipped + 1
+        while True:
+            boundary = bam_file.tell()
+            try:
+                mapping = next(bam_file)
+            except StopIteration:
+                yield offset, num_mappings
+                return
+
+            if mapping.qname != last.qname:
+                yield offset, num_mappings
+                bam_file.seek(boundary)
+                break
+
+            num_mappings += 1
+
+def _filter_chunk(bam_file_name, offset, num_mappings, minimum_mapq, max_insert_length, verbose, write_unmapped, scratch_dir):
+    ''' Reads, checks and classifies the num_mappings mappings starting at
+    virtual file offset in bam_file_name. Unique pairs are written to an
+    uncompressed BAM in scratch_dir. Returns that BAM's name, the pair counts,
+    the unmapped reads' fastq records, the messages to log, and the ValueError
+    from a malformed group, if any (the pairs before it are still processed).
+    '''
+    unmapped_records = []
+    messages = []
+    error = None
+    pair_counts = empty_pair_counts()
+
+    with pysam.AlignmentFile(bam_file_name) as bam_file:
+        bam_file.seek(offset)
+        mappings = islice(bam_file, num_mappings)
+        groups = utilities.group_by(mappings, key=lambda m: m.qname)
+
+        unique_file = tempfile.NamedTemporaryFile(dir=scratch_dir, suffix='.bam', delete=False)
+        unique_file.close()
+        with pysam.AlignmentFile(unique_file.name, 'wbu', template=bam_file) as unique_bam:
+            try:
+                for _, pairs, fields in _check_pairs(groups, 10000):
+                    categories, batch_counts = _classify_pairs(pairs, fields, minimum_mapq, max_insert_length)
+                    merge_pair_counts(pair_counts, batch_counts)
+
+                    for i in np.flatnonzero(categories == UNIQUE):
+                        R1_aligned, R2_aligned = pairs[i]
+                        unique_bam.write(R1_aligned)
+                        unique_bam.write(R2_aligned)
+
+                    for i in np.flatnonzero(categories == UNMAPPED):
+                        R1_aligned, R2_aligned = pairs[i]
+                        if verbose:
+                            messages.append('{0} was unmapped'.format(R1_aligned.qname))
+                        if write_unmapped:
+                            unmapped_records.append((str(sam.mapping_to_Read(R1_aligned)),
+                                                     str(sam.mapping_to_Read(R2_aligned)),
+                                                    ))
+
+                    if verbose:
+                        for i in np.flatnonzero(categories == NONUNIQUE):
+                            R1_aligned, R2_aligned = pairs[i]
+                            messages.append('{0} was nonunique, {1}, {2}'.format(R1_aligned.qname, R1_aligned.mapq, R2_aligned.mapq))
+            except ValueError as malformed:
+                # The mappings in its arguments can't be pickled.
+                error = ValueError(*map(str, malformed.args))
+
+    return unique_file.name, pair_counts, unmapped_records, messages, error
+
+def filter_name_sorted_bam(bam_file_name,
+                           minimum_mapq=42,
+                           max_insert_length=1000,
+                           counts_dict=None,
+                           verbose=False,
+                           unmapped_fns=None,
+                           num_processes=1,
+                           pairs_per_chunk=100000,
+                           scratch_dir=None,
+                          ):
+    ''' Equivalent to filter_mappings on the name-sorted bam_file_name, but
+        chunks of about pairs_per_chunk pairs, split at qname boundaries, are
+        read, classified, and filtered in a pool of num_processes processes.
+        The main process only locates chunk boundaries and streams each
+        chunk's unique pairs back, in file order, from an uncompressed BAM
+        the worker wrote in scratch_dir. Counts from each chunk are merged at
+        the end.
+    '''
+    if num_processes == 1:
+        with pysam.AlignmentFile(bam_file_name) as bam_file:
+            for R1_aligned, R2_aligned in filter_mappings(bam_file,
+                                                          minimum_mapq=minimum_mapq,
+                                                          max_insert_length=max_insert_length,
+                                                          counts_dict=counts_dict,
+                                                          verbose=verbose,
+                                                          unmapped_fns=unmapped_fns,
+                                                         ):
+                yield R1_aligned, R2_aligned
+        return
+
+    temp_dir = tempfile.mkdtemp(prefix='filter_', dir=scratch_dir)
+    pool = multiprocessing.Pool(num_processes)
+    bam_file = pysam.AlignmentFile(bam_file_name)
+    pair_counts = empty_pair_counts()
 
+    if unmapped_fns:
+        R1_unmapped_fh, R2_unmapped_fh = [open(fn, 'w') for fn in unmapped_fns]
+
+    def chunk_results():
+        # Keep enough chunks in flight to occupy every process, but not so many
+        # that finished chunks pile up on disk.
+        pending = deque()
+        for offset, num_mappings in _chunk_boundaries(bam_file, pairs_per_chunk):
+            args = (bam_file_name, offset, num_mappings, minimum_mapq, max_insert_length,
+                    verbose, bool(unmapped_fns), temp_dir)
+            pending.append(pool.apply_async(_filter_chunk, args))
+            if len(pending) > 2 * num_processes:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    try:
+        for unique_fn, chunk_counts, unmapped_records, messages, error in chunk_results():
+            merge_pair_counts(pair_counts, chunk_counts)
+            for message in messages:
+                logging.info(message)
+            for R1_record, R2_record in unmapped_records:
+                R1_unmapped_fh.write(R1_record)
+                R2_unmapped_fh.write(R2_record)
+
+            with pysam.AlignmentFile(unique_fn) as unique_bam:
+                for R1_aligned in unique_bam:
+                    R2_aligned = next(unique_bam)
+                    yield R1_aligned, R2_aligned
+            os.remove(unique_fn)
+
+            if error is not None:
+                raise error
+
+        if counts_dict != None:
+            counts_dict.update(pair_counts_to_counters(pair_counts))
+    finally:
+        pool.terminate()
+        pool.join()
+        bam_file.close()
+        if unmapped_fns:
+            R1_unmapped_fh.close()
+            R2_unmapped_fh.close()
+        shutil.rmtree(temp_dir)
+
+def _is_concordant_R1(mapping):
+    return mapping.is_read1 and \
+           not mapping.mate_is_unmapped and \
+           not mapping.is_unmapped and \
+           mapping.rnext == mapping.tid and \
+           abs(mapping.tlen) < 10000
+
+sam.register_collector('fragment_length', lambda m: abs(m.tlen), _is_concordant_R1)
+
+def extract_fragment_lengths(bam_file_name, num_processes=1):
+    histograms = sam.scan_bam(bam_file_name, ['fragment_length'], num_processes)
+    fragment_lengths = histograms['fragment_length'].to_array()
     return fragment_lengths
 
 def filter_long_TLENs(bam_file_name, filtered_bam_file_name, max_TLEN):
@@ -584,18 +929,183 @@ def filter_long_TLENs(bam_file_name, filtered_bam_file_name, max_TLEN):
             filtered_bam_file.write(aligned_read)
 
 def get_concordant_pairs(R1_group, R2_group, max_insert_length):
-    ''' Results are sorted by reference extent length. '''
+    ''' Results are sorted by reference extent length, with ties in the
+    order of R1_group, then R2_group.
+    
+    R2 mappings are bucketed by (tid, strand) and sorted by position, so each
+    R1 mapping is only compared to R2 mappings on the same reference and
+    opposite strand that start within max_insert_length on the correct side
+    of it.
+    '''
+    R2_buckets = {}
+    irregular_R2s = []
+    for j, R2_m in enumerate(R2_group):
+        if R2_m.reference_end is None:
+            irregular_R2s.append((j, R2_m))
+        else:
+            key = (R2_m.tid, R2_m.is_reverse)
+            R2_buckets.setdefault(key, []).append((R2_m.reference_start, j, R2_m))
+
+    for bucket in R2_buckets.itervalues():
+        bucket.sort()
+    bucket_starts = {key: [start for start, _, _ in bucket] for key, bucket in R2_buckets.iteritems()}
+
     pairs = []
-    for R1_m in R1_group:
-        for R2_m in R2_group:
+    for i, R1_m in enumerate(R1_group):
+        if R1_m.reference_end is None:
+            # Unmapped, or no alignment blocks. Check against everything the
+            # slow way to keep the behavior of is_discordant/is_disoriented.
+            candidates = list(enumerate(R2_group))
+        else:
+            key = (R1_m.tid, not R1_m.is_reverse)
+            bucket = R2_buckets.get(key, [])
+            starts = bucket_starts.get(key, [])
+
+            R1_start = R1_m.reference_start
+            # A concordant R2 must start at or after a forward R1 or at or
+            # before a reverse R1, and within max_insert_length of it.
+            if R1_m.is_reverse:
+                low = bisect.bisect_left(starts, R1_start - max_insert_length)
+                high = bisect.bisect_right(starts, R1_start)
+            else:
+                low = bisect.bisect_left(starts, R1_start)
+                high = bisect.bisect_right(starts, R1_start + max_insert_length)
+
+            candidates = [(j, R2_m) for _, j, R2_m in bucket[low:high]] + irregular_R2s
+
+        for j, R2_m in candidates:
             if not is_discordant(R1_m, R2_m, max_insert_length) and not is_disoriented(R1_m, R2_m):
-                pairs.append((R1_m, R2_m))
-    pairs = sorted(pairs, key=lambda p: get_reference_extent(*p))
+                pairs.append((get_reference_extent(R1_m, R2_m), i, j, R1_m, R2_m))
+
+    pairs.sort(key=lambda p: p[:3])
+    pairs = [(R1_m, R2_m) for _, _, _, R1_m, R2_m in pairs]
     return pairs
 
-def group_mapping_pairs(mappings):
-    groups = utilities.group_by(mappings, lambda r: r.query_name)
+def _order_mates(first, second):
+    if first.is_read1 and second.is_read2:
+        return first, second
+    elif first.is_read2 and second.is_read1:
+        return second, first
+    else:
+        raise ValueError(first, second)
+
+def _pair_stream(mappings, template, max_pending, num_partitions, prefix, depth, unpaired):
+    ''' Yields (R1, R2) pairs from mappings, holding at most max_pending
+        mappings whose mate hasn't been seen yet. The oldest waiting mappings
+        are spilled to num_partitions BAM files named from prefix, split by a
+        hash of qname and depth, which are paired recursively at the end.
+        Adds the number of mappings left without a mate to unpaired[0].
+    '''
+    pending = {}
+    # qnames in the order they started waiting. Entries for qnames that have
+    # since been paired are skipped when evicting and compacted away.
+    order = deque()
+    partitions = None
+
+    def spill(mapping):
+        if depth == 0:
+            partition = hash(mapping.query_name) % num_partitions
+        else:
+            # Each level has to split differently from the one before. The
+            # low bits of the built-in string hash barely depend on a prefix,
+            # so this needs a real digest.
+            key = '{0} {1}'.format(depth, mapping.query_name)
+            partition = int(hashlib.md5(key).hexdigest()[:8], 16) % num_partitions
+        partitions[partition][1].write(mapping)
+
+    pop_pending = pending.pop
+    try:
+        for mapping in mappings:
+            qname = mapping.query_name
+            mate = pop_pending(qname, None)
+            if mate is not None:
+                yield _order_mates(mate, mapping)
+                continue
+
+            pending[qname] = mapping
+            order.append(qname)
+            if len(order) > 2 * len(pending) + 1000:
+                order = deque(q for q in order if q in pending)
+
+            while len(pending) > max_pending:
+                oldest = pending.pop(order.popleft(), None)
+                if oldest is not None:
+                    if partitions is None:
+                        partitions = []
+                        for i in range(num_partitions):
+                            fn = '{0}.{1}.bam'.format(prefix, i)
+                            partitions.append((fn, pysam.AlignmentFile(fn, 'wbu', template=template)))
+                    spill(oldest)
+
+        if partitions is None:
+            unpaired[0] += len(pending)
+            return
+
+        for mapping in pending.itervalues():
+            spill(mapping)
+        pending = {}
+        order = deque()
+        for _, writer in partitions:
+            writer.close()
+
+        # Mates always land in the same partition.
+        for fn, _ in partitions:
+            with pysam.AlignmentFile(fn, check_sq=False) as partition:
+                for pair in _pair_stream(partition, partition, max_pending, num_partitions, fn[:-len('.bam')], depth + 1, unpaired):
+                    yield pair
+            os.remove(fn)
+
+    finally:
+        if partitions is not None:
+            for _, writer in partitions:
+                writer.close()
+
+def pair_mates(bam_file_name, max_pending=10**6, num_partitions=16, scratch_dir=None):
+    ''' Yields (R1, R2) pairs of primary mappings from bam_file_name, which
+        doesn't need to be sorted by name. Secondary and supplementary
+        mappings are skipped.
+        
+        Mappings whose mate hasn't been seen yet are held in a dictionary by
+        qname, and each pair is yielded as soon as its second mate is seen.
+        Whenever more than max_pending mappings are waiting, the one that has
+        waited longest is spilled to one of num_partitions BAM files in
+        scratch_dir, chosen by a hash of qname. After the whole file has been
+        read, each partition is paired in turn the same way, being split
+        again if it still holds too many unpaired mappings, so pairs that
+        were spilled come out at the end.
+
+        chain.from_iterable(pair_mates(...)) is a stream that filter_mappings
+        can group by qname.
+    '''
+    temp_dir = tempfile.mkdtemp(prefix='pair_mates_', dir=scratch_dir)
+    unpaired = [0]
+    try:
+        with pysam.AlignmentFile(bam_file_name) as bam_file:
+            primary = (m for m in bam_file if not (m.is_secondary or m.is_supplementary))
+            pairs = _pair_stream(primary, bam_file, max_pending, num_partitions, os.path.join(temp_dir, 'partition'), 0, unpaired)
+            try:
+                for pair in pairs:
+                    yield pair
+            finally:
+                # Closes the partition writers if the caller stops early.
+                pairs.close()
+
+        if unpaired[0]:
+            logging.warning('{0} mappings in {1} had no mate'.format(unpaired[0], bam_file_name))
+    finally:
+        shutil.rmtree(temp_dir)
+
+def group_mapping_pairs(mappings, **group_kwargs):
+    ''' group_kwargs (max_group_size, overflow, stats) are passed to
+        utilities.stream_groups.
+    '''
+    groups = utilities.stream_groups(mappings, lambda r: r.query_name, **group_kwargs)
     for query_name, query_mappings in groups:
-        R1_group = [m for m in query_mappings if m.is_read1]
-        R2_group = [m for m in query_mappings if m.is_read2]
+        R1_group = []
+        R2_group = []
+        for m in query_mappings:
+            if m.is_read1:
+                R1_group.append(m)
+            if m.is_read2:
+                R2_group.append(m)
         yield query_name, (R1_group, R2_group)
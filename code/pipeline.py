@@ -0,0 +1,204 @@
+''' Chains of subprocesses connected by pipes, like a shell pipeline. '''
+
+import os
+import signal
+import threading
+import time
+import subprocess32 as subprocess
+
+class PipelineError(subprocess.CalledProcessError, RuntimeError):
+    ''' Raised for the first stage of a Pipeline to fail. Also a RuntimeError
+        because that is what hand-built pipelines used to raise.
+    '''
+    def __init__(self, name, returncode, cmd, output):
+        subprocess.CalledProcessError.__init__(self, returncode, cmd, output)
+        self.name = name
+
+    def __str__(self):
+        return 'Pipeline stage {0} ({1}) exited with status {2}:\n{3}'.format(self.name,
+                                                                            ' '.join(self.cmd),
+                                                                            self.returncode,
+                                                                            self.output,
+                                                                           )
+
+class Pipeline(object):
+    ''' Runs commands with each one's stdout piped into the next one's stdin.
+        stdin and stdout are for the first and last commands, and may be
+        subprocess.PIPE, in which case they are available as the pipeline's
+        stdin and stdout.
+
+        Every command's stderr is drained by its own thread, so a chatty stage
+        can never fill its stderr pipe and deadlock the pipeline. The last
+        max_stderr bytes are kept for error messages, and everything is also
+        written to stderr_files[name] if given. names default to the program
+        names.
+
+        The first stage to fail has the other stages killed and is raised as a
+        PipelineError by wait. Stages that die of SIGPIPE are not counted as
+        failures, since that only happens when a later stage stopped reading.
+        stderrs has the kept stderr of each stage.
+        After wait, timings has each stage's name, wall time, user and system
+        CPU time, and return code.
+
+        Used as a context manager, the pipeline is started on entry and waited
+        on at exit.
+    '''
+    def __init__(self, commands, names=None, stdin=None, stdout=None, stderr_files=None, max_stderr=2**16):
+        self.commands = commands
+        if names is None:
+            names = [os.path.basename(command[0]) for command in commands]
+        self.names = names
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr_files = stderr_files if stderr_files is not None else {}
+        self.max_stderr = max_stderr
+
+        self.processes = []
+        self.stderrs = ['' for _ in commands]
+        self.timings = [None for _ in commands]
+        self.failure = None
+        self.failure_lock = threading.Lock()
+        # Held while reaping a stage and while signalling stages, so that a
+        # pid is never signalled after it has been reaped and possibly reused.
+        self.reap_lock = threading.Lock()
+        self.reaped = [False for _ in commands]
+        self.threads = []
+
+    def start(self):
+        stdin = self.stdin
+        try:
+            for i, command in enumerate(self.commands):
+                is_last = (i == len(self.commands) - 1)
+                stdout = self.stdout if is_last else subprocess.PIPE
+                process = subprocess.Popen(command,
+                                           stdin=stdin,
+                                           stdout=stdout,
+                                           stderr=subprocess.PIPE,
+                                          )
+                if i > 0:
+                    # Only the next stage should hold the read end.
+                    stdin.close()
+                stdin = process.stdout
+                self.processes.append((process, time.time()))
+        except:
+            # A stage that couldn't be started (e.g. a missing binary) would
+            # otherwise leave the earlier ones running with nothing to drain
+            # or reap them.
+            for i, (process, _) in enumerate(self.processes):
+                process.kill()
+                process.wait()
+                self.reaped[i] = True
+                for pipe in [process.stdin, process.stdout, process.stderr]:
+                    if pipe is not None:
+                        pipe.close()
+            raise
+
+        for i, (process, start_time) in enumerate(self.processes):
+            for target in [self._drain, self._wait_for]:
+                thread = threading.Thread(target=target, args=(i,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        first_process = self.processes[0][0]
+        last_process = self.processes[-1][0]
+        self.stdin = first_process.stdin
+        self.stdout = last_process.stdout
+
+        return self
+
+    def _drain(self, i):
+        process, _ = self.processes[i]
+        stderr_file = self.stderr_files.get(self.names[i])
+        for data in iter(lambda: os.read(process.stderr.fileno(), 2**16), ''):
+            if stderr_file is not None:
+                stderr_file.write(data)
+            self.stderrs[i] = (self.stderrs[i] + data)[-self.max_stderr:]
+        process.stderr.close()
+
+    def _wait_for(self, i, max_delay=0.02):
+        process, start_time = self.processes[i]
+        # A blocking wait4 would reap outside of reap_lock, so poll instead,
+        # backing off to max_delay between checks.
+        delay = 0.0005
+        while True:
+            with self.reap_lock:
+                pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                if pid != 0:
+                    if os.WIFSIGNALED(status):
+                        returncode = -os.WTERMSIG(status)
+                    else:
+                        returncode = os.WEXITSTATUS(status)
+                    # Let the Popen object know the process has been reaped.
+                    process.returncode = returncode
+                    self.reaped[i] = True
+                    break
+            time.sleep(delay)
+            delay = min(2 * delay, max_delay)
+
+        self.timings[i] = {'name': self.names[i],
+                           'wall': time.time() - start_time,
+                           'user': usage.ru_utime,
+                           'system': usage.ru_stime,
+                           'returncode': returncode,
+                          }
+
+        # Shells report a child killed by SIGPIPE as 128 + SIGPIPE.
+        if returncode not in (0, -signal.SIGPIPE, 128 + signal.SIGPIPE):
+            with self.failure_lock:
+                if self.failure is None:
+                    self.failure = i
+                    self.kill()
+
+    def kill(self):
+        with self.reap_lock:
+            for i, (process, _) in enumerate(self.processes):
+                if not self.reaped[i]:
+                    try:
+                        process.kill()
+                    except OSError:
+                        pass
+
+    @property
+    def returncode(self):
+        if self.failure is not None:
+            return self.timings[self.failure]['returncode']
+        else:
+            return 0
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+
+        if self.failure is not None:
+            i = self.failure
+            raise PipelineError(self.names[i],
+                                self.timings[i]['returncode'],
+                                self.commands[i],
+                                self.stderrs[i],
+                               )
+
+    def communicate(self):
+        ''' Like Popen.communicate, for callers that treat a pipeline as a
+            process. Returns (None, stderr of the failed stage or the last
+            stage) and sets returncode rather than raising.
+        '''
+        for thread in self.threads:
+            thread.join()
+
+        i = self.failure if self.failure is not None else len(self.commands) - 1
+        return None, self.stderrs[i]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if self.stdin is not None:
+            self.stdin.close()
+
+        if exception_type is not None:
+            self.kill()
+            for thread in self.threads:
+                thread.join()
+        else:
+            self.wait()
@@ -3,16 +3,23 @@
 import utilities
 import re
 import subprocess32 as subprocess
-from collections import Counter
-from itertools import izip, chain
+from collections import Counter, namedtuple
+from itertools import izip, chain, imap
+from functools import partial
 import os
 import shutil
 import external_sort
+import sam_cython
 import pysam
 import fastq
 import mapping_tools
+import pipeline
 import logging
 import heapq
+import tempfile
+import sys
+import multiprocessing
+import numpy as np
 
 BAM_CMATCH = 0     # M
 BAM_CINS = 1       # I
@@ -83,42 +90,78 @@ def unmapped_aligned_read(qname):
 def splice_in_name(line, new_name):
     return '\t'.join([new_name] + line.split('\t')[1:])
 
-def get_header_lines(sam_file_name):                                                                  
-    ''' Returns the header lines in sam_file_name. '''                                  
-    
-    header_lines = []
-    
-    with open(sam_file_name) as sam_file:                                                               
-        for line in sam_file:                                                                           
-            if line.startswith('@'):                                                                    
-                header_lines.append(line)
-            else:                                                                                       
-                break                                                                                   
-    
-    return header_lines
+SAMHeader = namedtuple('SAMHeader', ['lines', 'start_of_reads', 'SQ', 'RG', 'PG'])
+
+# Maps file name to ((device, inode, mtime, size), SAMHeader) so each file's
+# header is only parsed once as long as the file is unchanged. The inode
+# catches a file replaced by rename with the same size within one mtime tick.
+_header_cache = {}
 
-def count_header_lines(sam_file_name):                                                                  
-    ''' Returns the total number of header lines in sam_file_name. '''                                  
-    return len(get_header_lines(sam_file_name))
+def _parse_header_line(line):
+    ''' Returns a dictionary of the TAG:VALUE fields of a header line. '''
+    fields = line.rstrip('\n').split('\t')[1:]
+    return dict(field.split(':', 1) for field in fields if ':' in field)
 
-def open_to_reads(sam_file_name):                                                                       
-    ''' Returns an open file that has been advanced to the first read line in                           
-        sam_file_name (i.e. past all header lines.)                                                     
+def get_header(sam_file_name):
+    ''' Returns a SAMHeader with the header lines of sam_file_name, the byte
+        offset of its first read line, and parsed @SQ, @RG and @PG lines.
+        Results are cached until the file's inode, mtime or size changes.
     '''
-    header_line_count = count_header_lines(sam_file_name)
+    stat = os.stat(sam_file_name)
+    signature = (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+    cached = _header_cache.get(sam_file_name)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    lines = []
+    start_of_reads = 0
+    with open(sam_file_name) as sam_file:
+        for line in iter(sam_file.readline, ''):
+            if not line.startswith('@'):
+                break
+            lines.append(line)
+            start_of_reads += len(line)
+
+    parsed = {'SQ': [], 'RG': [], 'PG': []}
+    for line in lines:
+        record_type = line[1:3]
+        if record_type in parsed:
+            parsed[record_type].append(_parse_header_line(line))
+
+    header = SAMHeader(tuple(lines), start_of_reads, parsed['SQ'], parsed['RG'], parsed['PG'])
+    _header_cache[sam_file_name] = (signature, header)
+    return header
+
+def get_header_lines(sam_file_name):
+    ''' Returns the header lines in sam_file_name. '''
+    return list(get_header(sam_file_name).lines)
+
+def get_sq_lines(sam_file_name):
+    ''' Returns the @SQ header lines in sam_file_name. '''
+    return [line for line in get_header(sam_file_name).lines if line.startswith('@SQ')]
+
+def count_header_lines(sam_file_name):
+    ''' Returns the total number of header lines in sam_file_name. '''
+    return len(get_header(sam_file_name).lines)
+
+def open_to_reads(sam_file_name):
+    ''' Returns an open file that has been advanced to the first read line in
+        sam_file_name (i.e. past all header lines.)
+    '''
+    start_of_reads = get_header(sam_file_name).start_of_reads
     sam_file = open(sam_file_name)
-    for i in range(header_line_count):
-        sam_file.readline()
+    sam_file.seek(start_of_reads)
     return sam_file
 
 def separate_header_and_read_lines(sam_line_source):
     ''' Returns a list of header lines and an iterator over read lines. '''
     if type(sam_line_source) == str:
-        all_lines = open(sam_line_source)
-    else:
-        all_lines = iter(sam_line_source)
+        return get_header_lines(sam_line_source), open_to_reads(sam_line_source)
+
+    all_lines = iter(sam_line_source)
 
     header_lines = []
+    first_read_line = []
     for line in all_lines:
         if line.startswith('@'):
             header_lines.append(line)
@@ -134,62 +177,188 @@ def mapped_reads(sam_file_name):
     ''' Returns an iterator over the lines of sam_file_name that correspond to
         mapped reads.
     '''
-    def is_mapped(line):
-        parsed = parse_line(line)
-        return parsed['mapped']
-    
     lines = open_to_reads(sam_file_name)
-    mapped_lines = (line for line in lines if is_mapped(line))
+    mapped_lines = filter_lines_by_flag(lines, excluded=0x4)
     return mapped_lines
-    
-def parse_line(line):
-    ''' Returns a dictionary of the information in a SAM line.
+
+def get_flag(line):
+    ''' Returns the FLAG of a SAM line without splitting the rest of it. '''
+    return int(line.split('\t', 2)[1])
+
+def filter_lines_by_flag(lines, required=0, excluded=0):
+    ''' Yields the lines whose FLAG has all bits in required set and no bits in
+        excluded set.
     '''
-    fields = line.rstrip().split('\t')
-    
-    flags = int(fields[1])
-    parsed_line = {'mapped':    not (flags & 0x4),
-                   'QNAME':     fields[0],
-                   'strand':    '-' if (flags & 0x10) else '+',
-                   'RNAME':     fields[2],
-                   'POS':       int(fields[3]) - 1, # SAM is 1-indexed
-                   'MAPQ':      int(fields[4]),
-                   'CIGAR':     fields[5],
-                   'TLEN':      int(fields[8]),
-                   'SEQ':       fields[9],
-                   'QUAL':      fields[10],  
+    for line in lines:
+        flag = get_flag(line)
+        if (flag & required) == required and not (flag & excluded):
+            yield line
+
+def _parse_XA(qname, value):
+    ''' Parses the BWA-specific XA tag into a list of dictionaries. '''
+    entries = value.rstrip(';').split(';')
+    alternatives = []
+    for entry in entries:
+        ref_seq_name, strand_and_position, cigar, nm = entry.split(',')
+        # first character of strand_and_position is [+-], rest is position
+        strand = strand_and_position[0]
+        position = int(strand_and_position[1:]) - 1 # SAM is 1-indexed
+        xa_dict = {'QNAME':     qname,
+                   'RNAME':     ref_seq_name,
+                   'strand':    strand,
+                   'POS':       position,
+                   'CIGAR':     cigar,
+                   'NM':        int(nm),
                   }
-    
-    # There are 11 mandatory fields, followed by optional tags.
-    for field in fields[11:]:
-        name, data_type = field.split(':')[:2]
-        value = ':'.join(field.split(':')[2:])
-        
-        # BWA-specific XA field
-        if name == 'XA':
-            entries = value.rstrip(';').split(';')
-            parsed_line['XA'] = []
-            for entry in entries:
-                ref_seq_name, strand_and_position, cigar, nm = entry.split(',')
-                # first character of strand_and_position is [+-], rest is position
-                strand = strand_and_position[0]
-                position = int(strand_and_position[1:]) - 1 # SAM is 1-indexed
-                xa_dict = {'QNAME':     fields[0],
-                           'RNAME':     ref_seq_name,
-                           'strand':    strand,
-                           'POS':       position,
-                           'CIGAR':     cigar,
-                           'NM':        int(nm),
-                          }
-                parsed_line['XA'].append(xa_dict)
-        else:
-            if data_type == 'i':
-                value = int(value)
-            elif data_type == 'f':
-                value = float(value)
-            parsed_line[name] = value
+        alternatives.append(xa_dict)
+    return alternatives
+
+def _parse_tag(qname, field):
+    ''' Returns the name and decoded value of an optional SAM field. '''
+    name, data_type, value = field.split(':', 2)
+    if name == 'XA':
+        value = _parse_XA(qname, value)
+    elif data_type == 'i':
+        value = int(value)
+    elif data_type == 'f':
+        value = float(value)
+    return name, value
+
+class SAMRecord(object):
+    ''' A SAM line that is only split when one of its fields is accessed, and
+        whose optional tags are only decoded when asked for. Fields can be
+        accessed as attributes or with the same keys as the dictionaries
+        returned by parse_line.
+    '''
+    __slots__ = ['line', '_fields', '_tags']
+
+    def __init__(self, line):
+        self.line = line
+        self._fields = None
+        self._tags = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.line.rstrip().split('\t')
+        return self._fields
+
+    @property
+    def QNAME(self):
+        return self.fields[0]
+
+    @property
+    def FLAG(self):
+        return int(self.fields[1])
+
+    @property
+    def mapped(self):
+        return not (self.FLAG & 0x4)
+
+    @property
+    def strand(self):
+        return '-' if (self.FLAG & 0x10) else '+'
+
+    @property
+    def RNAME(self):
+        return self.fields[2]
+
+    @property
+    def POS(self):
+        # SAM is 1-indexed
+        return int(self.fields[3]) - 1
+
+    @property
+    def MAPQ(self):
+        return int(self.fields[4])
+
+    @property
+    def CIGAR(self):
+        return self.fields[5]
+
+    @property
+    def RNEXT(self):
+        return self.fields[6]
+
+    @property
+    def PNEXT(self):
+        return int(self.fields[7]) - 1
+
+    @property
+    def TLEN(self):
+        return int(self.fields[8])
+
+    @property
+    def SEQ(self):
+        return self.fields[9]
+
+    @property
+    def QUAL(self):
+        return self.fields[10]
+
+    @property
+    def tags(self):
+        ''' A dictionary of all decoded optional tags. '''
+        if self._tags is None:
+            qname = self.QNAME
+            # There are 11 mandatory fields, followed by optional tags.
+            self._tags = dict(_parse_tag(qname, field) for field in self.fields[11:])
+        return self._tags
+
+    def _find_tag_field(self, name):
+        prefix = name + ':'
+        for field in self.fields[11:]:
+            if field.startswith(prefix):
+                return field
+        return None
+
+    def has_tag(self, name):
+        if self._tags is not None:
+            return name in self._tags
+        return self._find_tag_field(name) is not None
+
+    def get_tag(self, name, default=None):
+        ''' Decodes only the tag name, returning default if it is absent. '''
+        if self._tags is not None:
+            return self._tags.get(name, default)
+
+        field = self._find_tag_field(name)
+        if field is None:
+            return default
+        _, value = _parse_tag(self.QNAME, field)
+        return value
+
+    _mandatory_keys = ['mapped', 'QNAME', 'strand', 'RNAME', 'POS', 'MAPQ',
+                       'CIGAR', 'TLEN', 'SEQ', 'QUAL',
+                      ]
+
+    def __getitem__(self, key):
+        if key in SAMRecord._mandatory_keys:
+            return getattr(self, key)
+        field = self._find_tag_field(key)
+        if field is None:
+            raise KeyError(key)
+        _, value = _parse_tag(self.QNAME, field)
+        return value
+
+    def __contains__(self, key):
+        return key in SAMRecord._mandatory_keys or self.has_tag(key)
+
+    def to_dict(self):
+        ''' Returns the dictionary that parse_line would. '''
+        parsed_line = {key: getattr(self, key) for key in SAMRecord._mandatory_keys}
+        parsed_line.update(self.tags)
+        return parsed_line
+
+def records(lines):
+    ''' Yields a SAMRecord for each line in lines. '''
+    for line in lines:
+        yield SAMRecord(line)
 
-    return parsed_line
+def parse_line(line):
+    ''' Returns a dictionary of the information in a SAM line.
+    '''
+    return SAMRecord(line).to_dict()
 
 cigar_block = re.compile(r'(\d+)([MIDNSHP=X])')
 
@@ -258,18 +427,7 @@ def alignment_to_cigar_blocks(ref_aligned, read_aligned):
     return [[count, char] for char, count in zip(sequence, counts)]
 
 def aligned_pairs_to_cigar(aligned_pairs, guide=None):
-    op_sequence = []
-    for read, ref in aligned_pairs:
-        if read == None or read == '-':
-            op_sequence.append(BAM_CDEL)
-        elif read == 'N':
-            op_sequence.append(BAM_CREF_SKIP)
-        elif ref == None or ref == '-':
-            op_sequence.append(BAM_CINS)
-        else:
-            op_sequence.append(BAM_CMATCH)
-
-    cigar = [(op, len(times)) for op, times in utilities.group_by(op_sequence)]
+    cigar = sam_cython.aligned_pairs_to_cigar_blocks(aligned_pairs)
 
     if guide:
         guide_cigar, from_side = guide
@@ -289,74 +447,53 @@ def aligned_pairs_to_cigar(aligned_pairs, guide=None):
 
     return cigar
 
-def cigar_to_aligned_pairs(cigar, start):
-    aligned_pairs = []
-
-    ref_pos = start
-    read_pos = 0
+def _check_aligned_pairs_ops(cigar):
     for op, length in cigar:
-        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
-            for i in range(length):
-                aligned_pairs.append((read_pos, ref_pos))
-
-                ref_pos += 1
-                read_pos += 1
-
-        elif op == BAM_CDEL:
-            # Deletion results in gap in read
-            for i in range(length):
-                aligned_pairs.append((None, ref_pos))
-                
-                ref_pos += 1
-        
-        elif op == BAM_CREF_SKIP:
-            # Skip results in gap in read
-            for i in range(length):
-                aligned_pairs.append(('N', ref_pos))
-                
-                ref_pos += 1
+        if op not in _aligned_pairs_ops:
+            raise ValueError('Unsupported op', cigar)
 
-        elif op == BAM_CINS:
-            # Insertion results in gap in ref
-            for i in range(length):
-                aligned_pairs.append((read_pos, None))
+_aligned_pairs_ops = {
+    BAM_CMATCH,
+    BAM_CEQUAL,
+    BAM_CDIFF,
+    BAM_CDEL,
+    BAM_CREF_SKIP,
+    BAM_CINS,
+}
 
-                read_pos += 1
+def cigar_to_columns(cigar, start, read_start=0):
+    ''' Array equivalent of cigar_to_aligned_pairs. Returns (ops,
+        read_positions, ref_positions) with one entry per aligned pair, with
+        = and X ops reported as M. See sam_cython.expand_cigar.
+    '''
+    _check_aligned_pairs_ops(cigar)
+    ops, read_positions, ref_positions = sam_cython.expand_cigar(cigar, start, read_start)
+    ops[(ops == BAM_CEQUAL) | (ops == BAM_CDIFF)] = BAM_CMATCH
+    return ops, read_positions, ref_positions
+
+def split_cigar_at_ref(cigar, ref_start, boundary, insertions_after):
+    ''' Splits the aligned pairs of cigar in two at reference position
+        boundary without expanding them. See sam_cython.split_cigar_at_ref.
+    '''
+    _check_aligned_pairs_ops(cigar)
+    return sam_cython.split_cigar_at_ref(cigar, ref_start, boundary, insertions_after)
 
-        else:
-            raise ValueError('Unsupported op', cigar)
+def cigar_to_aligned_pairs(cigar, start):
+    _check_aligned_pairs_ops(cigar)
+    columns = sam_cython.expand_cigar(cigar, start)
+    aligned_pairs = sam_cython.columns_to_aligned_pairs(*columns)
 
     return aligned_pairs
 
 def cigar_to_aligned_pairs_backwards(cigar, end, read_length):
-    aligned_pairs = []
-
-    ref_pos = end
-    read_pos = read_length - 1
-    for op, length in cigar[::-1]:
-        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
-            for i in range(length):
-                aligned_pairs.append((read_pos, ref_pos))
-
-                ref_pos -= 1
-                read_pos -= 1
-
-        elif op == BAM_CDEL or op == BAM_CREF_SKIP:
-            # Deletion results in gap in read
-            for i in range(length):
-                aligned_pairs.append((None, ref_pos))
-                
-                ref_pos -= 1
-
-        elif op == BAM_CINS:
-            # Insertion results in gap in ref
-            for i in range(length):
-                aligned_pairs.append((read_pos, None))
-
-                read_pos -= 1
-
-        else:
-            raise ValueError('Unsupported op', cigar)
+    _check_aligned_pairs_ops(cigar)
+    start = end - total_reference_nucs(cigar) + 1
+    read_start = read_length - total_read_nucs(cigar)
+    columns = sam_cython.expand_cigar(cigar, start, read_start)
+    aligned_pairs = sam_cython.columns_to_aligned_pairs(*columns,
+                                                        skip_read_value=None,
+                                                        backwards=True
+                                                       )
 
     return aligned_pairs
 
@@ -410,42 +547,7 @@ def md_string_to_ops_string(md_string):
         characters, either '=' if equal to the read, or any other char if equal
         to that char.
     '''
-    # In the presence of a CIGAR string, the '^' character seems extraneous.
-    md_string = md_string.translate(None, '^')
-    
-    match_lengths = map(int, re.findall(md_number, md_string))
-    text_blocks = re.findall(md_text, md_string)
-    
-    ops_string = '='*match_lengths[0]
-    for text_block, match_length in zip(text_blocks, match_lengths[1:]):
-        ops_string += text_block
-        ops_string += '='*match_length
-    
-    return ops_string
-
-def md_string_to_ops_string(md_string):
-    ''' Converts an MD string into a list of operations for supplying reference
-        characters, either '=' if equal to the read, or any other char if equal
-        to that char.
-    '''
-    # In the presence of a CIGAR string, the '^' character seems extraneous.
-    md_string = md_string.translate(None, '^')
-    
-    match_lengths = map(int, re.findall(md_number, md_string))
-    text_blocks = re.findall(md_text, md_string)
-    
-    # The standard calls for a number to start and end, zero if necessary,
-    # so after removing the initial number, there must be the same number of 
-    # match_lengths and text_blocks.
-    if len(text_blocks) != len(match_lengths) - 1:
-        raise ValueError(md_string)
-    
-    ops_string = '='*match_lengths[0]
-    for text_block, match_length in zip(text_blocks, match_lengths[1:]):
-        ops_string += text_block
-        ops_string += '='*match_length
-    
-    return ops_string
+    return sam_cython.expand_md(md_string).tostring()
 
 md_item_pattern = re.compile(r'[0-9]+|[TCAGN^]+')
 
@@ -457,7 +559,10 @@ def int_if_possible(string):
         return string
 
 def md_string_to_items(md_string):
-    items = [int_if_possible(item) for item in md_item_pattern.findall(md_string)]
+    # Items are either all digits or contain no digits, so checking the first
+    # character avoids int_if_possible's exception for every text item.
+    items = [int(item) if item[0].isdigit() else item
+             for item in md_item_pattern.findall(md_string)]
     return items
 
 def md_items_to_md_string(items):
@@ -573,9 +678,10 @@ def truncate_md_string_from_beginning(md_string, truncated_length):
     truncated_items = reverse_md_items(reversed_truncated_items)
     return md_items_to_md_string(truncated_items)
     
-def produce_alignment(mapping):
-    ''' Returns a list of (ref_char, read_char, qual_char, ref_pos, read_pos)
-        tuples.
+def alignment_arrays(mapping):
+    ''' Returns parallel arrays (ops, ref_positions, read_positions, ref_bases,
+        read_bases, quals) describing every M, =, X, I, and D column of mapping.
+        See sam_cython.alignment_arrays.
     '''
     read_seq = mapping.seq
     if read_seq == None:
@@ -586,80 +692,34 @@ def produce_alignment(mapping):
         read_quals = ''
     
     MD_string = dict(mapping.tags)['MD']
-    
-    read_quals = fastq.decode_sanger(read_quals)
 
-    ref_ops = iter(md_string_to_ops_string(MD_string))
-    
-    columns = []
-
-    ref_pos = mapping.pos
-    read_pos = 0
-    for op, length in mapping.cigar:
-        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
-            for i in range(length):
-                read_char = read_seq[read_pos]
-                
-                ref_op = ref_ops.next()
-                if ref_op == '=':
-                    ref_char = read_char
-                else:
-                    ref_char = ref_op
-                
-                qual = read_quals[read_pos]
-                
-                column = (ref_char, read_char, qual, ref_pos, read_pos)
-                columns.append(column)
-
-                ref_pos += 1
-                read_pos += 1
-
-        elif op == BAM_CDEL:
-            # Deletion results in gap in read
-            for i in range(length):
-                read_char = '-'
-                ref_char = ref_ops.next()
-                qual = 0 
-                
-                column = (ref_char, read_char, qual, ref_pos, read_pos)
-                columns.append(column)
-                
-                ref_pos += 1
-
-        elif op == BAM_CINS:
-            # Insertion results in gap in ref
-            for i in range(length):
-                read_char = read_seq[read_pos]
-                ref_char = '-'
-                qual = read_quals[read_pos]
-                column = (ref_char, read_char, qual, ref_pos, read_pos)
-                columns.append(column)
-
-                read_pos += 1
-
-        elif op == BAM_CREF_SKIP:
-            ref_pos += length
-
-        elif op == BAM_CSOFT_CLIP:
-            read_pos += length
-    
+    return sam_cython.alignment_arrays(mapping.cigar, MD_string, mapping.pos, read_seq, read_quals)
+
+def produce_alignment(mapping):
+    ''' Returns a list of (ref_char, read_char, qual_char, ref_pos, read_pos)
+        tuples.
+    '''
+    _, ref_positions, read_positions, ref_bases, read_bases, quals = alignment_arrays(mapping)
+    columns = zip(ref_bases.tostring(),
+                  read_bases.tostring(),
+                  quals.tolist(),
+                  ref_positions.tolist(),
+                  read_positions.tolist(),
+                 )
     return columns
 
 def ref_dict_from_mapping(mapping):
     ''' Build a dictionary mapping reference positions to base identities from
     the cigar and MD tag of a mapping.
     '''
-    alignment = produce_alignment(mapping)
-    ref_dict = {}
-    for ref_char, _, _, ref_position, _ in alignment:
-        if ref_char == '-':
-            continue
-
-        if ref_position in ref_dict:
-            # A ref_position shouldn't appear more than once
-            raise ValueError(mapping)
+    ops, ref_positions, _, ref_bases, _, _ = alignment_arrays(mapping)
+    not_inserted = (ops != BAM_CINS)
+    ref_positions = ref_positions[not_inserted].tolist()
+    ref_dict = dict(zip(ref_positions, ref_bases[not_inserted].tostring()))
 
-        ref_dict[ref_position] = ref_char
+    if len(ref_dict) != len(ref_positions):
+        # A ref_position shouldn't appear more than once
+        raise ValueError(mapping)
 
     return ref_dict
 
@@ -679,72 +739,55 @@ def merge_ref_dicts(first_dict, second_dict):
 
 def alignment_to_MD_string(ref_aligned, read_aligned):
     ''' Produce an MD string from an alignment. '''
-    # Mark all blocks of matching with numbers, all deletion bases with '^*0', and all mismatch bases.
-    MD_list = []
-    current_match_length = 0
-    for ref_char, read_char in izip(ref_aligned, read_aligned):
-        if ref_char == read_char:
-            current_match_length += 1
-        elif ref_char != '-':
-            if current_match_length > 0:
-                MD_list.append(current_match_length)
-                current_match_length = 0
-
-            if read_char == '-':
-                MD_list.append('^{0}'.format(ref_char))
-                MD_list.append(0)
-            else:
-                MD_list.append(ref_char)
-    
-    if current_match_length > 0:
-        MD_list.append(current_match_length)
-
-    # Remove all zeros that aren't a deletion followed by a mismatch
-    reduced_MD_list = []
-    for i in range(len(MD_list)):
-        if isinstance(MD_list[i], int):
-            if MD_list[i] > 0:
-                reduced_MD_list.append(MD_list[i])
-            elif 0 < i < len(MD_list) - 1:
-                if isinstance(MD_list[i - 1], str) and isinstance(MD_list[i + 1], str) and MD_list[i - 1][0] == '^' and MD_list[i + 1][0] != '^':
-                    reduced_MD_list.append(MD_list[i])
-        else:
-            reduced_MD_list.append(MD_list[i])
-    
-    # Collapse all deletions.
-    collapsed_MD_list = [reduced_MD_list[0]]
-    for i in range(1, len(reduced_MD_list)):
-        if isinstance(collapsed_MD_list[-1], str) and collapsed_MD_list[-1][0] == '^' and \
-           isinstance(reduced_MD_list[i], str) and reduced_MD_list[i][0] == '^':
-            
-            collapsed_MD_list[-1] += reduced_MD_list[i][1]
-        else:
-            collapsed_MD_list.append(reduced_MD_list[i])
-
-    # The standard calls for a number to start and to end, zero if necessary.
-    if isinstance(collapsed_MD_list[0], str):
-        collapsed_MD_list.insert(0, 0)
-    if isinstance(collapsed_MD_list[-1], str):
-        collapsed_MD_list.append(0)
-    
-    MD_string = ''.join(map(str, collapsed_MD_list))
-    return ''.join(map(str, collapsed_MD_list))
+    return sam_cython.alignment_to_MD_string(''.join(ref_aligned), ''.join(read_aligned))
 
-def line_groups(sam_file_name, key):
+def line_groups(sam_file_name, key, **group_kwargs):
     ''' Yields (key value, list of consecutive lines from sam_file_name
-        that are all transormed to key value).
+        that are all transormed to key value). group_kwargs (max_group_size,
+        overflow, stats) are passed to utilities.group_by.
     '''
     sam_file = open_to_reads(sam_file_name)
-    groups = utilities.group_by(sam_file, key)
+    groups = utilities.group_by(sam_file, key, **group_kwargs)
     return groups
 
-def sort(input_file_name, output_file_name):
+def coordinate_key(line, ref_order=None):
+    ''' Returns a key that sorts SAM lines by (RNAME, POS). If ref_order (a
+        dictionary from RNAME to index) is given, references are ordered by it,
+        otherwise lexicographically. Unmapped lines sort last.
+    '''
+    qname, flag, rname, pos, _ = line.split('\t', 4)
+    if ref_order is None:
+        ref_key = (rname == '*', rname)
+    else:
+        ref_key = ref_order.get(rname, len(ref_order))
+    return ref_key, int(pos)
+
+def get_ref_order(header_lines):
+    ''' Returns a dictionary from RNAME to its index among the @SQ lines in
+        header_lines.
+    '''
+    sq_lines = [line for line in header_lines if line.startswith('@SQ')]
+    ref_order = {}
+    for i, line in enumerate(sq_lines):
+        fields = dict(field.split(':', 1) for field in line.strip().split('\t')[1:])
+        ref_order[fields['SN']] = i
+    return ref_order
+
+def sort(input_file_name, output_file_name, by_coordinate=False, **external_sort_kwargs):
+    ''' Sorts the read lines in input_file_name lexicographically or, if
+        by_coordinate, by (RNAME, POS) in @SQ order. Extra keyword arguments
+        are passed along to external_sort.external_sort.
+    '''
     header_lines, read_lines = separate_header_and_read_lines(input_file_name)
+    if by_coordinate:
+        ref_order = get_ref_order(header_lines)
+        external_sort_kwargs['key'] = partial(coordinate_key, ref_order=ref_order)
+
     with open(output_file_name, 'w') as output_file:
         for header_line in header_lines:
             output_file.write(header_line)
         
-        external_sort.external_sort(read_lines, output_file)
+        external_sort.external_sort(read_lines, output_file, **external_sort_kwargs)
     
 def sort_bam(input_file_name, output_file_name, by_name=False, num_threads=1):
     root, ext = os.path.splitext(output_file_name)
@@ -775,18 +818,8 @@ def merge_sorted_bam_files(input_file_names, merged_file_name, by_name=False):
 def sam_to_sorted_bam(sam_file_name, bam_file_name):
     view_command = ['samtools', 'view', '-ubh', sam_file_name]
     sort_command = ['samtools', 'sort', '-T', bam_file_name, '-o', bam_file_name, '-']
-    bam_process = subprocess.Popen(view_command,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                  )
-    sort_process = subprocess.Popen(sort_command,
-                                    stdin=bam_process.stdout,
-                                    stderr=subprocess.PIPE,
-                                   )
-    sort_process.communicate()
-    _, err_output = bam_process.communicate()
-    if bam_process.returncode:
-        raise RuntimeError(err_output)
+    # Raises a PipelineError, a RuntimeError, if either stage fails.
+    pipeline.Pipeline([view_command, sort_command], names=['samtools view', 'samtools sort']).start().wait()
     
     index_bam(bam_file_name)
 
@@ -803,32 +836,279 @@ def index_bam(bam_file_name):
     samtools_command = ['samtools', 'index', bam_file_name]
     subprocess.check_call(samtools_command)
 
-def get_length_counts(bam_file_name, only_primary=True, only_unique=False):
-    bam_file = pysam.Samfile(bam_file_name)
-    if only_unique:
-        qlen_counts = Counter(ar.qlen for ar in bam_file if ar.mapping_quality == 50)
-    elif only_primary:
-        qlen_counts = Counter(ar.qlen for ar in bam_file if not ar.is_unmapped and not ar.is_secondary)
+class Histogram(object):
+    ''' Counts of integer values. Values in a window of at most max_dense
+    consecutive values are counted in a NumPy array, where counts[i] is the
+    count of value offset + i, and the rest in the outliers Counter, so that a
+    few extreme values (e.g. TLENs of chimeric pairs) don't allocate an array
+    spanning them. The window starts around the median of the first values
+    added and grows while it stays within max_dense.
+    '''
+    def __init__(self, max_dense=2**16):
+        self.max_dense = max_dense
+        self.offset = 0
+        self.counts = np.zeros(0, int)
+        self.outliers = Counter()
+
+    def _fit(self, values):
+        ''' Grows the window to cover as many of values as it can. '''
+        if len(self.counts) == 0:
+            center = int(np.median(values))
+            self.offset = center
+            self.counts = np.zeros(1, int)
+
+        end = self.offset + len(self.counts)
+        outside = values[(values < self.offset) | (values >= end)]
+        fits = outside[(outside >= end - self.max_dense) & (outside < self.offset + self.max_dense)]
+        if len(fits) == 0:
+            return
+
+        new_offset = min(self.offset, int(fits.min()))
+        new_end = max(end, int(fits.max()) + 1)
+        # If both directions can't fit, favor the smaller values.
+        new_end = min(new_end, new_offset + self.max_dense)
+        counts = np.zeros(new_end - new_offset, int)
+        start = self.offset - new_offset
+        counts[start:start + len(self.counts)] = self.counts
+        self.offset = new_offset
+        self.counts = counts
+
+    def _add(self, values, weights=None):
+        self._fit(values)
+        end = self.offset + len(self.counts)
+        in_window = (values >= self.offset) & (values < end)
+
+        dense = values[in_window]
+        if len(dense) > 0:
+            # Only count over the span of this batch, not the whole window.
+            low = dense.min()
+            dense_weights = weights[in_window] if weights is not None else None
+            batch_counts = np.bincount(dense - low, weights=dense_weights).astype(int)
+            start = low - self.offset
+            self.counts[start:start + len(batch_counts)] += batch_counts
+
+        if not in_window.all():
+            if weights is None:
+                outliers, outlier_counts = np.unique(values[~in_window], return_counts=True)
+            else:
+                outliers, outlier_counts = values[~in_window], weights[~in_window]
+            for value, count in zip(outliers.tolist(), outlier_counts.tolist()):
+                self.outliers[value] += count
+
+    def add_values(self, values):
+        values = np.asarray(values, int)
+        if len(values) == 0:
+            return
+        self._add(values)
+
+    def __iadd__(self, other):
+        nonzero, = np.nonzero(other.counts)
+        values = np.concatenate([nonzero + other.offset, np.array(other.outliers.keys(), int)])
+        weights = np.concatenate([other.counts[nonzero], np.array(other.outliers.values(), int)])
+        if len(values) > 0:
+            self._add(values, weights)
+        return self
+
+    def to_counter(self):
+        nonzero, = np.nonzero(self.counts)
+        counter = Counter({int(self.offset + i): int(self.counts[i]) for i in nonzero})
+        counter.update(self.outliers)
+        return counter
+
+    def to_array(self):
+        ''' Returns an array of the counts of 0, 1, ..., max value, discarding
+        negative values, like utilities.counts_to_array.
+        '''
+        nonnegative = {v: c for v, c in self.to_counter().items() if v >= 0}
+        if not nonnegative:
+            return np.array([0])
+        array = np.zeros(max(nonnegative) + 1, int)
+        values = np.array(nonnegative.keys(), int)
+        array[values] = nonnegative.values()
+        return array
+
+# Maps collector name to (value, include), where value(alignment) is the int
+# to count and include(alignment), if not None, picks which alignments count.
+collectors = {}
+
+def register_collector(name, value, include=None):
+    ''' Registers a statistic that scan_bam can collect by name. Since workers
+    look collectors up by name, scans with num_processes > 1 can use any
+    collector registered before the scan starts.
+    '''
+    collectors[name] = (value, include)
+
+def _is_primary(alignment):
+    return not alignment.is_unmapped and not alignment.is_secondary
+
+def _is_unique(alignment):
+    return alignment.mapping_quality == 50
+
+register_collector('length', lambda ar: ar.qlen)
+register_collector('length_primary', lambda ar: ar.qlen, _is_primary)
+register_collector('length_unique', lambda ar: ar.qlen, _is_unique)
+register_collector('tlen', lambda ar: ar.tlen)
+register_collector('tlen_primary', lambda ar: ar.tlen, _is_primary)
+register_collector('tlen_unique', lambda ar: ar.tlen, _is_unique)
+register_collector('mapq', lambda ar: ar.mapq)
+
+def _scan_alignments(collector_names, alignments, batch_size=100000):
+    histograms = {name: Histogram() for name in collector_names}
+    values = {name: [] for name in collector_names}
+    # (include, value, append) for each collector, looked up once.
+    steps = [(collectors[name][1], collectors[name][0], values[name].append)
+             for name in collector_names]
+
+    def flush():
+        for name in collector_names:
+            histograms[name].add_values(values[name])
+            del values[name][:]
+
+    for i, alignment in enumerate(alignments):
+        for include, value, append in steps:
+            if include is None or include(alignment):
+                append(value(alignment))
+
+        if i % batch_size == batch_size - 1:
+            flush()
+
+    flush()
+    return histograms
+
+def _add_histograms(first, second):
+    for name in second:
+        first[name] += second[name]
+    return first
+
+def scan_bam(bam_file_name, collector_names, num_processes=1):
+    ''' Fills a Histogram for each of the registered collectors in
+    collector_names in a single pass over bam_file_name. Returns a dictionary
+    from collector name to Histogram. If num_processes > 1, bam_file_name must
+    be indexed and regions are scanned in parallel with map_regions.
+    '''
+    scan = partial(_scan_alignments, collector_names)
+    if num_processes == 1:
+        with pysam.AlignmentFile(bam_file_name) as bam_file:
+            histograms = scan(bam_file.fetch(until_eof=True))
     else:
-        qlen_counts = Counter(ar.qlen for ar in bam_file)
-    
-    return qlen_counts
+        histograms = map_regions(bam_file_name,
+                                 scan,
+                                 _add_histograms,
+                                 workers=num_processes,
+                                 include_unplaced=True,
+                                )
+        if histograms is None:
+            histograms = {name: Histogram() for name in collector_names}
+
+    return histograms
+
+def get_regions(bam_file_name, chunk_bp=10**7, reads_per_region=None):
+    ''' Returns a list of (reference name, start, end) regions that tile the
+    references of the indexed bam_file_name that have reads. No region is
+    longer than chunk_bp. If reads_per_region is given, references are also
+    split evenly into enough regions that each has about that many reads,
+    going by the per-reference counts in the index.
+    '''
+    regions = []
+    with pysam.AlignmentFile(bam_file_name) as bam_file:
+        lengths = dict(zip(bam_file.references, bam_file.lengths))
+        for stats in bam_file.get_index_statistics():
+            if stats.total == 0:
+                continue
+
+            length = lengths[stats.contig]
+            num_regions = -(-length // chunk_bp)
+            if reads_per_region is not None:
+                num_regions = max(num_regions, -(-stats.total // reads_per_region))
+            num_regions = min(num_regions, length)
+
+            boundaries = [length * i // num_regions for i in range(num_regions + 1)]
+            for start, end in zip(boundaries, boundaries[1:]):
+                regions.append((stats.contig, start, end))
+
+    return regions
+
+def _region_alignments(bam_file, region):
+    ''' Yields the alignments in bam_file that start in region, so that
+    alignments spanning a boundary between regions belong to exactly one.
+    '''
+    if region == '*':
+        for alignment in bam_file.fetch('*'):
+            yield alignment
+    else:
+        contig, start, end = region
+        for alignment in bam_file.fetch(contig, start, end):
+            if alignment.reference_start >= start:
+                yield alignment
 
-def get_tlen_counts(bam_file_name, only_primary=True, only_unique=False):
-    bam_file = pysam.Samfile(bam_file_name)
+def _apply_to_region(bam_file_name, func, region):
+    with pysam.AlignmentFile(bam_file_name) as bam_file:
+        return func(_region_alignments(bam_file, region))
+
+def _reduce(combine, results):
+    results = iter(results)
+    try:
+        combined = next(results)
+    except StopIteration:
+        return None
+    for result in results:
+        combined = combine(combined, result)
+    return combined
+
+def map_regions(bam_file_name,
+                func,
+                combine,
+                workers=1,
+                chunk_bp=10**7,
+                regions_per_worker=4,
+                include_unplaced=False,
+               ):
+    ''' Applies func to an iterator over the alignments in each region of the
+    indexed bam_file_name from get_regions and returns the results reduced by
+    combine, in region order. Regions are sized so that there are about
+    regions_per_worker times as many as workers, each with about the same
+    number of reads. Each alignment is seen in exactly one region, the one its
+    reference_start is in. If include_unplaced, the unmapped reads that have
+    no reference are passed to func as a final region.
+    With workers > 1, regions are processed in a process pool, so func and
+    its results must be picklable.
+    Returns None if there are no regions.
+    '''
+    with pysam.AlignmentFile(bam_file_name) as bam_file:
+        total = sum(stats.total for stats in bam_file.get_index_statistics())
+
+    reads_per_region = max(1, total // (workers * regions_per_worker))
+    regions = get_regions(bam_file_name, chunk_bp, reads_per_region)
+    if include_unplaced:
+        regions.append('*')
+
+    apply_to_region = partial(_apply_to_region, bam_file_name, func)
+
+    if workers == 1:
+        return _reduce(combine, imap(apply_to_region, regions))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return _reduce(combine, pool.imap(apply_to_region, regions))
+    finally:
+        pool.close()
+        pool.join()
+
+def _counts(bam_file_name, name, only_primary, only_unique):
     if only_unique:
-        tlen_counts = Counter(ar.tlen for ar in bam_file if ar.mapping_quality == 50)
+        name += '_unique'
     elif only_primary:
-        tlen_counts = Counter(ar.tlen for ar in bam_file if not ar.is_unmapped and not ar.is_secondary)
-    else:
-        tlen_counts = Counter(ar.tlen for ar in bam_file)
-    
-    return tlen_counts
+        name += '_primary'
+    return scan_bam(bam_file_name, [name])[name].to_counter()
+
+def get_length_counts(bam_file_name, only_primary=True, only_unique=False):
+    return _counts(bam_file_name, 'length', only_primary, only_unique)
+
+def get_tlen_counts(bam_file_name, only_primary=True, only_unique=False):
+    return _counts(bam_file_name, 'tlen', only_primary, only_unique)
 
 def get_mapq_counts(bam_file_name):
-    bam_file = pysam.Samfile(bam_file_name)
-    mapq_counts = Counter(ar.mapq for ar in bam_file)
-    return mapq_counts
+    return scan_bam(bam_file_name, ['mapq'])['mapq'].to_counter()
 
 def mapping_to_Read(mapping):
     if mapping.is_unmapped or not mapping.is_reverse:
@@ -875,9 +1155,7 @@ class AlignmentSorter(object):
                              '-o', self.output_file_name,
                              self.fifo.file_name,
                             ])
-        self.sort_process = subprocess.Popen(sort_command,
-                                             stderr=subprocess.PIPE,
-                                            )
+        self.sort_process = pipeline.Pipeline([sort_command], names=['samtools sort']).start()
 
         self.sam_file = pysam.Samfile(self.fifo.file_name,
                                       'wbu',
@@ -891,12 +1169,12 @@ class AlignmentSorter(object):
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
         self.sam_file.close()
-        _, err_output = self.sort_process.communicate()
-        self.dev_null.close()
-        self.fifo.__exit__(exception_type, exception_value, exception_traceback)
-        
-        if self.sort_process.returncode:
-            raise RuntimeError(err_output)
+        try:
+            # Raises a PipelineError, a RuntimeError, if the sort failed.
+            self.sort_process.wait()
+        finally:
+            self.dev_null.close()
+            self.fifo.__exit__(exception_type, exception_value, exception_traceback)
 
         if not self.by_name:
             index_bam(self.output_file_name)
@@ -904,6 +1182,160 @@ class AlignmentSorter(object):
     def write(self, alignment):
         self.sam_file.write(alignment)
 
+def _coordinate_sort_key(alignment):
+    ''' Sorts by reference position with alignments that have no reference
+        last, like samtools sort.
+    '''
+    tid = alignment.reference_id
+    if tid < 0:
+        tid = sys.maxint
+    return tid, alignment.reference_start
+
+def _name_sort_key(alignment):
+    return alignment.query_name, alignment.is_read2
+
+def _estimated_size(alignment):
+    ''' Rough number of bytes an AlignedSegment occupies in memory. '''
+    return 2 * alignment.query_length + 250
+
+class BufferedAlignmentSorter(object):
+    ''' Context manager with the same interface as AlignmentSorter that sorts
+    in process instead of through samtools. AlignedSegments are buffered up to
+    roughly memory_budget bytes, sorted, and spilled to uncompressed temporary
+    BAM runs in scratch_dir. On exit, the runs are merged into a BAM compressed
+    by num_threads threads, which is then indexed if sorted by coordinate.
+    No more than fan_in runs are open at once; if there are more, they are
+    first merged into fewer, longer runs in as many passes as needed.
+    Sorting by name orders by (query_name, is_read2) rather than samtools' natural
+    order, matching merge_by_name.
+    '''
+    def __init__(self,
+                 reference_names,
+                 reference_lengths,
+                 output_file_name,
+                 by_name=False,
+                 memory_budget=2 * 1024**3,
+                 num_threads=1,
+                 scratch_dir=None,
+                 fan_in=64,
+                ):
+        if fan_in < 2:
+            raise ValueError('fan_in must be at least 2', fan_in)
+
+        self.reference_names = reference_names
+        self.reference_lengths = reference_lengths
+        self.output_file_name = output_file_name
+        self.by_name = by_name
+        self.memory_budget = memory_budget
+        self.num_threads = num_threads
+        self.scratch_dir = scratch_dir
+        self.fan_in = fan_in
+
+        if by_name:
+            self.key = _name_sort_key
+        else:
+            self.key = _coordinate_sort_key
+
+        tids = {name: tid for tid, name in enumerate(reference_names)}
+        self.get_tid = lambda name: tids.get(name, -1)
+
+    def __enter__(self):
+        self.temp_dir = tempfile.mkdtemp(dir=self.scratch_dir)
+        self.run_file_names = []
+        self.num_runs = 0
+        self.buffer = []
+        self.buffer_size = 0
+        return self
+
+    def _open(self, file_name, mode, **kwargs):
+        return pysam.AlignmentFile(file_name,
+                                   mode,
+                                   reference_names=self.reference_names,
+                                   reference_lengths=self.reference_lengths,
+                                   **kwargs)
+
+    def _write_run(self, alignments):
+        run_file_name = '{0}/run_{1}.bam'.format(self.temp_dir, self.num_runs)
+        self.num_runs += 1
+        with self._open(run_file_name, 'wbu') as run_file:
+            for alignment in alignments:
+                run_file.write(alignment)
+
+        return run_file_name
+
+    def _merge_runs(self, run_file_names):
+        ''' Returns the merged alignments from run_file_names, which are
+            closed when the returned generator is exhausted or closed.
+        '''
+        run_files = [pysam.AlignmentFile(fn, 'rb') for fn in run_file_names]
+        try:
+            for alignment in external_sort.merge(run_files, key=self.key):
+                yield alignment
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+    def _merge_group(self, run_file_names):
+        ''' Merges run_file_names into a new run, removes them, and returns
+            the new run's name.
+        '''
+        merged_file_name = self._write_run(self._merge_runs(run_file_names))
+        for fn in run_file_names:
+            os.remove(fn)
+        return merged_file_name
+
+    def _spill(self):
+        self.buffer.sort(key=self.key)
+        self.run_file_names.append(self._write_run(self.buffer))
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, alignment):
+        self.buffer.append(alignment)
+        self.buffer_size += _estimated_size(alignment)
+        if self.buffer_size >= self.memory_budget:
+            self._spill()
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        try:
+            if exception_type is None:
+                self._merge()
+        finally:
+            shutil.rmtree(self.temp_dir)
+
+    def _merge(self):
+        self.buffer.sort(key=self.key)
+
+        # Consecutive groups of runs are merged, so runs stay in the order
+        # they were written and ties keep their input order. The in-memory
+        # buffer takes one of the fan_in slots in the final merge.
+        run_file_names = self.run_file_names
+        while len(run_file_names) + 1 > self.fan_in:
+            excess = len(run_file_names) + 1 - self.fan_in
+            if excess < self.fan_in:
+                # Merging just the first excess + 1 runs is enough, so the
+                # rest aren't rewritten.
+                run_file_names = [self._merge_group(run_file_names[:excess + 1])] + run_file_names[excess + 1:]
+            else:
+                run_file_names = [self._merge_group(run_file_names[start:start + self.fan_in])
+                                  for start in range(0, len(run_file_names), self.fan_in)]
+        self.run_file_names = run_file_names
+
+        run_files = [pysam.AlignmentFile(fn, 'rb') for fn in run_file_names]
+        try:
+            runs = run_files + [self.buffer]
+            with self._open(self.output_file_name, 'wb', threads=self.num_threads) as output_file:
+                for alignment in external_sort.merge(runs, key=self.key):
+                    output_file.write(alignment)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+        self.buffer = []
+
+        if not self.by_name:
+            pysam.index(self.output_file_name)
+
 def merge_by_name(*mapping_iterators):
     ''' Merges iterators over mappings that are sorted by name. Use case is to
     combine accepted_hits.bam and unmapped.bam from tophat output.
@@ -929,3 +1361,65 @@ def aligned_pairs_exclude_soft_clipping(mapping):
         if last_op == BAM_CSOFT_CLIP:
             aligned_pairs = aligned_pairs[:-last_length]
     return aligned_pairs
+
+def _matched_columns(mapping):
+    ''' Returns arrays of the read and reference positions of mapping's M, =
+        and X columns.
+    '''
+    ops, read_positions, ref_positions = sam_cython.expand_cigar(mapping.cigartuples, mapping.reference_start)
+    matched = (ops == BAM_CMATCH) | (ops == BAM_CEQUAL) | (ops == BAM_CDIFF)
+    return read_positions[matched], ref_positions[matched]
+
+def mismatch_positions(mapping, ref_start, ref_bases):
+    ''' Returns arrays of the read and reference positions at which mapping's
+        read bases differ from ref_bases, a uint8 array of upper case reference
+        bases starting at ref_start and covering the mapping.
+    '''
+    return group_mismatch_positions([mapping], lambda tid, start, end: ref_bases[start - ref_start:end - ref_start])[0]
+
+def group_mismatch_positions(mappings, extent_fetcher, max_span=10**5):
+    ''' Like mismatch_positions for every mapping in mappings (e.g. all of a
+        read's mappings) at once. extent_fetcher(tid, start, end) returns the
+        upper case reference bases from start to end as a uint8 array (see
+        genomes.build_extent_fetcher). Mappings on the same reference within
+        max_span of each other share one fetch and all columns are compared
+        together. Returns a (read_positions, ref_positions) pair for each
+        mapping.
+    '''
+    if not mappings:
+        return []
+
+    columns = [_matched_columns(mapping) for mapping in mappings]
+    read_bases = [np.frombuffer(mapping.query_sequence, np.uint8)[read_positions]
+                  for mapping, (read_positions, _) in zip(mappings, columns)]
+
+    by_tid = {}
+    for i, mapping in enumerate(mappings):
+        by_tid.setdefault(mapping.reference_id, []).append(i)
+
+    ref_bases = [None for _ in mappings]
+    for tid, indices in by_tid.items():
+        indices = sorted(indices, key=lambda i: mappings[i].reference_start)
+        # Sweep into clusters of mappings that are close enough to fetch
+        # together.
+        clusters = []
+        for i in indices:
+            start, end = mappings[i].reference_start, mappings[i].reference_end
+            if clusters and end - clusters[-1][0] <= max_span:
+                cluster_start, cluster_end, members = clusters[-1]
+                clusters[-1] = (cluster_start, max(cluster_end, end), members + [i])
+            else:
+                clusters.append((start, end, [i]))
+
+        for cluster_start, cluster_end, members in clusters:
+            extent = extent_fetcher(tid, cluster_start, cluster_end)
+            for i in members:
+                ref_bases[i] = extent[columns[i][1] - cluster_start]
+
+    lengths = [len(read_positions) for read_positions, _ in columns]
+    differ = np.concatenate(read_bases) != np.concatenate(ref_bases)
+    differs = np.split(differ, np.cumsum(lengths)[:-1])
+
+    mismatches = [(read_positions[d], ref_positions[d])
+                  for (read_positions, ref_positions), d in zip(columns, differs)]
+    return mismatches
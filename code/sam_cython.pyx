@@ -0,0 +1,455 @@
+import numpy as np
+cimport cython
+
+cdef int BAM_CMATCH = 0     # M
+cdef int BAM_CINS = 1       # I
+cdef int BAM_CDEL = 2       # D
+cdef int BAM_CREF_SKIP = 3  # N
+cdef int BAM_CSOFT_CLIP = 4 # S
+cdef int BAM_CEQUAL = 7     # =
+cdef int BAM_CDIFF = 8      # X
+
+cdef char GAP_CHAR = '-'
+cdef char EQUAL_CHAR = '='
+
+cdef inline bint _is_column_op(int op, bint include_skips):
+    return (op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF or
+            op == BAM_CINS or op == BAM_CDEL or
+            (include_skips and op == BAM_CREF_SKIP))
+
+cdef _expand_cigar(cigar, long ref_start, long read_start, bint include_skips):
+    cdef long num_columns = 0
+    cdef long column = 0
+    cdef long ref_pos = ref_start
+    cdef long read_pos = read_start
+    cdef long i, length
+    cdef int op
+
+    for op, length in cigar:
+        if _is_column_op(op, include_skips):
+            num_columns += length
+
+    ops = np.empty(num_columns, int)
+    read_positions = np.empty(num_columns, int)
+    ref_positions = np.empty(num_columns, int)
+    cdef long[::1] ops_view = ops
+    cdef long[::1] read_view = read_positions
+    cdef long[::1] ref_view = ref_positions
+
+    for op, length in cigar:
+        if _is_column_op(op, include_skips):
+            for i in range(length):
+                ops_view[column] = op
+                read_view[column] = read_pos
+                ref_view[column] = ref_pos
+                column += 1
+
+                if op != BAM_CDEL and op != BAM_CREF_SKIP:
+                    read_pos += 1
+                if op != BAM_CINS:
+                    ref_pos += 1
+
+        elif op == BAM_CSOFT_CLIP:
+            read_pos += length
+
+        elif op == BAM_CREF_SKIP:
+            ref_pos += length
+
+    return ops, read_positions, ref_positions
+
+def expand_cigar(cigar, long ref_start, long read_start=0):
+    ''' Expands pysam-style cigar into one column per M, =, X, I, D, or N
+        operation. Returns arrays (ops, read_positions, ref_positions) holding
+        the read and reference cursors at each column. For a column that
+        doesn't consume a base from one of the sequences, the cursor is the
+        position of the next base in that sequence. Soft clipping advances the
+        read cursor without producing columns. Hard clipping and padding are
+        ignored.
+    '''
+    return _expand_cigar(cigar, ref_start, read_start, True)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def columns_to_aligned_pairs(long[::1] ops,
+                             long[::1] read_positions,
+                             long[::1] ref_positions,
+                             skip_read_value='N',
+                             bint backwards=False,
+                            ):
+    ''' Converts the arrays produced by expand_cigar into a list of
+        (read_pos, ref_pos) tuples, with None marking a gap and skip_read_value
+        in place of the read position for N columns. If backwards, the list
+        runs from the last column to the first.
+    '''
+    cdef long num_columns = ops.shape[0]
+    cdef long i, column
+    cdef long op
+
+    aligned_pairs = []
+    for i in range(num_columns):
+        if backwards:
+            column = num_columns - 1 - i
+        else:
+            column = i
+
+        op = ops[column]
+        if op == BAM_CDEL:
+            aligned_pairs.append((None, ref_positions[column]))
+        elif op == BAM_CREF_SKIP:
+            aligned_pairs.append((skip_read_value, ref_positions[column]))
+        elif op == BAM_CINS:
+            aligned_pairs.append((read_positions[column], None))
+        else:
+            aligned_pairs.append((read_positions[column], ref_positions[column]))
+
+    return aligned_pairs
+
+def expand_md(md_string):
+    ''' Converts an MD string into a uint8 array with one entry per reference
+        base it describes. The entry is ord('=') if the reference base is equal
+        to the read base, and the reference base otherwise. Equivalent to
+        md_string_to_ops_string.
+    '''
+    cdef bytes md = md_string
+    cdef const char *md_chars = md
+    cdef long md_length = len(md)
+    cdef long i, j, k, value
+    cdef long total = 0
+    cdef char c
+
+    # Tokenize into runs of digits and runs of capital letters. '^' is ignored
+    # entirely, and any other character ends the current token.
+    match_lengths = []
+    text_starts = []
+    text_ends = []
+    i = 0
+    while i < md_length:
+        c = md_chars[i]
+        if c >= '0' and c <= '9':
+            value = 0
+            while i < md_length and (md_chars[i] == '^' or (md_chars[i] >= '0' and md_chars[i] <= '9')):
+                if md_chars[i] != '^':
+                    value = value * 10 + (md_chars[i] - 48)
+                i += 1
+            match_lengths.append(value)
+        elif c >= 'A' and c <= 'Z':
+            text_starts.append(i)
+            while i < md_length and (md_chars[i] == '^' or (md_chars[i] >= 'A' and md_chars[i] <= 'Z')):
+                i += 1
+            text_ends.append(i)
+        else:
+            i += 1
+
+    # The standard calls for a number to start and end, zero if necessary,
+    # so after removing the initial number, there must be the same number of
+    # match_lengths and text_blocks.
+    if len(text_starts) != len(match_lengths) - 1:
+        raise ValueError(md_string)
+
+    for value in match_lengths:
+        total += value
+    for j in range(len(text_starts)):
+        for k in range(text_starts[j], text_ends[j]):
+            if md_chars[k] != '^':
+                total += 1
+
+    ref_ops = np.empty(total, np.uint8)
+    cdef unsigned char[::1] ref_ops_view = ref_ops
+    cdef long position = 0
+
+    for k in range(match_lengths[0]):
+        ref_ops_view[position] = EQUAL_CHAR
+        position += 1
+
+    for j in range(len(text_starts)):
+        for k in range(text_starts[j], text_ends[j]):
+            if md_chars[k] != '^':
+                ref_ops_view[position] = md_chars[k]
+                position += 1
+        for k in range(match_lengths[j + 1]):
+            ref_ops_view[position] = EQUAL_CHAR
+            position += 1
+
+    return ref_ops
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def alignment_arrays(cigar, md_string, long ref_start, bytes seq, bytes qual):
+    ''' Expands a mapping's cigar and MD string into parallel arrays
+        (ops, ref_positions, read_positions, ref_bases, read_bases, quals)
+        with one entry per M, =, X, I, or D column. Gap columns have ord('-')
+        as the missing base, a qual of 0 for deletions, and positions as
+        described in expand_cigar.
+    '''
+    ops, read_positions, ref_positions = _expand_cigar(cigar, ref_start, 0, False)
+    ref_ops = expand_md(md_string)
+
+    cdef long num_columns = len(ops)
+    cdef long[::1] ops_view = ops
+    cdef long[::1] read_view = read_positions
+    cdef unsigned char[::1] ref_ops_view = ref_ops
+    cdef long num_ref_ops = len(ref_ops)
+    cdef const char *seq_chars = seq
+    cdef const char *qual_chars = qual
+    cdef long seq_length = len(seq)
+    cdef long qual_length = len(qual)
+
+    ref_bases = np.empty(num_columns, np.uint8)
+    read_bases = np.empty(num_columns, np.uint8)
+    quals = np.empty(num_columns, int)
+    cdef unsigned char[::1] ref_bases_view = ref_bases
+    cdef unsigned char[::1] read_bases_view = read_bases
+    cdef long[::1] quals_view = quals
+
+    cdef long column, read_pos
+    cdef long ref_op_index = 0
+    cdef int op
+    cdef unsigned char read_char, ref_op
+
+    for column in range(num_columns):
+        op = ops_view[column]
+        read_pos = read_view[column]
+
+        if op == BAM_CDEL:
+            if ref_op_index >= num_ref_ops:
+                raise ValueError('MD string too short for cigar', md_string, cigar)
+            ref_bases_view[column] = ref_ops_view[ref_op_index]
+            ref_op_index += 1
+            read_bases_view[column] = GAP_CHAR
+            quals_view[column] = 0
+        else:
+            if read_pos >= seq_length or read_pos >= qual_length:
+                raise IndexError('cigar consumes more bases than the read has', cigar)
+            read_char = seq_chars[read_pos]
+            read_bases_view[column] = read_char
+            quals_view[column] = qual_chars[read_pos] - 33
+
+            if op == BAM_CINS:
+                ref_bases_view[column] = GAP_CHAR
+            else:
+                if ref_op_index >= num_ref_ops:
+                    raise ValueError('MD string too short for cigar', md_string, cigar)
+                ref_op = ref_ops_view[ref_op_index]
+                ref_op_index += 1
+                if ref_op == EQUAL_CHAR:
+                    ref_bases_view[column] = read_char
+                else:
+                    ref_bases_view[column] = ref_op
+
+    return ops, ref_positions, read_positions, ref_bases, read_bases, quals
+
+def aligned_pairs_to_cigar_blocks(aligned_pairs):
+    ''' Run-length encodes the ops implied by aligned_pairs as in
+        sam.aligned_pairs_to_cigar, without a guide.
+    '''
+    cdef int op
+    cdef int current_op = -1
+    cdef long current_length = 0
+
+    cigar = []
+    for read, ref in aligned_pairs:
+        if read is None or read == '-':
+            op = BAM_CDEL
+        elif read == 'N':
+            op = BAM_CREF_SKIP
+        elif ref is None or ref == '-':
+            op = BAM_CINS
+        else:
+            op = BAM_CMATCH
+
+        if op == current_op:
+            current_length += 1
+        else:
+            if current_length > 0:
+                cigar.append((current_op, current_length))
+            current_op = op
+            current_length = 1
+
+    if current_length > 0:
+        cigar.append((current_op, current_length))
+
+    return cigar
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def ops_to_cigar_blocks(long[::1] ops):
+    ''' Run-length encodes an array of ops (e.g. from expand_cigar) back into
+        pysam-style cigar blocks.
+    '''
+    cdef long i
+    cdef long num_ops = ops.shape[0]
+    cdef long current_op = -1
+    cdef long current_length = 0
+
+    cigar = []
+    for i in range(num_ops):
+        if ops[i] == current_op:
+            current_length += 1
+        else:
+            if current_length > 0:
+                cigar.append((current_op, current_length))
+            current_op = ops[i]
+            current_length = 1
+
+    if current_length > 0:
+        cigar.append((current_op, current_length))
+
+    return cigar
+
+def alignment_to_MD_string(bytes ref_aligned, bytes read_aligned):
+    ''' Produce an MD string from an alignment given as two equal-length
+        strings (or byte strings of arrays of base codes).
+    '''
+    cdef const char *ref_chars = ref_aligned
+    cdef const char *read_chars = read_aligned
+    cdef long length = min(len(ref_aligned), len(read_aligned))
+    cdef long i
+    cdef long current_match_length = 0
+    cdef char ref_char, read_char
+
+    # Mark all blocks of matching with numbers, all deletion bases with '^*0', and all mismatch bases.
+    MD_list = []
+    for i in range(length):
+        ref_char = ref_chars[i]
+        read_char = read_chars[i]
+        if ref_char == read_char:
+            current_match_length += 1
+        elif ref_char != GAP_CHAR:
+            if current_match_length > 0:
+                MD_list.append(current_match_length)
+                current_match_length = 0
+
+            if read_char == GAP_CHAR:
+                MD_list.append('^' + chr(ref_char))
+                MD_list.append(0)
+            else:
+                MD_list.append(chr(ref_char))
+
+    if current_match_length > 0:
+        MD_list.append(current_match_length)
+
+    # Remove all zeros that aren't a deletion followed by a mismatch
+    reduced_MD_list = []
+    for i in range(len(MD_list)):
+        if isinstance(MD_list[i], (int, long)):
+            if MD_list[i] > 0:
+                reduced_MD_list.append(MD_list[i])
+            elif 0 < i < len(MD_list) - 1:
+                if isinstance(MD_list[i - 1], str) and isinstance(MD_list[i + 1], str) and MD_list[i - 1][0] == '^' and MD_list[i + 1][0] != '^':
+                    reduced_MD_list.append(MD_list[i])
+        else:
+            reduced_MD_list.append(MD_list[i])
+
+    # Collapse all deletions.
+    collapsed_MD_list = [reduced_MD_list[0]]
+    for i in range(1, len(reduced_MD_list)):
+        if isinstance(collapsed_MD_list[-1], str) and collapsed_MD_list[-1][0] == '^' and \
+           isinstance(reduced_MD_list[i], str) and reduced_MD_list[i][0] == '^':
+
+            collapsed_MD_list[-1] += reduced_MD_list[i][1]
+        else:
+            collapsed_MD_list.append(reduced_MD_list[i])
+
+    # The standard calls for a number to start and to end, zero if necessary.
+    if isinstance(collapsed_MD_list[0], str):
+        collapsed_MD_list.insert(0, 0)
+    if isinstance(collapsed_MD_list[-1], str):
+        collapsed_MD_list.append(0)
+
+    return ''.join(map(str, collapsed_MD_list))
+
+def split_cigar_at_ref(cigar, long ref_start, long boundary, bint insertions_after):
+    ''' Splits the columns of cigar (starting at ref_start) in two at the first
+        non-insertion column whose ref position is >= boundary. Insertion
+        columns immediately before that column go with the second part if
+        insertions_after, and with the first part otherwise.
+        Returns (first_cigar, second_cigar, first_read_nucs, first_ref_nucs,
+        second_read_nucs, second_ref_nucs), with each cigar run-length encoded
+        as by ops_to_cigar_blocks(sam.cigar_to_columns(...)[0]), i.e. with =
+        and X reported as M. cigar must only contain M, =, X, I, D and N.
+    '''
+    cdef long ref_pos = ref_start
+    cdef long first_read_nucs = 0
+    cdef long first_ref_nucs = 0
+    cdef long second_read_nucs = 0
+    cdef long second_ref_nucs = 0
+    cdef long length, first_length
+    cdef int op
+    cdef bint split_found = False
+
+    first = []
+    second = []
+    # Insertion columns that can't be assigned until the split is found.
+    cdef long pending_insertion = 0
+
+    for op, length in cigar:
+        if length == 0:
+            continue
+
+        if op == BAM_CEQUAL or op == BAM_CDIFF:
+            op = BAM_CMATCH
+
+        if split_found:
+            _append_block(second, op, length)
+            if op != BAM_CDEL and op != BAM_CREF_SKIP:
+                second_read_nucs += length
+            if op != BAM_CINS:
+                second_ref_nucs += length
+            continue
+
+        if op == BAM_CINS:
+            pending_insertion += length
+            continue
+
+        if ref_pos + length <= boundary:
+            first_length = length
+        else:
+            first_length = max(0, boundary - ref_pos)
+            split_found = True
+
+        if first_length > 0 or not split_found:
+            # Pending insertions come before a column that is before the split.
+            if pending_insertion > 0:
+                _append_block(first, BAM_CINS, pending_insertion)
+                first_read_nucs += pending_insertion
+                pending_insertion = 0
+            _append_block(first, op, first_length)
+            if op != BAM_CDEL and op != BAM_CREF_SKIP:
+                first_read_nucs += first_length
+            first_ref_nucs += first_length
+
+        if split_found:
+            if pending_insertion > 0:
+                if insertions_after:
+                    _append_block(second, BAM_CINS, pending_insertion)
+                    second_read_nucs += pending_insertion
+                else:
+                    _append_block(first, BAM_CINS, pending_insertion)
+                    first_read_nucs += pending_insertion
+                pending_insertion = 0
+
+            _append_block(second, op, length - first_length)
+            if op != BAM_CDEL and op != BAM_CREF_SKIP:
+                second_read_nucs += length - first_length
+            second_ref_nucs += length - first_length
+
+        ref_pos += length
+
+    if pending_insertion > 0:
+        # No column is at or past boundary, so these are trailing insertions.
+        if insertions_after:
+            _append_block(second, BAM_CINS, pending_insertion)
+            second_read_nucs += pending_insertion
+        else:
+            _append_block(first, BAM_CINS, pending_insertion)
+            first_read_nucs += pending_insertion
+
+    return first, second, first_read_nucs, first_ref_nucs, second_read_nucs, second_ref_nucs
+
+cdef _append_block(blocks, int op, long length):
+    if length == 0:
+        return
+    if blocks and blocks[-1][0] == op:
+        blocks[-1] = (op, blocks[-1][1] + length)
+    else:
+        blocks.append((op, length))
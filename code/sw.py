@@ -192,6 +192,21 @@ def generate_alignments(query,
 
     return alignments
 
+def generate_alignments_threaded(query_target_pairs,
+                                 alignment_type,
+                                 num_threads=1,
+                                 **kwargs):
+    ''' Yields generate_alignments(query, target, alignment_type, **kwargs) for
+        each (query, target) in query_target_pairs, in order. Matrix generation
+        and backtracking release the GIL, so these run in parallel on
+        num_threads threads.
+    '''
+    def align(query_target_pair):
+        query, target = query_target_pair
+        return generate_alignments(query, target, alignment_type, **kwargs)
+
+    return utilities.threaded_map(align, query_target_pairs, num_threads)
+
 def propose_edge_ends(score_matrix,
                       cells_seen,
                       min_score=None,
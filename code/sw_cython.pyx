@@ -1,5 +1,6 @@
 import numpy as np
 cimport cython
+from libc.stdlib cimport malloc, free
 
 cdef int SOFT_CLIPPED_typed = -2
 SOFT_CLIPPED = SOFT_CLIPPED_typed
@@ -18,7 +19,12 @@ def generate_matrices(char* query,
                      ):
     cdef unsigned int row, col, next_col, next_row
     cdef int match_or_mismatch, diagonal, from_left, from_above, new_score, unconstrained_start
-    shape = (len(query) + 1, len(target) + 1)
+    cdef int max_score = 0, max_row = 0, max_col = 0
+    cdef unsigned int query_length = len(query)
+    cdef unsigned int target_length = len(target)
+    cdef int c_force_query_start = bool(force_query_start)
+    cdef int c_force_target_start = bool(force_target_start)
+    shape = (query_length + 1, target_length + 1)
     scores = np.zeros(shape, int)
     cdef long[:, ::1] scores_view = scores
     row_directions = np.zeros(shape, int)
@@ -26,48 +32,49 @@ def generate_matrices(char* query,
     col_directions = np.zeros(shape, int)
     cdef long[:, ::1] col_directions_view = col_directions
 
-    # If the alignment is constrained to include the start of the query,
-    # indel penalties need to be applied to cells in the first row.
-    if force_query_start: 
-        for row in range(1, len(query) + 1):
-            scores_view[row, 0] = scores_view[row - 1, 0] + indel_penalty
-            row_directions_view[row, 0] = -1
+    unconstrained_start = not (force_query_start or force_target_start or force_either_start)
 
-    # If the alignment is constrained to include the start of the target,
-    # indel penalties need to be applied to cells in the first column.
-    if force_target_start:
-        for col in range(1, len(target) + 1):
-            scores_view[0, col] = scores_view[0, col - 1] + indel_penalty
-            col_directions_view[0, col] = -1
+    with nogil:
+        # If the alignment is constrained to include the start of the query,
+        # indel penalties need to be applied to cells in the first row.
+        if c_force_query_start:
+            for row in range(1, query_length + 1):
+                scores_view[row, 0] = scores_view[row - 1, 0] + indel_penalty
+                row_directions_view[row, 0] = -1
 
-    unconstrained_start = not (force_query_start or force_target_start or force_either_start)
+        # If the alignment is constrained to include the start of the target,
+        # indel penalties need to be applied to cells in the first column.
+        if c_force_target_start:
+            for col in range(1, target_length + 1):
+                scores_view[0, col] = scores_view[0, col - 1] + indel_penalty
+                col_directions_view[0, col] = -1
 
-    for row in range(1, len(query) + 1):
-        for col in range(1, len(target) + 1):
-            if query[row - 1] == target[col - 1]:
-                match_or_mismatch = match_bonus
-            else:
-                match_or_mismatch = mismatch_penalty
-            diagonal = scores_view[row - 1, col - 1] + match_or_mismatch
-            from_left = scores_view[row, col - 1] + indel_penalty
-            from_above = scores_view[row - 1, col] + indel_penalty
-            new_score = max(diagonal, from_left, from_above)
-            if unconstrained_start:
-                new_score = max(0, new_score)
-            scores_view[row, col] = new_score
-            if new_score > max_score:
-                max_score = new_score
-                max_row = row
-                max_col = col
-            if unconstrained_start and new_score == 0:
-                pass
-            elif new_score == diagonal:
-                col_directions_view[row, col] = -1
-                row_directions_view[row, col] = -1
-            elif new_score == from_left:
-                col_directions_view[row, col] = -1
-            elif new_score == from_above:
-                row_directions_view[row, col] = -1
+        for row in range(1, query_length + 1):
+            for col in range(1, target_length + 1):
+                if query[row - 1] == target[col - 1]:
+                    match_or_mismatch = match_bonus
+                else:
+                    match_or_mismatch = mismatch_penalty
+                diagonal = scores_view[row - 1, col - 1] + match_or_mismatch
+                from_left = scores_view[row, col - 1] + indel_penalty
+                from_above = scores_view[row - 1, col] + indel_penalty
+                new_score = max(diagonal, from_left, from_above)
+                if unconstrained_start:
+                    new_score = max(0, new_score)
+                scores_view[row, col] = new_score
+                if new_score > max_score:
+                    max_score = new_score
+                    max_row = row
+                    max_col = col
+                if unconstrained_start and new_score == 0:
+                    pass
+                elif new_score == diagonal:
+                    col_directions_view[row, col] = -1
+                    row_directions_view[row, col] = -1
+                elif new_score == from_left:
+                    col_directions_view[row, col] = -1
+                elif new_score == from_above:
+                    row_directions_view[row, col] = -1
 
     matrices = {'scores': scores,
                 'row_directions': row_directions,
@@ -75,6 +82,79 @@ def generate_matrices(char* query,
                }
     return matrices
 
+@cython.boundscheck(False)
+cdef int _walk_back(long[:, :] row_directions,
+                    long[:, :] col_directions,
+                    long[:, :] scores,
+                    int row,
+                    int col,
+                    int force_query_start,
+                    int force_target_start,
+                    int force_either_start,
+                    int *rows,
+                    int *cols,
+                    int *next_rows,
+                    int *next_cols,
+                   ) nogil:
+    ''' Follows the direction matrices back from (row, col), recording every
+        cell visited and the cell it points to. Returns the number of steps
+        recorded. If the walk gets stuck on a cell before reaching an end, that
+        cell is recorded a second time so that the caller's cells_seen check
+        rejects the path.
+    '''
+    cdef int num_steps = 0
+    cdef int next_row, next_col
+    cdef int reached_end
+    cdef int unconstrained_start = not (force_query_start or force_target_start or force_either_start)
+
+    if row == 0 or col == 0:
+        # There are no query or target bases involved in a path that ends on
+        # the top or the left edge.
+        return 0
+
+    while True:
+        next_col = col + col_directions[row, col]
+        next_row = row + row_directions[row, col]
+
+        rows[num_steps] = row
+        cols[num_steps] = col
+        next_rows[num_steps] = next_row
+        next_cols[num_steps] = next_col
+        num_steps += 1
+
+        reached_end = False
+        if unconstrained_start:
+            if scores[next_row, next_col] <= 0:
+                reached_end = True
+        elif force_query_start and force_target_start:
+            if next_row == 0 and next_col == 0:
+                reached_end = True
+        elif force_either_start:
+            if next_row == 0 or next_col == 0:
+                reached_end = True
+        elif force_query_start:
+            if next_row == 0:
+                reached_end = True
+        elif force_target_start:
+            if next_col == 0:
+                reached_end = True
+
+        if reached_end:
+            break
+
+        if next_row == row and next_col == col:
+            rows[num_steps] = row
+            cols[num_steps] = col
+            next_rows[num_steps] = row
+            next_cols[num_steps] = col
+            num_steps += 1
+            break
+
+        row = next_row
+        col = next_col
+
+    return num_steps
+
 def backtrack_cython(char* query,
               char* target,
               matrices,
@@ -86,6 +166,7 @@ def backtrack_cython(char* query,
               int force_either_start,
              ):
     cdef int row, col, next_row, next_col, target_index, query_index
+    cdef int step, num_steps
     query_mappings = np.full(len(query), SOFT_CLIPPED_typed, int)
     cdef long [:] query_mappings_view = query_mappings
     target_mappings = np.full(len(target), SOFT_CLIPPED_typed, int)
@@ -95,68 +176,69 @@ def backtrack_cython(char* query,
     cdef long [:, :] row_directions = matrices['row_directions']
     cdef long [:, :] scores = matrices['scores']
 
+    # Every step moves up, left, or both, so a path can't be longer than this
+    # (plus one for a repeated cell on a stuck walk).
+    cdef int max_steps = len(query) + len(target) + 2
+    cdef int *rows = <int *> malloc(max_steps * sizeof(int))
+    cdef int *cols = <int *> malloc(max_steps * sizeof(int))
+    cdef int *next_rows = <int *> malloc(max_steps * sizeof(int))
+    cdef int *next_cols = <int *> malloc(max_steps * sizeof(int))
+
     path = []
     insertions = set()
     deletions = set()
     mismatches = set()
-    
-    unconstrained_start = not(force_query_start or force_target_start or force_either_start)
 
-    row = end_row
-    col = end_col
+    try:
+        with nogil:
+            num_steps = _walk_back(row_directions,
+                                   col_directions,
+                                   scores,
+                                   end_row,
+                                   end_col,
+                                   force_query_start,
+                                   force_target_start,
+                                   force_either_start,
+                                   rows,
+                                   cols,
+                                   next_rows,
+                                   next_cols,
+                                  )
 
-    if row == 0 or col == 0:
-        # There are no query or target bases involved in a path that ends on
-        # the top or the left edge.
-        reached_end = True
-    else:
-        reached_end = False
+        for step in range(num_steps):
+            row = rows[step]
+            col = cols[step]
+            next_row = next_rows[step]
+            next_col = next_cols[step]
 
-    while not reached_end:
-        if (row, col) in cells_seen:
-            return None
-        cells_seen.add((row, col))
+            if (row, col) in cells_seen:
+                return None
+            cells_seen.add((row, col))
 
-        next_col = col + col_directions[row, col]
-        next_row = row + row_directions[row, col]
-        if next_col == col:
-            target_index = GAP_typed
-            insertions.add(row - 1)
-        else:
-            target_index = col - 1
-        if next_row == row:
-            query_index = GAP_typed
-            deletions.add(col - 1)
-        else:
-            query_index = row - 1
-        
-        if target_index != GAP_typed:
-            target_mappings_view[target_index] = query_index
-        if query_index != GAP_typed:
-            query_mappings_view[query_index] = target_index
-        if target_index != GAP_typed and query_index != GAP_typed and query[query_index] != target[target_index]:
-            mismatches.add((query_index, target_index))
-
-        path.append((query_index, target_index))
+            if next_col == col:
+                target_index = GAP_typed
+                insertions.add(row - 1)
+            else:
+                target_index = col - 1
+            if next_row == row:
+                query_index = GAP_typed
+                deletions.add(col - 1)
+            else:
+                query_index = row - 1
 
-        row = next_row
-        col = next_col
+            if target_index != GAP_typed:
+                target_mappings_view[target_index] = query_index
+            if query_index != GAP_typed:
+                query_mappings_view[query_index] = target_index
+            if target_index != GAP_typed and query_index != GAP_typed and query[query_index] != target[target_index]:
+                mismatches.add((query_index, target_index))
 
-        if unconstrained_start:
-            if scores[row, col] <= 0:
-                reached_end = True
-        elif force_query_start and force_target_start:
-            if row == 0 and col == 0:
-                reached_end = True
-        elif force_either_start:
-            if row == 0 or col == 0:
-                reached_end = True
-        elif force_query_start:
-            if row == 0:
-                reached_end = True
-        elif force_target_start:
-            if col == 0:
-                reached_end = True
+            path.append((query_index, target_index))
+    finally:
+        free(rows)
+        free(cols)
+        free(next_rows)
+        free(next_cols)
 
     path = path[::-1]
 
@@ -1,5 +1,7 @@
 from __future__ import division
 from itertools import izip, islice, groupby, cycle, product
+from collections import deque, Counter
+from concurrent import futures
 import subprocess
 import re
 import numpy as np
@@ -68,14 +70,119 @@ def mean_from_histogram(histogram):
         mean = np.true_divide(np.dot(histogram, np.arange(len(histogram))), histogram.sum())
     return mean
 
-def group_by(iterable, key=None):
+def _group_view(value, group, max_group_size, overflow, stats):
+    size = 0
+    for element in group:
+        size += 1
+        if max_group_size is not None and size > max_group_size:
+            if overflow == 'raise':
+                raise ValueError('group has more than max_group_size elements', value, max_group_size)
+            # overflow == 'truncate'
+            continue
+        yield element
+
+    if stats is not None:
+        stats['groups'] += 1
+        stats['elements'] += size
+        stats['largest'] = max(stats['largest'], size)
+        stats['sizes'][size] += 1
+        if max_group_size is not None and size > max_group_size:
+            stats['overflowed'] += 1
+            stats['dropped'] += size - max_group_size
+
+def stream_groups(iterable, key=None, max_group_size=None, overflow='raise', stats=None):
+    ''' Like group_by, but each group is yielded as a lazy iterator instead
+        of a list. As with itertools.groupby, a group's iterator is only valid
+        until the next group is requested.
+        
+        If max_group_size is given, a group with more elements than that either
+        raises ValueError when the extra element is reached (overflow='raise')
+        or only produces its first max_group_size elements (overflow='truncate').
+        
+        If stats (a dictionary) is given, it is kept updated with the number of
+        'groups' and 'elements', the 'largest' group size, a Counter of group
+        'sizes', and how many groups 'overflowed' and elements were 'dropped'.
+    '''
+    if overflow not in ('raise', 'truncate'):
+        raise ValueError('overflow must be \'raise\' or \'truncate\'', overflow)
+
+    if stats is not None:
+        for name in ['groups', 'elements', 'largest', 'overflowed', 'dropped']:
+            stats.setdefault(name, 0)
+        stats.setdefault('sizes', Counter())
+
+    for value, group in groupby(iterable, key):
+        view = _group_view(value, group, max_group_size, overflow, stats)
+        yield value, view
+        # Whatever the caller didn't consume still needs to be counted.
+        for _ in view:
+            pass
+
+def group_by(iterable, key=None, max_group_size=None, overflow='raise', stats=None):
     ''' Groups iterable into lists of consecutive elements that are transformed
-        into the same value key.
+        into the same value key. max_group_size, overflow and stats are as
+        for stream_groups.
     '''
-    groups = groupby(iterable, key)
+    if max_group_size is None and stats is None:
+        groups = groupby(iterable, key)
+    else:
+        groups = stream_groups(iterable, key, max_group_size, overflow, stats)
     group_lists = ((value, list(iterator)) for value, iterator in groups)
     return group_lists
 
+def chunks(iterable, chunk_size):
+    ''' Yields lists of up to chunk_size consecutive elements of iterable. '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+def threaded_map(function, iterable, num_threads=1, max_pending=None):
+    ''' Yields function(x) for each x in iterable, in order. If num_threads > 1,
+        calls are run on a pool of num_threads threads, which only helps if
+        function releases the GIL (e.g. the nogil Cython kernels). At most
+        max_pending calls (default 2 * num_threads) are in flight at once, so
+        iterable is consumed lazily.
+    '''
+    if num_threads <= 1:
+        for x in iterable:
+            yield function(x)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * num_threads
+
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for x in iterable:
+            pending.append(executor.submit(function, x))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def prefetch(iterable, chunk_size=1000, max_pending=4):
+    ''' Yields the elements of iterable in order while a background thread
+        reads ahead up to max_pending chunks of chunk_size elements. Only helps
+        if producing elements releases the GIL (e.g. pysam reading records).
+    '''
+    iterator = iter(iterable)
+    next_chunk = lambda: list(islice(iterator, chunk_size))
+
+    # A single worker runs the reads one after the other, in order.
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque(executor.submit(next_chunk) for _ in range(max_pending))
+        while True:
+            chunk = pending.popleft().result()
+            if not chunk:
+                break
+            pending.append(executor.submit(next_chunk))
+            for x in chunk:
+                yield x
+
 def round_robin(iterables):
     ''' Modified from recipe on itertools doc page credited to George Sakkis.
     '''
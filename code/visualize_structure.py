@@ -8,21 +8,23 @@ from Circles import periodicity
 import numpy as np
 import os.path
 
-def mapping_to_alignment(mapping, sam_file, base_lookup):
-    ''' Convert a mapping represented by a pysam.AlignedRead into an alignment. '''
+def mapping_to_alignment(mapping, sam_file, extent_fetcher, mismatch_positions=None):
+    ''' Convert a mapping represented by a pysam.AlignedRead into an alignment.
+        mismatch_positions, if already found for a group of mappings by
+        sam.group_mismatch_positions, saves looking them up again.
+    '''
+    if mismatch_positions is None:
+        mismatch_positions = sam.group_mismatch_positions([mapping], extent_fetcher)[0]
+    read_positions, ref_positions = mismatch_positions
+    mismatches = set(zip(read_positions.tolist(), ref_positions.tolist()))
+
     path = []
-    mismatches = set()
     deletions = set()
 
     for read_i, ref_i in sam.aligned_pairs_exclude_soft_clipping(mapping):
         if read_i != None:
             if ref_i == None:
                 ref_i = sw.GAP
-            else:
-                read_base = mapping.seq[read_i]
-                ref_base = base_lookup(mapping.tid, ref_i).upper()
-                if read_base != ref_base:
-                    mismatches.add((read_i, ref_i))
 
             path.append((read_i, ref_i))
         else:
@@ -59,14 +61,16 @@ def produce_bowtie2_alignments(reads,
                                                    yield_mappings=True,
                                                    **bowtie2_options)
 
-    base_lookup = genomes.build_base_lookup(genome_dir, sam_file)
+    extent_fetcher = genomes.build_extent_fetcher(genome_dir, sam_file)
 
     mapping_groups = utilities.group_by(mappings, lambda m: m.qname)
     
     for qname, group in mapping_groups:
         group = sorted(group, key=lambda m: (m.tid, m.pos))
-        alignments = [mapping_to_alignment(mapping, sam_file, base_lookup)
-                      for mapping in group if not mapping.is_unmapped]
+        group = [mapping for mapping in group if not mapping.is_unmapped]
+        group_mismatches = sam.group_mismatch_positions(group, extent_fetcher)
+        alignments = [mapping_to_alignment(mapping, sam_file, extent_fetcher, mismatch_positions)
+                      for mapping, mismatch_positions in zip(group, group_mismatches)]
         yield qname, alignments
 
 def get_local_alignments(read, targets):
@@ -8,6 +8,7 @@ include_dirs = [np.get_include()]
 ext_modules = [Extension('adapters_cython', ['Sequencing/adapters_cython.pyx'], include_dirs=include_dirs),
                Extension('fastq_cython', ['Sequencing/fastq_cython.pyx'], include_dirs=include_dirs),
                Extension('sw_cython', ['Sequencing/sw_cython.pyx'], include_dirs=include_dirs),
+               Extension('sam_cython', ['Sequencing/sam_cython.pyx'], include_dirs=include_dirs),
               ]
 
 setup(